@@ -41,10 +41,16 @@ setup(
     ],
     python_requires=">=3.5",
     install_requires=["pyqt5", "gevent"],
+    extras_require={"zstd": ["zstandard"]},
     keywords=[_name, "holy", "tftp", "server"],
     entry_points={
         "console_scripts": [
             "%s = src.main:main" % _exec,
+            "holytftp-history = src.tftp.history:main",
+            "holytftp-admin = src.tftp.admin:main",
+            "holytftp-replay = src.tftp.replay:main",
+            "holytftp-get = src.tftp.client:main_get",
+            "holytftp-put = src.tftp.client:main_put",
         ],
     },
 )
@@ -2,6 +2,7 @@ import os
 from os.path import expanduser
 import json
 from .log import log
+from .rules import RuleSet
 
 
 class Config(object):
@@ -11,14 +12,22 @@ class Config(object):
         self._work_path = os.path.abspath(".")
         self._filename = filename or expanduser("~/.config/holytftp.json")
         self._max_path = 9
+        self.generation = 0  # bumped whenever the name -> path mapping may change
+        self.on_save = None  # called after the file is written (the GUI tells the engine to reload)
+        self._rules = {}  # [tab] = RuleSet, compiled for self._rules_generation
+        self._rules_generation = None
 
         self.load()
 
+    def changed(self):
+        self.generation += 1
+
     def load(self):
         try:
             log.info("loading config from", self._filename)
             with open(self._filename, "r", encoding="utf-8") as f:
                 self._json = json.load(f)
+                self.changed()
         except (FileNotFoundError, ValueError):
             pass
 
@@ -29,6 +38,8 @@ class Config(object):
             log.info("saving config to", filename)
             with open(filename, "w", encoding="utf-8") as f:
                 json.dump(self._json, f, indent=4)
+            if self.on_save and filename == self._filename:
+                self.on_save()
         except OSError as e:
             if _try_count < 5:
                 os.makedirs(os.path.dirname(filename))
@@ -43,6 +54,7 @@ class Config(object):
     @active_tab.setter
     def active_tab(self, value):
         self._json["active_tab"] = value
+        self.changed()
 
     @property
     def port(self):
@@ -66,6 +78,10 @@ class Config(object):
             self._json["tabs"] = [{}, {}, {}]
             return self._json["tabs"]
 
+    def del_tab(self, index):
+        self.tabs.pop(index)
+        self.changed()
+
     def get_tab(self, index=None):
         if index is None:
             index = self.active_tab
@@ -119,6 +135,7 @@ class Config(object):
         else:
             paths[-1] = path
         t["paths"] = paths[-self._max_path:]
+        self.changed()
 
     def get_tab_paths(self, index=None):
         if index is None:
@@ -135,6 +152,7 @@ class Config(object):
             index = self.active_tab
         t = self.get_tab(index)
         t["virtualized"] = on
+        self.changed()
 
     def get_tab_vpaths(self, index=None):
         if index is None:
@@ -149,6 +167,7 @@ class Config(object):
             return False
         else:
             vpaths[name] = path
+            self.changed()
             return True
 
     def del_tab_vpath(self, name, index=None):
@@ -162,8 +181,64 @@ class Config(object):
         else:
             vpaths.pop(name)
             log.trace("pop", name)
+            self.changed()
             return True
 
+    def clear_tab_vpaths(self, index=None):
+        self.get_tab_vpaths(index).clear()
+        self.changed()
+
+    def get_tab_acl(self, index=None):
+        if index is None:
+            index = self.active_tab
+        ret = self.get_tab_val(index, "acl", [])  # ["allow read 10.0.0.0/8", "deny any 0.0.0.0/0"]
+        return ret if type(ret) is list else []
+
+    def set_tab_acl(self, rules, index=None):
+        self.get_tab(index)["acl"] = list(rules)
+        self.changed()
+
+    def get_tab_rules(self, index=None):
+        if index is None:
+            index = self.active_tab
+        ret = self.get_tab_val(index, "rules", [])  # [{"name" | "prefix" | "regex": ..., "path": ...}]
+        return ret if type(ret) is list else []
+
+    def set_tab_rules(self, rules, index=None):
+        self.get_tab(index)["rules"] = list(rules)
+        self.changed()
+
+    def get_tab_templates(self, index=None):
+        if index is None:
+            index = self.active_tab
+        ret = self.get_tab_val(index, "templates", [])  # [{"name" | "prefix" | "regex": ..., "template": ...}]
+        return ret if type(ret) is list else []
+
+    def get_tab_listen(self, index=None):
+        if index is None:
+            index = self.active_tab
+        ret = self.get_tab_val(index, "listen", "")  # "1069", "10.0.0.5" or "10.0.0.5:1069": own listener
+        return ret if type(ret) is str else ""
+
+    def set_tab_listen(self, listen, index=None):
+        self.get_tab(index)["listen"] = listen
+
+    def get_tab_ruleset(self, index=None):
+        """The compiled rules of the tab, None if it has none. Compiled again when the config changes."""
+        if index is None:
+            index = self.active_tab
+        if self._rules_generation != self.generation:
+            self._rules.clear()
+            self._rules_generation = self.generation
+        if index not in self._rules:
+            rules = self.get_tab_rules(index)
+            ruleset = None
+            if rules:
+                ruleset = RuleSet(rules, self.get_tab_path(index))
+                log.info("mapping rules of tab %d: %d of %d compiled" % (index, ruleset.size, len(rules)))
+            self._rules[index] = ruleset
+        return self._rules[index]
+
     @property
     def col_widths(self):
         ret = self._json.get("col_widths")
@@ -173,6 +248,257 @@ class Config(object):
             self._json["col_widths"] = [150, 130, 180, 100, 40, 400]
             return self._json["col_widths"]
 
+    @property
+    def max_history(self):
+        value = self._json.get("max_history")
+        if type(value) is not int or value < 0:
+            self._json["max_history"] = value = 1000
+        return value
+
+    @max_history.setter
+    def max_history(self, value):
+        if type(value) is not int or value < 0:
+            value = 1000
+        self._json["max_history"] = value
+
+    @property
+    def history(self):
+        return self._json.get("history", True)
+
+    @history.setter
+    def history(self, on: bool):
+        self._json["history"] = on
+
+    @property
+    def history_file(self):
+        value = self._json.get("history_file")
+        if type(value) is not str or not value:
+            value = expanduser("~/.config/holytftp.db")
+        return value
+
+    @history_file.setter
+    def history_file(self, value):
+        self._json["history_file"] = value
+
+    @property
+    def batch_io(self):
+        return self._json.get("batch_io", True)
+
+    @batch_io.setter
+    def batch_io(self, on: bool):
+        self._json["batch_io"] = on
+
+    @property
+    def neg_cache_ttl(self):
+        value = self._json.get("neg_cache_ttl")
+        if type(value) not in (int, float) or value < 0:
+            self._json["neg_cache_ttl"] = value = 5
+        return value
+
+    @neg_cache_ttl.setter
+    def neg_cache_ttl(self, value):
+        self._json["neg_cache_ttl"] = value
+
+    @property
+    def preload(self):
+        ret = self._json.get("preload")
+        if type(ret) is list:
+            return ret
+        return []
+
+    @property
+    def preload_hottest(self):
+        value = self._json.get("preload_hottest")
+        if type(value) is not int or value < 0:
+            self._json["preload_hottest"] = value = 0
+        return value
+
+    @property
+    def preload_mode(self):
+        value = self._json.get("preload_mode")
+        if value not in ("pagecache", "memory"):
+            self._json["preload_mode"] = value = "pagecache"
+        return value
+
+    @property
+    def file_cache_mb(self):
+        value = self._json.get("file_cache_mb")
+        if type(value) is not int or value < 0:
+            self._json["file_cache_mb"] = value = 256
+        return value
+
+    @property
+    def dump_dir(self):
+        value = self._json.get("dump_dir")
+        if type(value) is not str or not value:
+            value = expanduser("~/.cache/holytftp")
+        return value
+
+    @property
+    def profile_seconds(self):
+        value = self._json.get("profile_seconds")
+        if type(value) not in (int, float) or value <= 0:
+            self._json["profile_seconds"] = value = 30
+        return value
+
+    @property
+    def capture_packets(self):
+        value = self._json.get("capture_packets")
+        if type(value) is not int or value < 0:
+            self._json["capture_packets"] = value = 64
+        return value
+
+    @property
+    def capture_server_packets(self):
+        value = self._json.get("capture_server_packets")
+        if type(value) is not int or value < 0:
+            self._json["capture_server_packets"] = value = 4096
+        return value
+
+    @property
+    def admin_socket(self):
+        value = self._json.get("admin_socket")
+        if type(value) is not str:
+            value = expanduser("~/.cache/holytftp/admin.sock")
+        return value
+
+    @property
+    def workers(self):
+        value = self._json.get("workers")
+        if type(value) is not int or value < 1:
+            self._json["workers"] = value = 4
+        return value
+
+    @property
+    def rate_limit(self):
+        value = self._json.get("rate_limit")
+        if type(value) is not int or value < 0:
+            self._json["rate_limit"] = value = 0
+        return value
+
+    @property
+    def drain_seconds(self):
+        value = self._json.get("drain_seconds")
+        if type(value) not in (int, float) or value < 0:
+            self._json["drain_seconds"] = value = 60
+        return value
+
+    @property
+    def reuse_port(self):
+        return self._json.get("reuse_port", True)
+
+    @property
+    def queue_depth(self):
+        value = self._json.get("queue_depth")
+        if type(value) is not int or value < 1:
+            self._json["queue_depth"] = value = 256
+        return value
+
+    @property
+    def source_rate(self):
+        value = self._json.get("source_rate")
+        if type(value) not in (int, float) or value < 0:
+            self._json["source_rate"] = value = 50
+        return value
+
+    @property
+    def source_burst(self):
+        value = self._json.get("source_burst")
+        if type(value) is not int or value < 1:
+            self._json["source_burst"] = value = 100
+        return value
+
+    @property
+    def mtu_frames(self):
+        value = self._json.get("mtu_frames")  # frames a DATA packet may span, 0: no cap
+        if type(value) is not int or value < 0:
+            self._json["mtu_frames"] = value = 1
+        return value
+
+    @property
+    def subnet_mtu(self):
+        ret = self._json.get("subnet_mtu")  # {"10.0.0.0/8": 9000, ...}
+        if type(ret) is dict:
+            return ret
+        return {}
+
+    @property
+    def upstream(self):
+        value = self._json.get("upstream")  # "host[:port]" of the server to relay, "" to disable
+        if type(value) is not str:
+            value = ""
+        return value
+
+    @property
+    def relay_cache_dir(self):
+        value = self._json.get("relay_cache_dir")
+        if type(value) is not str or not value:
+            value = expanduser("~/.cache/holytftp/relay")
+        return value
+
+    @property
+    def relay_cache_mb(self):
+        value = self._json.get("relay_cache_mb")
+        if type(value) is not int or value < 0:
+            self._json["relay_cache_mb"] = value = 1024
+        return value
+
+    @property
+    def relay_ttl(self):
+        value = self._json.get("relay_ttl")  # seconds a relayed file is served before revalidation
+        if type(value) not in (int, float) or value < 0:
+            self._json["relay_ttl"] = value = 300
+        return value
+
+    @property
+    def dedup_store(self):
+        value = self._json.get("dedup_store")  # directory of the upload chunk store, "" to disable
+        if type(value) is not str:
+            value = ""
+        return value
+
+    @property
+    def dedup_chunk_kb(self):
+        value = self._json.get("dedup_chunk_kb")
+        if type(value) is not int or value < 1:
+            self._json["dedup_chunk_kb"] = value = 64
+        return value
+
+    @property
+    def upload_stages(self):
+        ret = self._json.get("upload_stages")  # ["limit:2G", "sha256", "crc32", "gzip:6" or "zstd:3"]
+        if type(ret) is list:
+            return ret
+        return []
+
+    @property
+    def frame_cache_mb(self):
+        value = self._json.get("frame_cache_mb")  # decompressed frames of .gz/.zst files, shared
+        if type(value) is not int or value < 0:
+            self._json["frame_cache_mb"] = value = 64
+        return value
+
+    @property
+    def netascii_cache_mb(self):
+        value = self._json.get("netascii_cache_mb")  # small text files kept translated to netascii
+        if type(value) is not int or value < 0:
+            self._json["netascii_cache_mb"] = value = 16
+        return value
+
+    @property
+    def render_cache_mb(self):
+        value = self._json.get("render_cache_mb")  # renderings of the tabs' templates
+        if type(value) is not int or value < 0:
+            self._json["render_cache_mb"] = value = 16
+        return value
+
+    @property
+    def trace_file(self):
+        value = self._json.get("trace_file")  # requests trace for holytftp-replay, "" to disable
+        if type(value) is not str:
+            value = ""
+        return value
+
     @property
     def size(self):
         return self._json.get("width", 700), self._json.get("height", 500)
@@ -207,13 +533,19 @@ class Config(object):
     def always_top(self, on: bool):
         self._json["always_top"] = on
 
-    def get_real_path(self, filename):
-        if self.get_tab_virtualized():
-            vpaths = self.get_tab_vpaths()
+    def get_real_path(self, filename, index=None):
+        if index is None:
+            index = self.active_tab
+        ruleset = self.get_tab_ruleset(index)
+        if ruleset is not None:
+            path = ruleset.resolve(filename)
+            if path is not None:
+                return path or None
+        if self.get_tab_virtualized(index):
+            vpaths = self.get_tab_vpaths(index)
             return vpaths.get(filename)
         else:
-            path = self.get_tab_path()
+            path = self.get_tab_path(index)
             return os.path.join(path, filename)
 
-
 cfg = Config()
@@ -0,0 +1,241 @@
+"""
+The transfer engine runs in a child process of the GUI, so that a modal
+dialog or a slow repaint never stalls a session.
+
+The GUI starts `python -m src.main --engine` with one end of a socket
+pair (its fd in HOLYTFTP_ENGINE_FD). Both ends send JSON lines:
+
+    engine -> GUI   {"ev": "start" | "update" | "stop" | "status" | "message" | "restart", ...}
+    GUI -> engine   {"cmd": "reload" | "warmup" | "shutdown"}
+
+The engine never waits for the GUI: events are queued and written by a
+greenlet of their own, progress is coalesced per session, and if the GUI
+stops reading the queue is bounded (the oldest events are dropped).
+
+An engine cannot restart itself like a headless server (its successor
+would have no link to the GUI): it asks the GUI, which drains it and
+starts a new one.
+"""
+import os
+import sys
+import json
+import socket
+import subprocess
+from collections import deque
+import gevent
+from gevent.event import Event
+from .log import log
+from .config import cfg
+from .globals import g
+
+ENGINE_FD_ENV = "HOLYTFTP_ENGINE_FD"
+
+
+class EngineLink(object):
+    """The engine's end of the link: server callbacks become events, commands come back."""
+
+    MAX_EVENTS = 10000
+    FLUSH_INTERVAL = 0.2  # progress is sent at most this often
+    STATUS_INTERVAL = 1
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.sock.settimeout(None)  # not the TFTP default: the GUI may stay silent for long
+        self.events = deque()
+        self.ready = Event()  # events are waiting to be written
+        self.progress = {}  # [peer] = bytes transferred, not sent yet
+        self.dropped = 0
+
+    def send(self, event):
+        if len(self.events) >= self.MAX_EVENTS:
+            self.events.popleft()
+            self.dropped += 1
+        self.events.append(event)
+        self.ready.set()
+
+    def start_session(self, peer, is_read, file, size, filepath):
+        self.send({"ev": "start", "peer": peer, "read": is_read, "file": file, "size": size, "path": filepath})
+
+    def update_session(self, peer, transferred):
+        self.progress[peer] = transferred
+
+    def stop_session(self, peer, ok, title, detail="", results=None):
+        transferred = self.progress.pop(peer, None)
+        if transferred is not None:
+            self.send({"ev": "update", "sessions": [[peer, transferred]]})
+        self.send({"ev": "stop", "peer": peer, "ok": ok, "title": title, "detail": detail, "results": results})
+
+    def message(self, level, text):
+        self.send({"ev": "message", "level": level, "text": text})
+
+    def restart(self):
+        self.send({"ev": "restart"})
+
+    def ticker(self):
+        ticks = 0
+        while True:
+            gevent.sleep(self.FLUSH_INTERVAL)
+            if self.progress:
+                self.send({"ev": "update", "sessions": [[p, n] for p, n in self.progress.items()]})
+                self.progress.clear()
+            ticks += 1
+            if ticks * self.FLUSH_INTERVAL >= self.STATUS_INTERVAL:
+                ticks = 0
+                self.send({"ev": "status", "port": self.server.port, "sessions": len(self.server.sessions()),
+                           "draining": self.server.draining, "dropped": self.dropped,
+                           "counters": dict(self.server.stats.counters)})
+
+    def writer(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            while self.events:
+                lines = []
+                while self.events and len(lines) < 100:
+                    lines.append(json.dumps(self.events.popleft()))
+                self.sock.sendall(("\n".join(lines) + "\n").encode())
+
+    def reader(self):
+        for line in self.sock.makefile("rb"):
+            try:
+                cmd = json.loads(line.decode()).get("cmd")
+            except ValueError:
+                continue
+            log.debug("engine command:", cmd)
+            if cmd == "reload":
+                self.server.reload()
+            elif cmd == "warmup":
+                g.spawn(self.server.warmup)
+            elif cmd == "shutdown":
+                g.spawn(self.server.shutdown)
+        log.warn("the GUI is gone")
+        g.spawn(self.server.shutdown)
+
+    def start(self):
+        g.spawn(self.writer)
+        g.spawn(self.ticker)
+        g.spawn(self.reader)
+
+
+class EngineProcess(object):
+    """
+    The GUI's handle on the engine child. It stands in for the server
+    (g.server) in the GUI process: port, draining, sessions(), warmup(),
+    shutdown() and close(). A child that exits on its own is restarted,
+    at once when it asked for it.
+    """
+
+    RESTART_DELAY = 1
+
+    def __init__(self, main):
+        self.main = main
+        self.port = cfg.port
+        self.draining = False
+        self.counters = {}
+        self.proc = None
+        self.sock = None
+        self.restarting = False  # the engine asked for a new one, it is draining
+
+    def start(self):
+        ours, theirs = socket.socketpair()
+        fd = theirs.fileno()
+        os.set_inheritable(fd, True)
+        env = dict(os.environ)
+        env[ENGINE_FD_ENV] = str(fd)
+        self.proc = subprocess.Popen([sys.executable, "-m", "src.main", "--engine"], env=env, pass_fds=(fd,))
+        theirs.close()
+        ours.settimeout(None)
+        self.sock = ours
+        log.info("engine started, pid", self.proc.pid)
+        g.spawn(self.reader)
+
+    def command(self, cmd):
+        if self.sock is None:
+            return  # not started yet, it reads the config when it starts
+        try:
+            self.sock.sendall((json.dumps({"cmd": cmd}) + "\n").encode())
+        except OSError as e:
+            log.error("cannot reach the engine:", e)
+
+    def reload(self):
+        if not self.draining:  # the config is saved once more on the way out
+            self.command("reload")
+
+    def warmup(self):
+        self.command("warmup")
+
+    def sessions(self):
+        return list(self.main.sessions)
+
+    def restart(self):
+        if self.draining or self.restarting:
+            return
+        log.warn("restarting the engine once it has drained")
+        self.restarting = True
+        self.command("shutdown")
+
+    def shutdown(self, code=0, deadline=None):
+        """Let the engine finish its sessions, then exit with it."""
+        self.draining = True
+        if not self.restarting:  # already told, a second shutdown would cut its drain short
+            self.command("shutdown")
+        self.proc.wait()
+        sys.exit(code)
+
+    def close(self):
+        self.draining = True
+        if not self.restarting:
+            self.command("shutdown")
+        self.proc.wait()
+
+    def dispatch(self, ev):
+        kind = ev.get("ev")
+        if kind == "start":
+            self.main.start_session(tuple(ev["peer"]), ev["read"], ev["file"], ev["size"], ev["path"])
+        elif kind == "update":
+            for peer, transferred in ev["sessions"]:
+                self.main.update_session(tuple(peer), transferred)
+        elif kind == "stop":
+            self.main.stop_session(tuple(ev["peer"]), ev["ok"], ev["title"], ev["detail"], ev["results"])
+        elif kind == "status":
+            self.port = ev["port"]
+            self.counters = ev["counters"]
+        elif kind == "message":
+            {"warn": g.warn, "error": g.error}.get(ev["level"], g.info)(ev["text"])
+        elif kind == "restart":
+            self.restart()
+
+    def reader(self):
+        for line in self.sock.makefile("rb"):
+            try:
+                self.dispatch(json.loads(line.decode()))
+            except (ValueError, KeyError, TypeError) as e:
+                log.error("bad event from the engine:", e)
+        code = self.proc.wait()
+        self.sock.close()
+        self.sock = None  # commands are dropped until a new engine starts
+        for peer in list(self.main.sessions):
+            self.main.stop_session(peer, False, "Error", "The engine exited")
+        if self.draining:
+            return  # shutdown() or close() is waiting for it and exits
+        if self.restarting:
+            self.restarting = False
+        else:
+            log.error("engine exited with %s, restarting" % code)
+            gevent.sleep(self.RESTART_DELAY)
+        self.start()
+
+
+def run_engine():
+    """Entry of the child process. Without a link to a GUI it simply runs headless."""
+    from .tftp import TftpServer
+    fd = os.environ.pop(ENGINE_FD_ENV, None)
+    g.server = TftpServer(cfg.port)
+    if fd:
+        link = EngineLink(g.server, socket.socket(fileno=int(fd)))
+        g.engine = link
+        g.server.set_callback(link.start_session, link.update_session, link.stop_session)
+        link.start()
+    g.spawn(g.server.start)
+    g.goin()
@@ -9,6 +9,7 @@ class Globals(object):
     app = None
     server = None
     main = None
+    engine = None  # link to the GUI when running as its engine process
     glist = []
 
     def spawn(self, func, *args, **kwargs):
@@ -37,15 +38,31 @@ class Globals(object):
             log.error(e)
             traceback.print_exc()
             cfg.save()
+            if g.server is not None and not g.server.draining:
+                # let the in-flight transfers finish instead of killing them
+                gevent.spawn(cls.gevent_wrapper, g.server.shutdown, (1,))
+                return
             exit(1)
 
     def warn(self, string):
+        if self.engine is not None:
+            return self.engine.message("warn", string)
+        if self.app is None:  # headless
+            return log.warn(string)
         QMessageBox.warning(self.main, "Warning", string, QMessageBox.Ok, QMessageBox.Ok)
 
     def error(self, string):
+        if self.engine is not None:
+            return self.engine.message("error", string)
+        if self.app is None:
+            return log.error(string)
         QMessageBox.critical(self.main, "Error", string, QMessageBox.Close, QMessageBox.Close)
 
     def info(self, string):
+        if self.engine is not None:
+            return self.engine.message("info", string)
+        if self.app is None:
+            return log.info(string)
         QMessageBox.information(self.main, "Information", string, QMessageBox.Ok, QMessageBox.Ok)
 
     def ask(self, title, string):
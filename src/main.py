@@ -1,43 +1,24 @@
 #!/usr/bin/python3
 
 import time
+import argparse
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from src.Ui_window import Ui_MainWindow
 from src.tftp import *
 from src.config import cfg
+from src.model import SessionTableModel
+from src.utils import bytes2human
+from src.engine import EngineProcess, run_engine
 
 monkey.patch_all()
 
 
-def bytes2human(n, precision=4):
-    b = int(n % 1024)
-    n /= 1024
-    k = int(n % 1024)
-    n /= 1024
-    m = int(n % 1024)
-    n /= 1024
-    g = int(n % 1024)
-    n /= 1024
-    t = int(n % 1024)
-    if t:
-        s, u = "%.2f" % (t + g/1024), "TB"
-    elif g:
-        s, u = "%.2f" % (g + m/1024), "GB"
-    elif m:
-        s, u = "%.2f" % (m + k/1024), "MB"
-    elif k:
-        s, u = "%.2f" % (k + b/1024), "KB"
-    else:
-        s, u = "%d" % b, "B"
-    return s[:int(precision)].strip(".") + " " + u
-
-
 class Session(object):
-    def __init__(self, peer, index, is_read, size, file, full_path, transferred=0):
+    def __init__(self, peer, row_id, is_read, size, file, full_path, transferred=0):
         self.peer = peer
-        self.index = index
+        self.row_id = row_id
         self.is_read = is_read
         self.size = size
         self.file = file
@@ -91,7 +72,7 @@ class TabBarWithCtxMenu(QTabBar):
             self.removeTab(self.clicked_index)
             if self.clicked_index == count - 2:
                 self.setCurrentIndex(self.clicked_index - 1)
-            cfg.tabs.pop(self.clicked_index)
+            cfg.del_tab(self.clicked_index)
             cfg.save()
 
     def on_real_folder(self, checked: bool):
@@ -134,14 +115,13 @@ class LineEditWithClick(QLineEdit):
 
 
 class MainWindow(QMainWindow, Ui_MainWindow):
-    COLUMN_NUMBER = 6
     F_COL_NUM = 2
 
     def __init__(self):
         super().__init__()
         self.setupUi(self)
 
-        self.modelSessions = QStandardItemModel(0, self.COLUMN_NUMBER)
+        self.modelSessions = SessionTableModel(cfg.max_history)
         self.modelFiles = QStandardItemModel(0, self.F_COL_NUM)
         self.sessions = {}
         self.last_update_ui = 0.0
@@ -194,11 +174,19 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         a.triggered.connect(self.on_action_always_top)
         self.on_action_always_top(cfg.always_top)
 
+        self.menu.addSeparator()
+        a = self.menu.addAction("Warm Up Cache")
+        a.triggered.connect(self.on_action_warmup)
+
     @staticmethod
     def on_action_min2tray(checked: bool):
         cfg.min2tray = checked
         cfg.save()
 
+    @staticmethod
+    def on_action_warmup(checked: bool):
+        g.spawn(g.server.warmup)
+
     def on_action_always_top(self, checked: bool):
         # flags = self.windowFlags()
         # if checked:
@@ -231,6 +219,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.tabWidget.removeTab(0)
         for i in range(len(cfg.tabs)):
             self.tabWidget.addTab(QWidget(), cfg.get_tab_name(i))
+            if cfg.get_tab_listen(i):
+                self.tabWidget.setTabToolTip(i, "Also served on " + cfg.get_tab_listen(i))
         self.tabWidget.addTab(QWidget(), "+")
 
         self.tabWidget.currentChanged.connect(self.on_activate_tab)
@@ -239,14 +229,6 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def init_table(self):
         self.tableSessions.setModel(self.modelSessions)
-        self.modelSessions.setHorizontalHeaderLabels(
-            [" Client ", " Status ", " Request ", " Transferred ", " % ", " File "])
-        items = [self.modelSessions.horizontalHeaderItem(i) for i in range(self.COLUMN_NUMBER)]
-        items[0].setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        items[2].setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        items[3].setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        items[4].setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        items[5].setTextAlignment(Qt.AlignLeft | Qt.AlignVCenter)
 
         for i in range(len(cfg.col_widths)):
             self.tableSessions.setColumnWidth(i, cfg.col_widths[i])
@@ -340,7 +322,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if not g.ask("Warning", "Sure to delete all virtual files?"):
             return
         self.modelFiles.setRowCount(0)
-        cfg.get_tab_vpaths().clear()
+        cfg.clear_tab_vpaths()
         cfg.save()
 
     def on_click_menu(self):
@@ -417,40 +399,28 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def closeEvent(self, event: QCloseEvent):
         log.warn("terminated for window closed")
         # save window geometry
-        g = self.geometry()
-        cfg.position = g.x(), g.y()
-        cfg.size = g.width(), g.height()
+        geo = self.geometry()
+        cfg.position = geo.x(), geo.y()
+        cfg.size = geo.width(), geo.height()
         # save column widths
         for i in range(len(cfg.col_widths)):
             cfg.col_widths[i] = self.tableSessions.columnWidth(i)
         # save to file
         cfg.save()
+        if g.server:
+            if g.server.sessions():
+                # let the in-flight transfers finish, then exit
+                self.hide()
+                self.tray.hide()
+                g.spawn(g.server.shutdown)
+                event.ignore()
+                return
+            g.server.close()
         sys.exit(0)
 
     def start_session(self, peer, is_read, file, size, filepath):
-        self.sessions[peer] = Session(peer, self.modelSessions.rowCount(), is_read, size, file, filepath)
-
-        items = [QStandardItem() for i in range(MainWindow.COLUMN_NUMBER)]
-
-        items[0].setText(" %-15s:%d " % peer)
-        items[1].setText(" Downloading... " if is_read else " Uploading... ")
-        items[1].setForeground(QColor(0x009900))
-        items[1].font().setBold(True)
-        items[1].setTextAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
-        items[2].setText(" %s %s " % ("<<" if is_read else ">>", file))
-        items[2].setToolTip(file)
-        items[3].setText(" 0 ")
-        items[3].setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        items[4].setText(" 0 " if size > 0 else " N/A ")
-        items[4].setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
-        items[5].setText(" %s " % filepath)
-        items[5].setToolTip(filepath)
-
-        for t in items:
-            t.setForeground(QColor(0x009900))
-            t.setBackground(QColor(0xf8fff8))
-
-        self.modelSessions.appendRow(items)
+        row_id = self.modelSessions.add(peer, is_read, size, file, filepath)
+        self.sessions[peer] = Session(peer, row_id, is_read, size, file, filepath)
         self.tableSessions.scrollToBottom()
 
     def update_session(self, peer, transferred):
@@ -460,40 +430,22 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.transferred += transferred - ss.transferred
         ss.transferred = transferred
+        self.modelSessions.update(ss.row_id, transferred)
         interval = time.time() - self.last_update_ui
         if interval < 0.2:
             return  # slowly update ui
 
         self.last_update_ui = time.time()
-        items = [self.modelSessions.item(ss.index, i) for i in range(MainWindow.COLUMN_NUMBER)]
-        items[3].setText(" {:,} ".format(transferred))
-        items[3].setToolTip("<b>{}</b><br>{:,}".format(bytes2human(transferred), transferred))
+        self.modelSessions.flush()
 
-        if ss.size > 0:
-            items[4].setText(" %d " % (transferred * 100 / ss.size))
-
-    def stop_session(self, peer, ok, title, detail=""):
+    def stop_session(self, peer, ok, title, detail="", results=None):
         ss = self.sessions.get(peer)
         if not ss:
             return
 
-        items = [self.modelSessions.item(ss.index, i) for i in range(MainWindow.COLUMN_NUMBER)]
-        items[1].setText(" Completed " if ok else title)
-        items[3].setText(" {:,} ".format(ss.transferred))
-        items[3].setToolTip("<b>{}</b><br>{:,}".format(bytes2human(ss.transferred), ss.transferred))
-
-        if not ok and detail:
-            items[1].setToolTip(detail)
-
-        if ss.size > 0:
-            items[4].setText(" %d " % (ss.transferred * 100 / ss.size))
-
-        for t in items:
-            f = t.font()
-            f.setBold(False)
-            t.setFont(f)
-            t.setForeground(QColor(0) if ok else QColor(0xff0000))
-            t.setBackground(QColor(0xffffff))
+        if ok and results:
+            detail = "<br>".join("%s: %s" % (k, v) for k, v in sorted(results.items()))
+        self.modelSessions.finish(ss.row_id, ok, title, detail)
 
         if os.access(ss.full_path, os.F_OK):
             # check if it's in virtual file list
@@ -538,16 +490,37 @@ def run_ui_timer(m, svr):
         last_time = time.time()
 
 
+def run_headless():
+    g.server = TftpServer(cfg.port)
+    g.spawn(g.server.start)
+    g.goin()
+
+
 def main():
     log.trace("pid:", os.getpid())
 
-    g.app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(prog="HolyTFTP", description="A TFTP server with GUI.")
+    parser.add_argument("--headless", action="store_true", help="run the server without GUI")
+    parser.add_argument("--in-process", action="store_true",
+                        help="run the transfers in the GUI process instead of a child process")
+    parser.add_argument("--engine", action="store_true", help=argparse.SUPPRESS)
+    args, qt_args = parser.parse_known_args()
+    if args.headless:
+        return run_headless()
+    if args.engine:
+        return run_engine()
+
+    g.app = QApplication(sys.argv[:1] + qt_args)
 
     g.main = MainWindow()
     g.spawn(run_main_ui, g.app)
 
-    g.server = TftpServer(cfg.port)
-    g.server.set_callback(g.main.start_session, g.main.update_session, g.main.stop_session)
+    if args.in_process:
+        g.server = TftpServer(cfg.port)
+        g.server.set_callback(g.main.start_session, g.main.update_session, g.main.stop_session)
+    else:
+        g.server = EngineProcess(g.main)
+        cfg.on_save = g.server.reload
     g.spawn_later(0.5, g.server.start)
 
     g.spawn_later(1, run_ui_timer, g.main, g.server)
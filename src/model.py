@@ -0,0 +1,197 @@
+from array import array
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt5.QtGui import QColor
+from .utils import bytes2human
+
+
+class SessionTableModel(QAbstractTableModel):
+    """
+    Session table backed by column arrays.
+
+    Rows are addressed by a serial id handed out by add(), so active
+    sessions keep working after old rows are compacted away.
+    Only the cells requested by the view (i.e. the visible ones) are
+    formatted, in data().
+    """
+
+    HEADERS = [" Client ", " Status ", " Request ", " Transferred ", " % ", " File "]
+    HEADER_ALIGNS = [Qt.AlignLeft | Qt.AlignVCenter, Qt.AlignHCenter | Qt.AlignVCenter,
+                     Qt.AlignLeft | Qt.AlignVCenter, Qt.AlignRight | Qt.AlignVCenter,
+                     Qt.AlignRight | Qt.AlignVCenter, Qt.AlignLeft | Qt.AlignVCenter]
+
+    RUNNING = 0
+    COMPLETED = 1
+    FAILED = 2
+
+    FORE_COLORS = {RUNNING: QColor(0x009900), COMPLETED: QColor(0), FAILED: QColor(0xff0000)}
+    BACK_COLORS = {RUNNING: QColor(0xf8fff8), COMPLETED: QColor(0xffffff), FAILED: QColor(0xffffff)}
+
+    def __init__(self, capacity=1000, parent=None):
+        super().__init__(parent)
+        self.capacity = capacity
+        self.next_id = 0
+        self.ids = array("q")
+        self.ips = []
+        self.ports = array("l")
+        self.states = array("b")
+        self.reads = array("b")
+        self.sizes = array("q")
+        self.transferred = array("q")
+        self.files = []
+        self.paths = []
+        self.titles = []  # status text of failed sessions, None otherwise
+        self.details = []
+        self.active = {}  # [id] = row
+        self.dirty = set()  # rows changed since last flush()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.ids)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation != Qt.Horizontal:
+            return None
+        if role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        if role == Qt.TextAlignmentRole:
+            return self.HEADER_ALIGNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if role == Qt.DisplayRole:
+            return self.text(row, col)
+        if role == Qt.ForegroundRole:
+            return self.FORE_COLORS[self.states[row]]
+        if role == Qt.BackgroundRole:
+            return self.BACK_COLORS[self.states[row]]
+        if role == Qt.TextAlignmentRole:
+            if col == 1:
+                return Qt.AlignHCenter | Qt.AlignVCenter
+            if col in (3, 4):
+                return Qt.AlignRight | Qt.AlignVCenter
+            return None
+        if role == Qt.ToolTipRole:
+            if col == 1:
+                return self.details[row] or None
+            if col == 2:
+                return self.files[row]
+            if col == 3:
+                n = self.transferred[row]
+                return "<b>{}</b><br>{:,}".format(bytes2human(n), n)
+            if col == 5:
+                return self.paths[row]
+        return None
+
+    def text(self, row, col):
+        state = self.states[row]
+        if col == 0:
+            return " %-15s:%d " % (self.ips[row], self.ports[row])
+        if col == 1:
+            if state == self.COMPLETED:
+                return " Completed "
+            if state == self.FAILED:
+                return self.titles[row]
+            return " Downloading... " if self.reads[row] else " Uploading... "
+        if col == 2:
+            return " %s %s " % ("<<" if self.reads[row] else ">>", self.files[row])
+        if col == 3:
+            return " {:,} ".format(self.transferred[row])
+        if col == 4:
+            size = self.sizes[row]
+            return " %d " % (self.transferred[row] * 100 / size) if size > 0 else " N/A "
+        if col == 5:
+            return " %s " % self.paths[row]
+        return None
+
+    def add(self, peer, is_read, size, file, path):
+        row_id = self.next_id
+        self.next_id += 1
+        row = len(self.ids)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.ids.append(row_id)
+        self.ips.append(peer[0])
+        self.ports.append(peer[1])
+        self.states.append(self.RUNNING)
+        self.reads.append(1 if is_read else 0)
+        self.sizes.append(size)
+        self.transferred.append(0)
+        self.files.append(file)
+        self.paths.append(path)
+        self.titles.append(None)
+        self.details.append(None)
+        self.endInsertRows()
+        self.active[row_id] = row
+        self.compact()
+        return row_id
+
+    def update(self, row_id, transferred):
+        row = self.active.get(row_id)
+        if row is None:
+            return
+        self.transferred[row] = transferred
+        self.dirty.add(row)
+
+    def finish(self, row_id, ok, title, detail=""):
+        row = self.active.pop(row_id, None)
+        if row is None:
+            return
+        self.states[row] = self.COMPLETED if ok else self.FAILED
+        self.titles[row] = title
+        self.details[row] = detail or None
+        self.dirty.add(row)
+        self.flush()
+
+    def flush(self):
+        if not self.dirty:
+            return
+        first, last = min(self.dirty), max(self.dirty)
+        self.dirty.clear()
+        self.dataChanged.emit(self.index(first, 0), self.index(last, len(self.HEADERS) - 1))
+
+    def compact(self):
+        # drop the oldest finished rows, with some slack to amortize the cost
+        count = len(self.ids)
+        if self.capacity <= 0 or count <= self.capacity + max(self.capacity // 8, 1):
+            return
+        excess = count - self.capacity
+        drop = []
+        for row in range(count):
+            if excess <= 0:
+                break
+            if self.states[row] != self.RUNNING:
+                drop.append(row)
+                excess -= 1
+        if not drop:
+            return
+
+        self.flush()
+        # remove contiguous runs from the bottom up, so row numbers stay valid
+        runs = []
+        for row in drop:
+            if runs and runs[-1][1] == row - 1:
+                runs[-1][1] = row
+            else:
+                runs.append([row, row])
+        columns = [self.ids, self.ips, self.ports, self.states, self.reads, self.sizes,
+                   self.transferred, self.files, self.paths, self.titles, self.details]
+        for first, last in reversed(runs):
+            self.beginRemoveRows(QModelIndex(), first, last)
+            for c in columns:
+                del c[first:last + 1]
+            self.endRemoveRows()
+
+        self.active = {self.ids[row]: row
+                       for row in range(len(self.ids)) if self.states[row] == self.RUNNING}
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        self.compact()
@@ -0,0 +1,139 @@
+"""
+Filename mapping rules of a tab ("rules" in its config), tried before
+the tab folder or its virtual files:
+
+    {"name": "pxelinux.cfg/default", "path": "/srv/pxe/default"}
+    {"regex": "pxelinux\\.cfg/01-(?P<mac>[0-9a-f-]{17})", "path": "racks/{mac}.cfg"}
+    {"prefix": "images/", "path": "/srv/images/"}
+
+Exact names are looked up first, then the regexes in the order listed,
+then the longest prefix. A relative path is taken from the tab folder.
+In a regex rule's path, {0}, {1}... and {name} are its captures; a
+prefix rule appends the rest of the name to its path. A capture or rest
+holding a ".." component, or starting with "/" or a drive (it would
+replace the path it is put in), is refused. Names no rule maps are
+served as before.
+"""
+import os
+import re
+from collections import OrderedDict
+from .log import log
+
+NAMED_GROUP = re.compile(r"(?<!\\)\(\?P<\w+>")
+
+
+def normalize(name):
+    return name.replace("\\", "/").lstrip("/")
+
+
+def unsafe(value):
+    """Whether a capture or rest could lead out of its rule's path."""
+    return ".." in value.split("/") or value.startswith("/") or bool(os.path.splitdrive(value)[0])
+
+
+class RuleSet(object):
+    """
+    The rules of a tab, compiled: exact names in a dict, prefixes in one
+    dict per prefix length (probed longest first), and all the regexes
+    in a single alternation whose outer groups tell which rule matched.
+    Resolved names are kept in an LRU of CACHE_SIZE entries.
+
+    `target` is the key every rule must have: "path" for mapping rules,
+    others use match() with rules of their own (e.g. "template").
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self, rules, root, target="path"):
+        self.root = root
+        self.target = target
+        self.exact = {}  # [name] = rule
+        self.prefixes = {}  # [length] = {prefix: rule}
+        self.regex = None
+        self.targets = {}  # [outer group of a regex rule] = (rule, {capture name: group}, groups)
+        self.cache = OrderedDict()
+        self.size = 0
+        parts = []
+        group = 1
+        for rule in rules:
+            try:
+                if not isinstance(rule[target], str):
+                    raise TypeError("%s is not a string" % target)
+                if "name" in rule:
+                    self.exact.setdefault(normalize(rule["name"]), rule)
+                elif "prefix" in rule:
+                    prefix = normalize(rule["prefix"])
+                    self.prefixes.setdefault(len(prefix), {}).setdefault(prefix, rule)
+                elif "regex" in rule:
+                    source = rule["regex"]
+                    one = re.compile(source)
+                    if "(?P=" in source:
+                        raise ValueError("named backreferences are not supported")
+                    source = NAMED_GROUP.sub("(", source)  # names would clash in the alternation
+                    if re.compile(source).groups != one.groups:
+                        raise ValueError("cannot be combined")
+                    parts.append("(%s)" % source)
+                    self.targets[group] = (rule, {n: group + i for n, i in one.groupindex.items()}, one.groups)
+                    group += one.groups + 1
+                else:
+                    raise ValueError("needs a name, prefix or regex")
+                self.size += 1
+            except (KeyError, TypeError, ValueError, re.error) as e:
+                log.warn("invalid rule %r:" % (rule,), e)
+        if parts:
+            try:
+                self.regex = re.compile("|".join(parts))
+            except re.error as e:
+                log.error("regex rules ignored, they do not combine:", e)
+                self.targets.clear()
+        self.lengths = sorted(self.prefixes, reverse=True)
+
+    def absolute(self, path):
+        return os.path.join(self.root, path)  # an absolute path stays as it is
+
+    def match(self, name):
+        """(rule, [captures], {named captures}, rest after a prefix) of a normalized name, or None."""
+        rule = self.exact.get(name)
+        if rule is not None:
+            return rule, [], {}, None
+        if self.regex is not None:
+            m = self.regex.fullmatch(name)
+            if m:
+                base = m.lastindex  # the outer group closes last
+                rule, names, count = self.targets[base]
+                return (rule, [v or "" for v in m.groups()[base:base + count]],
+                        {n: m.group(i) or "" for n, i in names.items()}, None)
+        for length in self.lengths:
+            rule = self.prefixes[length].get(name[:length])
+            if rule is not None and len(name) >= length:
+                return rule, [], {}, name[length:]
+        return None
+
+    def lookup(self, name):
+        """Path of name; None if no rule maps it, "" if the rule refuses it."""
+        found = self.match(name)
+        if found is None:
+            return None
+        rule, groups, named, rest = found
+        path = rule[self.target]
+        if rest is not None:
+            return "" if unsafe(rest) else self.absolute(path + rest)
+        if any(unsafe(v) for v in groups):
+            return ""
+        try:
+            return self.absolute(path.format(*groups, **named))
+        except (IndexError, KeyError, ValueError) as e:
+            log.error("rule %r cannot map %s:" % (path, name), e)
+            return ""
+
+    def resolve(self, name):
+        name = normalize(name)
+        path = self.cache.get(name, False)
+        if path is not False:
+            self.cache.move_to_end(name)
+            return path
+        path = self.lookup(name)
+        self.cache[name] = path
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return path
@@ -0,0 +1,129 @@
+"""
+Access control per tab. The "acl" of a tab is a list of rules
+
+    "ACTION DIRECTION CIDR [PATTERN]"
+
+e.g. "allow read 10.0.0.0/8 pxelinux*", "deny write 0.0.0.0/0". ACTION
+is allow or deny, DIRECTION read, write or any, PATTERN a glob on the
+requested file name (default *). The rule with the longest prefix
+matching the client decides; among rules of the same prefix, the first
+one listed. A request no rule matches is allowed, so end the list with
+"deny any 0.0.0.0/0" to allow only what is listed.
+"""
+import re
+import socket
+import fnmatch
+import posixpath
+import ipaddress
+from ..log import log
+from ..config import cfg
+from .packet import TftpOpCode
+
+READ = 1
+WRITE = 2
+DIRECTIONS = {"read": READ, "write": WRITE, "any": READ | WRITE}
+OPCODES = {TftpOpCode.ReadRequest: READ, TftpOpCode.WriteRequest: WRITE}
+
+
+class Rule(object):
+    __slots__ = ("text", "allow", "directions", "match")
+
+    def __init__(self, text, allow, directions, match):
+        self.text = text
+        self.allow = allow
+        self.directions = directions
+        self.match = match  # None matches any name
+
+
+def normalize(name):
+    """The name a pattern is matched against: "/a//b", "a\\b" and "./a/b" are all "a/b"."""
+    return posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+
+
+class AccessList(object):
+    """
+    The rules of one tab. They are grouped by prefix length into one
+    hash table each ([network >> (32 - length)] = rules), and the tables
+    are probed longest prefix first: a lookup costs at most one dict
+    access per distinct prefix length, however many rules there are.
+    """
+
+    def __init__(self, rules):
+        tables = {}
+        matchers = {}  # [pattern] = compiled, shared by the rules using it
+        self.size = 0
+        for text in rules:
+            try:
+                rule, net = self.parse(text, matchers)
+            except ValueError as e:
+                log.warn("invalid acl rule %r:" % text, e)
+                continue
+            shift = 32 - net.prefixlen
+            tables.setdefault(shift, {}).setdefault(int(net.network_address) >> shift, []).append(rule)
+            self.size += 1
+        self.tables = sorted(tables.items())  # [(shift, table)], longest prefix first
+
+    @staticmethod
+    def parse(text, matchers):
+        words = str(text).split()
+        if len(words) not in (3, 4) or words[0] not in ("allow", "deny") or words[1] not in DIRECTIONS:
+            raise ValueError("expected ACTION DIRECTION CIDR [PATTERN]")
+        net = ipaddress.ip_network(words[2], strict=False)
+        if net.version != 4:
+            raise ValueError("only IPv4 is served")
+        pattern = normalize(words[3]) if len(words) == 4 else "*"
+        match = None
+        if pattern != "*":
+            match = matchers.get(pattern)
+            if match is None:
+                if any(c in pattern for c in "*?["):
+                    match = re.compile(fnmatch.translate(pattern)).match
+                else:
+                    match = pattern.__eq__
+                matchers[pattern] = match
+        return Rule(text, words[0] == "allow", DIRECTIONS[words[1]], match), net
+
+    def lookup(self, ip, direction, name):
+        """The rule deciding the request, or None."""
+        if not self.tables:
+            return None
+        try:
+            addr = int.from_bytes(socket.inet_aton(ip), "big")
+        except OSError:
+            return None
+        name = normalize(name)
+        for shift, table in self.tables:
+            rules = table.get(addr >> shift)
+            if rules:
+                for rule in rules:
+                    if rule.directions & direction and (rule.match is None or rule.match(name)):
+                        return rule
+        return None
+
+
+class Acl(object):
+    """The access lists of the tabs, compiled on first use and again when the config changes."""
+
+    def __init__(self):
+        self.lists = {}  # [tab] = AccessList
+        self.generation = None
+
+    def get(self, tab=None):
+        if self.generation != cfg.generation:
+            self.lists.clear()
+            self.generation = cfg.generation
+        if tab is None:
+            tab = cfg.active_tab
+        acl = self.lists.get(tab)
+        if acl is None:
+            self.lists[tab] = acl = AccessList(cfg.get_tab_acl(tab))
+            if acl.size:
+                log.info("acl of tab %d: %d rules, %d prefix lengths" % (tab, acl.size, len(acl.tables)))
+        return acl
+
+    def allowed(self, ip, opcode, name, tab=None):
+        direction = OPCODES.get(opcode)
+        if direction is None:
+            return True  # not a request, the session will refuse it anyway
+        rule = self.get(tab).lookup(ip, direction, name)
+        return rule is None or rule.allow
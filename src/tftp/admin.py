@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import errno
+import time
+import socket
+import argparse
+import gevent
+from ..log import log, Logger
+from ..config import cfg
+from ..globals import g
+from ..utils import bytes2human
+from .storage import is_archive
+from .acl import DIRECTIONS
+from .dedup import MIN_GRACE
+
+LOG_LEVELS = {"fatal": Logger.FATAL, "error": Logger.ERROR, "warn": Logger.WARN,
+              "debug": Logger.DEBUG, "info": Logger.INFO}
+
+
+class AdminServer(object):
+    """
+    Line based JSON control socket (UNIX domain) of a running TftpServer.
+
+    Every request is one JSON object with a "cmd" key, every reply is one
+    JSON object: {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+    """
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.sock = None
+        self.inode = None
+
+    def start(self, takeover=False):
+        """Bind the socket; one a live server answers on is only taken over by the process replacing it."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path) and not takeover:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                pass  # stale socket of a previous run
+            else:
+                raise OSError(errno.EADDRINUSE, "another server is answering on it")
+            finally:
+                probe.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(None)  # accept() waits as long as it takes
+        mask = os.umask(0o177)  # created 0600, never open to others
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(mask)
+        self.inode = os.stat(self.path).st_ino
+        self.sock.listen(8)
+        log.info("admin socket is", self.path)
+        gevent.spawn(self.serve)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                if os.stat(self.path).st_ino == self.inode:  # not replaced by a new process
+                    os.unlink(self.path)
+            except OSError:
+                pass
+
+    def serve(self):
+        while self.sock:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError as e:
+                if self.sock:
+                    log.error("admin: accept failed:", e)
+                    gevent.sleep(1)
+                continue
+            gevent.spawn(self.handle, conn)
+
+    def handle(self, conn):
+        conn.settimeout(None)
+        f = conn.makefile("rwb")
+        try:
+            for line in f:
+                try:
+                    req = json.loads(line.decode())
+                    resp = {"ok": True, "result": self.dispatch(req)}
+                except Exception as e:
+                    log.debug("admin: error:", e)
+                    resp = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+                f.write((json.dumps(resp) + "\n").encode())
+                f.flush()
+        except OSError:
+            pass
+        finally:
+            f.close()
+            conn.close()
+
+    def dispatch(self, req):
+        func = getattr(self, "cmd_" + str(req.get("cmd")), None)
+        if func is None:
+            raise ValueError("unknown command %r" % req.get("cmd"))
+        args = dict(req)
+        args.pop("cmd")
+        return func(**args)
+
+    def cmd_sessions(self):
+        now = time.time()
+        ret = []
+        for s in self.server.sessions():
+            elapsed = now - s.start_time
+            ret.append({
+                "peer": "%s:%d" % s.peer, "worker": s.index,
+                "direction": "read" if s.is_read() else "write",
+                "file": s.req.filename if s.req else None, "path": s.filename,
+                "size": s.size, "transferred": s.transferred,
+                "blksize": s.req.block_size if s.req else None,
+                "req_blksize": s.req.requested_block_size if s.req else None,
+                "elapsed": elapsed, "speed": s.transferred / elapsed if elapsed > 0 else 0,
+                "retransmits": s.retransmits, "tab": s.tab,
+            })
+        return ret
+
+    def cmd_kill(self, peer):
+        ip, port = peer.rsplit(":", 1)
+        s = self.server.peers.get((ip, int(port)))
+        if not hasattr(s, "kill"):
+            raise KeyError("no active session of %s" % peer)
+        s.kill()
+        return peer
+
+    def cmd_stats(self):
+        ret = self.server.stats.dict()
+        ret.update({
+            "port": self.server.port,
+            "workers": self.server.worker_number,
+            "rate_limit": self.server.rate_limit,
+            "active": len(self.server.sessions()),
+            "queued": self.server.queue.qsize(),
+            "queue_depth": self.server.queue.maxsize,
+            "source_rate": self.server.limiter.rate,
+            "sources": len(self.server.limiter.buckets),
+            "log_level": log.level,
+            "history_pending": len(self.server.history.pending) if self.server.history else None,
+            "warmup": self.server.preloader.progress(),
+            "tabs": self.tabs(),
+        })
+        return ret
+
+    def tabs(self):
+        active = {}
+        for s in self.server.sessions():
+            active[s.tab] = active.get(s.tab, 0) + 1
+        ret = []
+        for tab in range(len(cfg.tabs)):
+            listener = self.server.listeners.get(tab)
+            ret.append({"tab": tab, "name": cfg.get_tab_name(tab), "path": cfg.get_tab_path(tab),
+                        "listen": "%s:%d" % (listener.host, listener.port) if listener else None,
+                        "active": active.get(tab, 0),
+                        "counters": dict(self.server.tab_stats[tab].counters) if tab in self.server.tab_stats else {}})
+        return ret
+
+    def cmd_cache(self):
+        now = time.time()
+        neg = self.server.neg_cache
+        mtu = self.server.mtu
+        relay = self.server.relay
+        frames = self.server.compressed.frames
+        netascii = self.server.netascii
+        templates = self.server.templates
+        return {
+            "negative": {"ttl": neg.ttl, "hits": neg.hits,
+                         "entries": [{"tab": k[0], "name": k[1], "expires_in": e[0] - now}
+                                     for k, e in neg.entries.items()]},
+            "files": {"capacity": self.server.files.capacity, "used": self.server.files.used,
+                      "entries": [{"path": p, "size": e[1]} for p, e in self.server.files.entries.items()]},
+            "relay": {"upstream": cfg.upstream, "capacity": relay.capacity, "used": relay.used,
+                      "files": len(relay.entries or ()),
+                      "fetching": [{"file": f.name, "size": f.size, "received": f.received}
+                                   for f in relay.fetches.values()]} if relay else None,
+            "archives": [{"path": p, "members": len(i.members)} for p, i in self.server.archives.indexes.items()],
+            "compressed": {"capacity": frames.capacity, "used": frames.used, "frames": len(frames.entries),
+                           "hits": frames.hits, "misses": frames.misses,
+                           "files": [{"path": p, "size": i.size, "points": len(i.points)}
+                                     for p, i in self.server.compressed.indexes.items()]},
+            "netascii": {"capacity": netascii.texts.capacity, "used": netascii.texts.used,
+                         "texts": len(netascii.texts.entries), "hits": netascii.texts.hits,
+                         "misses": netascii.texts.misses, "indexes": len(netascii.indexes)},
+            "templates": {"capacity": templates.renders.capacity, "used": templates.renders.used,
+                          "renders": len(templates.renders.entries), "hits": templates.renders.hits,
+                          "misses": templates.renders.misses, "rendered": templates.rendered},
+            "dedup": {"store": cfg.dedup_store, "chunk_size": self.server.dedup.chunk_size}
+            if self.server.dedup else None,
+            "mtu": {"frames": cfg.mtu_frames,
+                    "entries": [{"peer": ip, "mtu": e[1], "expires_in": e[0] - now}
+                                for ip, e in mtu.entries.items()]},
+        }
+
+    def cmd_set(self, key, value, tab=None):
+        if key == "workers":
+            self.server.set_workers(int(value))
+        elif key == "rate_limit":
+            self.server.rate_limit = max(0, int(value))
+        elif key == "log_level":
+            log.level = LOG_LEVELS[value] if value in LOG_LEVELS else int(value)
+        elif key == "queue_depth":
+            self.server.queue.maxsize = max(1, int(value))
+        elif key == "source_rate":
+            self.server.limiter.rate = max(0.0, float(value))
+        elif key == "source_burst":
+            self.server.limiter.burst = max(1, int(value))
+        elif key == "neg_cache_ttl":
+            self.server.neg_cache.ttl = float(value)
+            self.server.neg_cache.clear()
+        elif key == "listen":
+            cfg.set_tab_listen("" if value in ("", "off") else value, index=tab)
+            self.server.update_listeners()
+            cfg.save()
+        elif key == "root":
+            if not os.path.isdir(value) and not (os.path.isfile(value) and is_archive(value)):
+                raise ValueError("%s is neither a directory nor an archive" % value)
+            cfg.set_tab_path(value, index=tab)
+            cfg.save()
+        else:
+            raise KeyError("unknown setting %r" % key)
+        return {key: value}
+
+    def cmd_profile(self, action="start", seconds=None, mode="sample"):
+        if action == "stop":
+            return self.server.profiler.stop()
+        return self.server.profiler.start(seconds or cfg.profile_seconds, mode)
+
+    def cmd_dump(self):
+        return self.server.dump_capture()
+
+    def cmd_drain(self, seconds=None):
+        g.spawn(self.server.shutdown, 0, seconds)
+        return True
+
+    def cmd_restart(self):
+        g.spawn(self.server.restart)
+        return True
+
+    def cmd_warmup(self):
+        gevent.spawn(self.server.warmup)
+        return True
+
+    def cmd_acl(self, ip, file, direction="read", tab=None):
+        acl = self.server.acl.get(tab)
+        rule = acl.lookup(ip, DIRECTIONS[direction], file)
+        return {"allowed": rule is None or rule.allow, "rule": rule.text if rule else None, "rules": acl.size}
+
+    def cmd_reload(self):
+        self.server.reload()
+        return {"generation": cfg.generation, "listeners": {tab: "%s:%d" % (listener.host, listener.port)
+                                                            for tab, listener in self.server.listeners.items()}}
+
+    def cmd_resolve(self, file, tab=None):
+        ruleset = cfg.get_tab_ruleset(tab)
+        return {"path": cfg.get_real_path(file, tab), "mapped": ruleset is not None and ruleset.resolve(file) is not None,
+                "rules": ruleset.size if ruleset else 0, "cached": len(ruleset.cache) if ruleset else 0}
+
+    def cmd_gc(self, grace=3600):
+        dedup = self.server.dedup
+        if not dedup:
+            raise ValueError("no dedup store configured")
+        removed, freed = gevent.get_hub().threadpool.apply(dedup.gc, (float(grace),))
+        return {"removed": removed, "freed": freed}
+
+
+def request(path, req):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    f = s.makefile("rwb")
+    f.write((json.dumps(req) + "\n").encode())
+    f.flush()
+    resp = json.loads(f.readline().decode())
+    s.close()
+    return resp
+
+
+def print_sessions(sessions):
+    print("%-21s %-5s %10s %10s %4s %10s %5s  %s"
+          % ("Peer", "Dir", "Bytes", "Size", "%", "Speed", "Retx", "File"))
+    for s in sessions:
+        pct = "%d" % (s["transferred"] * 100 / s["size"]) if s["size"] else "-"
+        print("%-21s %-5s %10s %10s %4s %8s/s %5d  %s"
+              % (s["peer"], s["direction"], bytes2human(s["transferred"]), bytes2human(s["size"]),
+                 pct, bytes2human(s["speed"]), s["retransmits"], s["file"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="holytftp-admin", description="Inspect and tune a running HolyTFTP.")
+    parser.add_argument("-s", "--socket", default=cfg.admin_socket, help="admin socket path")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.add_parser("sessions", help="list active sessions")
+    p = sub.add_parser("kill", help="kill a session")
+    p.add_argument("peer", help="ip:port of the client")
+    sub.add_parser("stats", help="counters, timers and limits")
+    sub.add_parser("cache", help="cache contents")
+    p = sub.add_parser("set", help="change a setting: workers, rate_limit, queue_depth, source_rate,"
+                                   " source_burst, log_level, neg_cache_ttl, root, listen")
+    p.add_argument("key")
+    p.add_argument("value")
+    p.add_argument("--tab", type=int, help="tab index (for root and listen)")
+    p = sub.add_parser("profile", help="start/stop the profiler")
+    p.add_argument("action", choices=["start", "stop"])
+    p.add_argument("-t", "--seconds", type=float)
+    p.add_argument("-m", "--mode", choices=["sample", "cprofile"], default="sample")
+    sub.add_parser("dump", help="dump the server packet ring to a pcap file")
+    sub.add_parser("warmup", help="warm up the file cache")
+    p = sub.add_parser("acl", help="which acl rule decides a request")
+    p.add_argument("ip")
+    p.add_argument("file")
+    p.add_argument("-d", "--direction", choices=["read", "write"], default="read")
+    p.add_argument("--tab", type=int, help="tab index (default: the active one)")
+    sub.add_parser("reload", help="read the config file again (mapping rules, acls, ...)")
+    p = sub.add_parser("resolve", help="the path a file name is served from")
+    p.add_argument("file")
+    p.add_argument("--tab", type=int, help="tab index (default: the active one)")
+    p = sub.add_parser("gc", help="remove the dedup chunks no upload refers to")
+    p.add_argument("-g", "--grace", type=float, help="keep chunks younger than this (seconds, default 3600, at least %d)" % MIN_GRACE)
+    p = sub.add_parser("drain", help="finish active sessions, then exit")
+    p.add_argument("-t", "--seconds", type=float, help="deadline")
+    sub.add_parser("restart", help="hand the port over to a new process, then drain")
+    args = vars(parser.parse_args(argv))
+    path = args.pop("socket")
+    if not args.get("cmd"):
+        parser.print_help()
+        return 1
+    args = {k: v for k, v in args.items() if v is not None}
+
+    try:
+        resp = request(path, args)
+    except OSError as e:
+        print("cannot connect to %s: %s" % (path, e), file=sys.stderr)
+        return 1
+    if not resp.get("ok"):
+        print(resp.get("error"), file=sys.stderr)
+        return 1
+    if args["cmd"] == "sessions":
+        print_sessions(resp["result"])
+    else:
+        print(json.dumps(resp["result"], indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import os
+import time
+from collections import OrderedDict
+from ..config import cfg
+
+
+def nearest_dir(path):
+    """The closest existing directory holding (or that would hold) path."""
+    d = os.path.dirname(path)
+    while d and not os.path.isdir(d):
+        parent = os.path.dirname(d)
+        if parent == d:
+            break
+        d = parent
+    return d
+
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class NegativeCache(object):
+    """
+    Short-lived memory of file names that were not found.
+
+    An entry dies when its TTL expires, when the directory that would hold
+    the file changes (its mtime moves when an entry is added), or when the
+    config changes the name -> path mapping (cfg.generation).
+    """
+
+    def __init__(self, ttl=5, capacity=0x10000):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries = OrderedDict()  # [(tab, name)] = (expires, dir, mtime)
+        self.generation = cfg.generation
+        self.hits = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.generation = cfg.generation
+
+    def add(self, name, path, tab=None):
+        if self.ttl <= 0:
+            return
+        if self.generation != cfg.generation:
+            self.clear()
+        d = nearest_dir(path) if path else None
+        key = (cfg.active_tab if tab is None else tab, name)
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, d, dir_mtime(d) if d else None)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def hit(self, name, tab=None):
+        if not self.entries:
+            return False
+        if self.generation != cfg.generation:
+            self.clear()
+            return False
+        key = (cfg.active_tab if tab is None else tab, name)
+        e = self.entries.get(key)
+        if e is None:
+            return False
+        expires, d, mtime = e
+        if expires < time.time() or (d and dir_mtime(d) != mtime):
+            del self.entries[key]
+            return False
+        self.hits += 1
+        return True
@@ -0,0 +1,81 @@
+import os
+import time
+import socket
+from struct import pack
+import gevent
+from ..log import log
+
+LINKTYPE_RAW = 101  # raw IPv4, no link-layer header
+HEADER_BYTES = 4  # opcode + block/error code, the payload is never kept
+
+
+def ip_checksum(header):
+    s = 0
+    for i in range(0, len(header), 2):
+        s += (header[i] << 8) + header[i + 1]
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+
+class PacketRing(object):
+    """
+    Fixed-size ring of recent packet headers: time, direction, peer,
+    local port, opcode, block and length. Adding a packet is one tuple
+    store; to_pcap() turns the ring into a pcap file of truncated
+    IPv4/UDP packets, so the failure can be inspected after the fact.
+    """
+
+    IN = 0
+    OUT = 1
+
+    def __init__(self, size=64):
+        self.size = size
+        self.items = [None] * size
+        self.pos = 0
+
+    def add(self, out, peer, local_port, data):
+        opcode = (data[0] << 8 | data[1]) if len(data) >= 2 else 0
+        block = (data[2] << 8 | data[3]) if len(data) >= 4 else 0
+        self.items[self.pos] = (time.time(), out, peer, local_port, opcode, block, len(data))
+        self.pos = (self.pos + 1) % self.size
+
+    def snapshot(self):
+        return [i for i in self.items[self.pos:] + self.items[:self.pos] if i is not None]
+
+    @staticmethod
+    def to_pcap(items):
+        out = [pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 0xffff, LINKTYPE_RAW)]
+        for ts, is_out, peer, local_port, opcode, block, length in items:
+            payload = pack("!HH", opcode, block)[:length]
+            peer_ip = socket.inet_aton(peer[0])
+            local_ip = socket.inet_aton("0.0.0.0")
+            src, dst = (local_ip, peer_ip) if is_out else (peer_ip, local_ip)
+            sport, dport = (local_port, peer[1]) if is_out else (peer[1], local_port)
+            ip = pack("!BBHHHBBH4s4s", 0x45, 0, 28 + length, 0, 0x4000, 64, socket.IPPROTO_UDP, 0, src, dst)
+            ip = ip[:10] + pack("!H", ip_checksum(ip)) + ip[12:]
+            udp = pack("!HHHH", sport, dport, 8 + length, 0)
+            frame = ip + udp + payload
+            sec = int(ts)
+            out.append(pack("<IIII", sec, int((ts - sec) * 1000000), len(frame), 28 + length))
+            out.append(frame)
+        return b"".join(out)
+
+    def dump(self, filename):
+        """Write the ring to a pcap file from the thread pool."""
+        items = self.snapshot()
+        if not items:
+            return None
+
+        def write():
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "wb") as f:
+                f.write(self.to_pcap(items))
+
+        try:
+            gevent.get_hub().threadpool.apply(write)
+        except OSError as e:
+            log.error("failed to dump packets to %s:" % filename, e)
+            return None
+        log.warn("%d packets dumped to %s" % (len(items), filename))
+        return filename
@@ -0,0 +1,388 @@
+import os
+import sys
+import time
+import socket
+import hashlib
+import argparse
+from struct import pack, unpack
+from gevent.pool import Pool
+from .packet import *
+from ..utils import bytes2human
+
+CHUNK = 0x10000
+
+
+class TransferError(Exception):
+    def __init__(self, msg, errcode=None):
+        super().__init__(msg)
+        self.errcode = errcode  # TftpErrCode sent by the server, if any
+
+
+def parse_checksum(value):
+    """"sha256:hex" -> (algorithm, hex); a bare hex digest is taken as sha256."""
+    if not value:
+        return None
+    algo, _, digest = value.rpartition(":")
+    algo = algo or "sha256"
+    if algo not in hashlib.algorithms_available:
+        raise ValueError("unknown checksum algorithm %r" % algo)
+    return algo, digest.lower()
+
+
+def read_manifest(filename):
+    """
+    One transfer per line: REMOTE [LOCAL] [ALGO:DIGEST]
+    Blank lines and lines starting with '#' are skipped.
+    """
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            remote, local, checksum = fields[0], None, None
+            for field in fields[1:]:
+                if ":" in field and field.split(":", 1)[0] in hashlib.algorithms_available:
+                    checksum = field
+                else:
+                    local = field
+            entries.append((remote, local, checksum))
+    return entries
+
+
+class TftpClient(object):
+    """
+    TFTP client speaking to one server. get() and put() stream the file
+    straight to/from disk and may be run from many greenlets at once:
+    each transfer has its own socket.
+
+    blksize, windowsize (RFC 7440) and tsize are requested; whatever the
+    server does not acknowledge falls back to the RFC 1350 defaults.
+    """
+
+    def __init__(self, host, port=69, blksize=1468, windowsize=1, tsize=True, timeout=TFTP_TIMEOUT, retries=5,
+                 source=None):
+        self.address = (socket.gethostbyname(host), port)
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.tsize = tsize
+        self.timeout = timeout
+        self.retries = retries
+        self.source = source  # local address to send from
+
+    def socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        if self.source:
+            sock.bind((self.source, 0))
+        return sock
+
+    def request(self, code, remote, size=None):
+        raw = pack("!H", code) + (remote + "\0octet\0").encode()
+        if self.blksize and self.blksize != DEFAULT_BLOCK_SIZE:
+            raw += b"blksize\0%d\0" % self.blksize
+        if self.windowsize > 1:
+            raw += b"windowsize\0%d\0" % self.windowsize
+        if self.tsize:
+            raw += b"tsize\0%d\0" % (size or 0)
+        return raw
+
+    def receive(self, sock, peer):
+        """Next packet of the session peer: (opcode, block, raw). Learns the peer port on the first one."""
+        while True:
+            raw, address = sock.recvfrom(0x10000)
+            if len(raw) < 4:
+                continue
+            if peer[1] is None and address[0] == peer[0]:
+                peer[1] = address[1]
+            elif tuple(peer) != address:
+                sock.sendto(bytes(TftpErrorPacket(TftpErrCode.UnknownTID)), address)
+                continue
+            code, block = unpack("!HH", raw[:4])
+            if code == TftpOpCode.Error:
+                err = TftpErrorPacket.from_bytes(raw)
+                raise TransferError("%s: %s" % (TftpErrCode.str(err.errcode), err.msg), err.errcode)
+            return code, block, raw
+
+    def negotiate(self, raw):
+        """Options of an OACK, with the defaults of what was not acknowledged."""
+        options = {k.lower(): v for k, v in TftpAckPacket.from_bytes(raw, None).options.items()}
+        blksize = int(options.get("blksize", DEFAULT_BLOCK_SIZE))
+        windowsize = int(options.get("windowsize", 1))
+        tsize = int(options["tsize"]) if options.get("tsize", "").isdigit() else None
+        return blksize, windowsize, tsize
+
+    def download(self, remote, write, started=None):
+        """
+        Receive `remote`, passing every in-order block to write(data).
+        started(tsize) is called once the options are settled, before the
+        first block (tsize is None if the server did not tell).
+        Returns (bytes, blksize, windowsize), raises TransferError.
+        """
+        sock = self.socket()
+        peer = [self.address[0], None]
+        try:
+            req = self.request(TftpOpCode.RRQ, remote)
+            sock.sendto(req, self.address)
+            blksize, windowsize, tsize = DEFAULT_BLOCK_SIZE, 1, None
+            last = 0  # blocks received in order
+            in_window = 0
+            retries = 0
+            received = 0
+            while True:
+                try:
+                    code, block, raw = self.receive(sock, peer)
+                except socket.timeout:
+                    retries += 1
+                    if retries > self.retries:
+                        raise TransferError("Timeout")
+                    if peer[1] is None:
+                        sock.sendto(req, self.address)
+                    else:
+                        sock.sendto(pack("!HH", TftpOpCode.ACK, last & 0xffff), tuple(peer))
+                    in_window = 0
+                    continue
+                retries = 0
+                if code == TftpOpCode.OACK:
+                    if last == 0:
+                        blksize, windowsize, tsize = self.negotiate(raw)
+                        sock.sendto(pack("!HH", TftpOpCode.ACK, 0), tuple(peer))
+                    continue
+                if code != TftpOpCode.Data:
+                    continue
+                if block != (last + 1) & 0xffff:
+                    if block != last & 0xffff:  # out of order: ack what we have, window restarts there
+                        sock.sendto(pack("!HH", TftpOpCode.ACK, last & 0xffff), tuple(peer))
+                        in_window = 0
+                    continue
+                if last == 0 and started:
+                    started(tsize)
+                data = raw[4:]
+                last += 1
+                in_window += 1
+                write(data)
+                received += len(data)
+                final = len(data) < blksize
+                if final or in_window >= windowsize:
+                    sock.sendto(pack("!HH", TftpOpCode.ACK, block), tuple(peer))
+                    in_window = 0
+                if final:
+                    break
+            if tsize and tsize != received:
+                raise TransferError("size mismatch: %d of %d bytes" % (received, tsize))
+            return received, blksize, windowsize
+        finally:
+            sock.close()
+
+    def probe_size(self, remote):
+        """Size of `remote` from the tsize of the OACK; the transfer is aborted right after."""
+        sock = self.socket()
+        peer = [self.address[0], None]
+        req = pack("!H", TftpOpCode.RRQ) + (remote + "\0octet\0tsize\0000\0").encode()
+        try:
+            for _ in range(self.retries + 1):
+                sock.sendto(req, self.address)
+                try:
+                    code, block, raw = self.receive(sock, peer)
+                except socket.timeout:
+                    continue
+                sock.sendto(bytes(TftpErrorPacket(TftpErrCode.Undefined, "Size probe")), tuple(peer))
+                return self.negotiate(raw)[2] if code == TftpOpCode.OACK else None
+            raise TransferError("Timeout")
+        finally:
+            sock.close()
+
+    def get(self, remote, local, checksum=None):
+        """Download `remote` to `local` (written to local.part, renamed when complete)."""
+        result = {"file": remote, "local": local, "direction": "get", "bytes": 0}
+        start = time.time()
+        hasher = hashlib.new(checksum[0]) if checksum else None
+        part = local + ".part"
+        try:
+            d = os.path.dirname(local)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            with open(part, "wb", buffering=CHUNK) as f:
+                if hasher:
+                    def write(data):
+                        hasher.update(data)
+                        f.write(data)
+                else:
+                    write = f.write
+                result["bytes"], blksize, windowsize = self.download(remote, write)
+            self.verify(result, hasher, checksum)
+            os.replace(part, local)
+            result.update(ok=True, blksize=blksize, windowsize=windowsize)
+        except (TransferError, OSError, ValueError) as e:
+            result.update(ok=False, error=str(e))
+            if os.path.exists(part):
+                os.unlink(part)
+        return self.finish(result, start)
+
+    def put(self, local, remote, checksum=None):
+        """Upload `local` as `remote`, reading the blocks straight from the file."""
+        result = {"file": remote, "local": local, "direction": "put", "bytes": 0}
+        start = time.time()
+        hasher = hashlib.new(checksum[0]) if checksum else None
+        sock = self.socket()
+        peer = [self.address[0], None]
+        fd = None
+        try:
+            fd = os.open(local, os.O_RDONLY)
+            size = os.fstat(fd).st_size
+            req = self.request(TftpOpCode.WRQ, remote, size)
+            sock.sendto(req, self.address)
+            blksize, windowsize = DEFAULT_BLOCK_SIZE, 1
+            retries = 0
+            while True:  # wait for the OACK or ACK 0
+                try:
+                    code, block, raw = self.receive(sock, peer)
+                except socket.timeout:
+                    retries += 1
+                    if retries > self.retries:
+                        raise TransferError("Timeout")
+                    sock.sendto(req, self.address)
+                    continue
+                if code == TftpOpCode.OACK:
+                    blksize, windowsize, _ = self.negotiate(raw)
+                    break
+                if code == TftpOpCode.ACK and block == 0:
+                    break
+
+            total = size // blksize + 1  # the last block is shorter, maybe empty
+            acked = 0
+            hashed = 0
+            retries = 0
+            while acked < total:
+                for n in range(acked + 1, min(acked + windowsize, total) + 1):
+                    data = os.pread(fd, blksize, (n - 1) * blksize)
+                    if hasher and n > hashed:
+                        hasher.update(data)
+                        hashed = n
+                    sock.sendto(pack("!HH", TftpOpCode.Data, n & 0xffff) + data, tuple(peer))
+                while True:
+                    try:
+                        code, block, raw = self.receive(sock, peer)
+                    except socket.timeout:
+                        retries += 1
+                        if retries > self.retries:
+                            raise TransferError("Timeout")
+                        break  # resend the window
+                    if code != TftpOpCode.ACK:
+                        continue
+                    ahead = (block - acked) & 0xffff
+                    if 0 < ahead <= windowsize:
+                        acked += ahead
+                        retries = 0
+                        break
+            result["bytes"] = size
+            self.verify(result, hasher, checksum)
+            result.update(ok=True, blksize=blksize, windowsize=windowsize)
+        except (TransferError, OSError, ValueError) as e:
+            result.update(ok=False, error=str(e))
+        finally:
+            if fd is not None:
+                os.close(fd)
+            sock.close()
+        return self.finish(result, start)
+
+    @staticmethod
+    def verify(result, hasher, checksum):
+        if not hasher:
+            return
+        result["checksum"] = "%s:%s" % (checksum[0], hasher.hexdigest())
+        if hasher.hexdigest() != checksum[1]:
+            raise TransferError("checksum mismatch: %s" % result["checksum"])
+
+    @staticmethod
+    def finish(result, start):
+        result["seconds"] = time.time() - start
+        result["speed"] = result["bytes"] / result["seconds"] if result["seconds"] > 0 else 0
+        return result
+
+
+def print_result(r):
+    if r["ok"]:
+        print("OK   %-30s %10s %7.2fs %10s/s  blksize=%d windowsize=%d"
+              % (r["file"], bytes2human(r["bytes"]), r["seconds"], bytes2human(r["speed"]),
+                 r["blksize"], r["windowsize"]))
+    else:
+        print("FAIL %-30s %s" % (r["file"], r["error"]))
+    sys.stdout.flush()
+
+
+def run(client, jobs, func, entries):
+    pool = Pool(jobs)
+    start = time.time()
+    results = []
+
+    def one(entry):
+        r = func(*entry)
+        print_result(r)
+        results.append(r)
+
+    for entry in entries:
+        pool.spawn(one, entry)
+    pool.join()
+    elapsed = time.time() - start
+    total = sum(r["bytes"] for r in results if r["ok"])
+    failed = sum(1 for r in results if not r["ok"])
+    print("%d files, %d failed, %s in %.2fs, %s/s"
+          % (len(results), failed, bytes2human(total), elapsed, bytes2human(total / elapsed if elapsed > 0 else 0)))
+    return 1 if failed else 0
+
+
+def make_parser(prog, description):
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument("host", help="server address")
+    parser.add_argument("files", nargs="*", help="files to transfer")
+    parser.add_argument("-p", "--port", type=int, default=69)
+    parser.add_argument("-m", "--manifest", help="file of 'REMOTE [LOCAL] [ALGO:DIGEST]' lines")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="parallel transfers")
+    parser.add_argument("-b", "--blksize", type=int, default=1468)
+    parser.add_argument("-w", "--windowsize", type=int, default=1)
+    parser.add_argument("-t", "--timeout", type=int, default=TFTP_TIMEOUT)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--no-tsize", action="store_true", help="do not send the tsize option")
+    return parser
+
+
+def client_from_args(args):
+    return TftpClient(args.host, args.port, args.blksize, args.windowsize, not args.no_tsize,
+                      args.timeout, args.retries)
+
+
+def main_get(argv=None):
+    parser = make_parser("holytftp-get", "Download files from a TFTP server.")
+    parser.add_argument("-d", "--dir", default=".", help="download directory")
+    args = parser.parse_intermixed_args(argv)  # options may come between host and files
+    entries = [(f, None, None) for f in args.files]
+    if args.manifest:
+        entries += read_manifest(args.manifest)
+    if not entries:
+        parser.error("no files given")
+    client = client_from_args(args)
+    entries = [(remote, os.path.join(args.dir, local or os.path.basename(remote)), parse_checksum(checksum))
+               for remote, local, checksum in entries]
+    return run(client, args.jobs, client.get, entries)
+
+
+def main_put(argv=None):
+    parser = make_parser("holytftp-put", "Upload files to a TFTP server.")
+    parser.add_argument("-r", "--remote-dir", default="", help="prefix of the remote names")
+    args = parser.parse_intermixed_args(argv)
+    entries = [(os.path.basename(f), f, None) for f in args.files]
+    if args.manifest:
+        entries += read_manifest(args.manifest)
+    if not entries:
+        parser.error("no files given")
+    client = client_from_args(args)
+    prefix = args.remote_dir.rstrip("/") + "/" if args.remote_dir else ""
+    entries = [(local or remote, prefix + remote, parse_checksum(checksum))
+               for remote, local, checksum in entries]
+    return run(client, args.jobs, client.put, entries)
+
+
+if __name__ == "__main__":
+    # python -m src.tftp.client get|put ...
+    sys.exit(main_put(sys.argv[2:]) if sys.argv[1:2] == ["put"] else main_get(sys.argv[2:]))
@@ -0,0 +1,238 @@
+import os
+import re
+import json
+import time
+import fcntl
+import hashlib
+from collections import Counter
+import gevent
+from ..log import log
+from .protocol import TFTP_RETRY
+
+MAGIC = b"HOLYTFTP-MANIFEST 1\n"
+MIN_GRACE = 255 * (TFTP_RETRY + 1)  # longest a session waits for its client (timeout option 255)
+DIGEST = re.compile(r"[0-9a-f]{64}")  # a chunk name: never a path out of the store
+
+
+class ManifestSource(object):
+    """Reads an uploaded file back from the chunks its manifest lists."""
+
+    def __init__(self, store, path, manifest):
+        self.store = store
+        self.path = path
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.chunks = manifest["chunks"]
+        self.current = None  # (index, file) of the chunk read last
+
+    def chunk(self, index):
+        if self.current is None or self.current[0] != index:
+            self.close()
+            self.current = (index, open(self.store.chunk_path(self.chunks[index]), "rb"))
+        return self.current[1]
+
+    def read(self, offset, length):
+        out = []
+        end = min(offset + length, self.size)
+        while offset < end:
+            index, pos = divmod(offset, self.chunk_size)
+            data = os.pread(self.chunk(index).fileno(), min(end - offset, self.chunk_size - pos), pos)
+            if not data:
+                raise OSError(5, "Chunk %s is truncated" % self.chunks[index])
+            out.append(data)
+            offset += len(data)
+        return b"".join(out)
+
+    def close(self):
+        if self.current:
+            self.current[1].close()
+            self.current = None
+
+
+class DedupStore(object):
+    """
+    Content-addressed store of upload chunks.
+
+    Uploads are cut into fixed-size chunks named by their SHA-256
+    (chunks/ab/abcdef...); a chunk already in the store is not written
+    again. The uploaded file becomes a small manifest (MAGIC + JSON with
+    size, sha256 and the chunk list) that the server reads back
+    transparently. Paths holding manifests are listed in `refs`, which
+    gc() walks to find the chunks still in use.
+
+    put() and commit() hold `lock` shared, gc() holds it exclusive while
+    it removes a chunk or rewrites refs, so a chunk found in the store
+    stays there until its manifest is listed. The chunks of the uploads in progress here
+    are counted in `pending` and kept whatever their age.
+    """
+
+    def __init__(self, root, chunk_size=64 << 10, stats=None):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.refs = os.path.join(root, "refs")
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        self.lock = open(os.path.join(root, "lock"), "a")
+        self.pending = Counter()  # [digest] = uploads in progress using it
+
+    hasher = staticmethod(hashlib.sha256)
+
+    def incr(self, name, n=1):
+        if self.stats:
+            self.stats.incr(name, n)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, "chunks", digest[:2], digest)
+
+    def share(self):
+        """Takes `lock` shared. While a gc holds it, the hub sleeps rather than blocks in flock."""
+        while True:
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                gevent.sleep(0.01)
+
+    def put(self, data):
+        """Store a chunk of an upload in progress, until commit() or release() of its list."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        self.share()
+        try:
+            self.pending[digest] += 1
+            if os.path.exists(path):
+                os.utime(path)  # in use again, for the other processes' gc
+                self.incr("dedup.chunks_reused")
+                self.incr("dedup.bytes_saved", len(data))
+                return digest
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        finally:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.incr("dedup.chunks_new")
+        return digest
+
+    def release(self, chunks):
+        """The upload that put chunks is over: they are the gc's again unless a manifest lists them."""
+        self.pending.subtract(chunks)
+        for digest in chunks:
+            if self.pending[digest] <= 0:
+                del self.pending[digest]
+
+    def commit(self, path, size, digest, chunks):
+        manifest = {"size": size, "sha256": digest, "chunk_size": self.chunk_size, "chunks": chunks}
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        self.share()
+        try:
+            with open(tmp, "wb") as f:
+                f.write(MAGIC + json.dumps(manifest).encode())
+            os.replace(tmp, path)  # readers see the old file or the whole manifest
+            with open(self.refs, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(os.path.abspath(path) + "\n")
+        finally:
+            self.release(chunks)
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def load(path):
+        """The manifest at path, or None if it is an ordinary file (or no valid manifest)."""
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return None
+                manifest = json.loads(f.read().decode())
+            if not (isinstance(manifest["size"], int) and isinstance(manifest["chunk_size"], int)
+                    and manifest["chunk_size"] > 0 and isinstance(manifest["chunks"], list)
+                    and all(isinstance(c, str) and DIGEST.fullmatch(c) for c in manifest["chunks"])):
+                raise ValueError("bad manifest")
+            return manifest
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, OSError):
+                log.warn("dedup: %s is no valid manifest:" % path, e)
+            return None
+
+    def open(self, path):
+        manifest = self.load(path)
+        return ManifestSource(self, path, manifest) if manifest else None
+
+    def committed(self, seen, live, used):
+        """Adds the manifests listed in refs after offset seen; returns the new end."""
+        try:
+            with open(self.refs) as f:
+                f.seek(seen)
+                for line in f:
+                    path = line.rstrip("\n")
+                    manifest = self.load(path) if path else None
+                    if manifest:
+                        live.add(path)
+                        used.update(manifest["chunks"])
+                return f.tell()
+        except FileNotFoundError:
+            return seen
+
+    def gc(self, grace=3600):
+        """
+        Remove the chunks no manifest refers to. Chunks younger than
+        `grace` seconds are kept: they may belong to the uploads of
+        another process (a restart hands the port over while the old
+        one finishes its sessions), so grace may not be below MIN_GRACE.
+        Returns (chunks removed, bytes freed).
+        """
+        if grace < MIN_GRACE:
+            raise ValueError("grace must be at least %d seconds, the session timeout" % MIN_GRACE)
+        used = set()
+        live = set()
+        try:
+            with open(self.refs) as f:
+                paths = set(line.rstrip("\n") for line in f if line.strip())
+                seen = f.tell()
+        except FileNotFoundError:
+            paths, seen = set(), 0
+        for path in paths:
+            manifest = self.load(path)
+            if manifest:
+                live.add(path)
+                used.update(manifest["chunks"])
+
+        removed = freed = 0
+        deadline = time.time() - grace
+        with open(os.path.join(self.root, "lock"), "a") as lock:
+            for root, _, files in os.walk(os.path.join(self.root, "chunks")):
+                for name in files:
+                    if name in used:
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        if os.stat(path).st_mtime > deadline:
+                            continue
+                        fcntl.flock(lock, fcntl.LOCK_EX)  # short: uploads wait for it
+                        try:
+                            seen = self.committed(seen, live, used)
+                            st = os.stat(path)
+                            if name in used or name in self.pending or st.st_mtime > deadline:
+                                continue
+                            os.unlink(path)
+                        finally:
+                            fcntl.flock(lock, fcntl.LOCK_UN)
+                    except OSError:
+                        continue
+                    removed += 1
+                    freed += st.st_size
+
+            # rewrite refs with the live paths and whatever was committed meanwhile;
+            # no commit() has refs open while the lock is held exclusive
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.committed(seen, live, used)
+                tmp = self.refs + ".tmp"
+                with open(tmp, "w") as out:
+                    out.writelines(p + "\n" for p in sorted(live))
+                os.replace(tmp, self.refs)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        log.info("dedup gc: %d manifests, %d chunks removed, %d bytes freed" % (len(live), removed, freed))
+        return removed, freed
@@ -0,0 +1,188 @@
+import sys
+import time
+import sqlite3
+import argparse
+from collections import deque
+from datetime import datetime
+import gevent
+from ..log import log
+from ..utils import bytes2human
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    start REAL NOT NULL,
+    duration REAL NOT NULL,
+    client TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    file TEXT,
+    path TEXT,
+    size INTEGER,
+    bytes INTEGER,
+    blksize INTEGER,
+    req_blksize INTEGER,
+    retransmits INTEGER,
+    ok INTEGER NOT NULL,
+    result TEXT,
+    detail TEXT,
+    results TEXT
+);
+CREATE INDEX IF NOT EXISTS transfers_start ON transfers(start);
+CREATE INDEX IF NOT EXISTS transfers_client ON transfers(client, start);
+CREATE INDEX IF NOT EXISTS transfers_file ON transfers(file, start);
+CREATE TABLE IF NOT EXISTS file_access (
+    path TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_access_count ON file_access(count);
+"""
+
+COLUMNS = ["start", "duration", "client", "port", "direction", "file", "path",
+           "size", "bytes", "blksize", "req_blksize", "retransmits", "ok", "result", "detail", "results"]
+MIGRATIONS = [  # columns added after the first release: (name, type)
+    ("req_blksize", "INTEGER"),
+    ("results", "TEXT"),  # JSON of the upload stages (digests, compressed size)
+]
+
+
+class TransferHistory(object):
+    """
+    Append-only record of finished sessions in a SQLite database.
+
+    record() only queues the row; run() writes the queued rows in batches
+    from the hub's thread pool, so the transfer loop never waits on disk.
+    Per-file read counts are kept the same way by access().
+    """
+
+    FLUSH_INTERVAL = 1
+    BATCH_SIZE = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = deque()
+        self.accesses = {}  # [path] = [count, last access]
+        self.db = None
+
+    def open(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.filename, check_same_thread=False)
+            self.db.executescript(SCHEMA)
+            self.migrate()
+        return self.db
+
+    def migrate(self):
+        have = set(r[1] for r in self.db.execute("PRAGMA table_info(transfers)"))
+        with self.db:
+            for name, kind in MIGRATIONS:
+                if name not in have:
+                    self.db.execute("ALTER TABLE transfers ADD COLUMN %s %s" % (name, kind))
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def record(self, **fields):
+        self.pending.append(tuple(fields.get(c) for c in COLUMNS))
+
+    def access(self, path, when=None):
+        e = self.accesses.get(path)
+        if e is None:
+            self.accesses[path] = e = [0, 0]
+        e[0] += 1
+        e[1] = when or time.time()
+
+    def take(self):
+        rows = list(self.pending)
+        self.pending.clear()
+        accesses, self.accesses = self.accesses, {}
+        return rows, accesses
+
+    def write(self, rows, accesses):
+        db = self.open()
+        with db:
+            for i in range(0, len(rows), self.BATCH_SIZE):
+                db.executemany("INSERT INTO transfers (%s) VALUES (%s)"
+                               % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                               rows[i:i + self.BATCH_SIZE])
+            if accesses:
+                db.executemany("INSERT OR IGNORE INTO file_access VALUES (?, 0, 0)",
+                               [(p,) for p in accesses])
+                db.executemany("UPDATE file_access SET count = count + ?,"
+                               " last_access = MAX(last_access, ?) WHERE path = ?",
+                               [(c, t, p) for p, (c, t) in accesses.items()])
+
+    def flush(self):
+        if self.pending or self.accesses:
+            self.write(*self.take())
+
+    def run(self):
+        log.info("history is recorded to", self.filename)
+        pool = gevent.get_hub().threadpool
+        while True:
+            gevent.sleep(self.FLUSH_INTERVAL)
+            if not self.pending and not self.accesses:
+                continue
+            try:
+                pool.apply(self.write, self.take())
+            except sqlite3.Error as e:
+                log.error("failed to write history:", e)
+
+    def query(self, sql, args=()):
+        return self.open().execute(sql, args).fetchall()
+
+    def slowest(self, since=0, limit=20):
+        return self.query("SELECT start, duration, client, direction, file, bytes,"
+                          " bytes / duration AS speed, retransmits FROM transfers"
+                          " WHERE start >= ? AND ok AND duration > 0"
+                          " ORDER BY speed LIMIT ?", (since, limit))
+
+    def hottest(self, limit=20):
+        return [r[0] for r in self.query("SELECT path FROM file_access"
+                                         " ORDER BY count DESC, last_access DESC LIMIT ?", (limit,))]
+
+    def failure_rates(self, since=0, limit=20):
+        return self.query("SELECT client, COUNT(*) AS total, SUM(NOT ok) AS failed,"
+                          " 1.0 * SUM(NOT ok) / COUNT(*) AS rate FROM transfers"
+                          " WHERE start >= ? GROUP BY client"
+                          " ORDER BY rate DESC, total DESC LIMIT ?", (since, limit))
+
+
+def today():
+    return time.mktime(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timetuple())
+
+
+def main(argv=None):
+    from ..config import cfg
+
+    parser = argparse.ArgumentParser(prog="holytftp-history", description="Query the transfer history.")
+    parser.add_argument("query", choices=["slowest", "failures", "hottest"])
+    parser.add_argument("-f", "--file", default=cfg.history_file, help="history database")
+    parser.add_argument("-n", "--limit", type=int, default=20, help="number of rows")
+    parser.add_argument("--hours", type=float, help="look back N hours instead of since midnight")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.hours * 3600 if args.hours is not None else today()
+    history = TransferHistory(args.file)
+    if args.query == "slowest":
+        print("%-19s %9s %-15s %-5s %10s %10s %5s  %s"
+              % ("Start", "Duration", "Client", "Dir", "Bytes", "Speed", "Retx", "File"))
+        for start, duration, client, direction, file, size, speed, retx in history.slowest(since, args.limit):
+            print("%-19s %8.2fs %-15s %-5s %10s %8s/s %5d  %s"
+                  % (datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"), duration, client,
+                     direction, bytes2human(size), bytes2human(speed), retx or 0, file))
+    elif args.query == "hottest":
+        for path in history.hottest(args.limit):
+            print(path)
+    else:
+        print("%-15s %8s %8s %7s" % ("Client", "Total", "Failed", "Rate"))
+        for client, total, failed, rate in history.failure_rates(since, args.limit):
+            print("%-15s %8d %8d %6.1f%%" % (client, total, failed, rate * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
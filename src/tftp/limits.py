@@ -0,0 +1,40 @@
+import time
+
+
+class SourceLimiter(object):
+    """
+    Token bucket per source IP: `rate` requests per second, bursts of up
+    to `burst`. A rate of 0 disables the limit.
+    """
+
+    MAX_SOURCES = 0x10000
+
+    def __init__(self, rate=50, burst=100):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # [ip] = [tokens, last update]
+
+    def allow(self, ip, now=None):
+        if self.rate <= 0:
+            return True
+        now = now or time.time()
+        b = self.buckets.get(ip)
+        if b is None:
+            if len(self.buckets) >= self.MAX_SOURCES:
+                self.prune(now)
+            self.buckets[ip] = b = [self.burst, now]
+        else:
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] < 1:
+            return False
+        b[0] -= 1
+        return True
+
+    def prune(self, now):
+        # forget the sources whose bucket is full again
+        full = self.burst / self.rate if self.rate > 0 else 0
+        for ip in [ip for ip, b in self.buckets.items() if now - b[1] >= full]:
+            del self.buckets[ip]
+        if len(self.buckets) >= self.MAX_SOURCES:
+            self.buckets.clear()
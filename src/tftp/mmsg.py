@@ -0,0 +1,156 @@
+import sys
+import errno
+import socket
+import ctypes
+import ctypes.util
+from gevent.socket import wait_read, wait_write
+from ..log import log
+
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),  # network byte order
+                ("sin_addr", ctypes.c_uint8 * 4),
+                ("sin_zero", ctypes.c_uint8 * 8)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                                  ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError) as e:
+        log.debug("recvmmsg/sendmmsg unavailable:", e)
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+class PlainIO(object):
+    """One syscall per datagram, the portable fallback of MmsgIO."""
+
+    def __init__(self, sock, size=0xffff):
+        self.sock = sock
+        self.size = size
+
+    def recv(self):
+        return [self.sock.recvfrom(self.size)]
+
+    def send(self, msgs):
+        for data, address in msgs:
+            self.sock.sendto(data, address)
+        return len(msgs)
+
+
+class MmsgIO(object):
+    """
+    Batched datagram I/O on top of recvmmsg(2)/sendmmsg(2).
+
+    recv() returns every datagram already queued on the socket (up to
+    `count`) in one syscall; send() flushes a list of (data, address)
+    in as few syscalls as possible. Both cooperate with the gevent hub.
+    """
+
+    def __init__(self, sock, count=32, size=0xffff):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.count = count
+        self.size = size
+        self.bufs = [ctypes.create_string_buffer(size) for i in range(count)]
+        self.names = (sockaddr_in * count)()
+        self.iovs = (iovec * count)()
+        self.hdrs = (mmsghdr * count)()
+        for i in range(count):
+            self.iovs[i].iov_base = ctypes.cast(self.bufs[i], ctypes.c_void_p)
+            self.iovs[i].iov_len = size
+            h = self.hdrs[i].msg_hdr
+            h.msg_name = ctypes.cast(ctypes.pointer(self.names[i]), ctypes.c_void_p)
+            h.msg_iov = ctypes.pointer(self.iovs[i])
+            h.msg_iovlen = 1
+
+    @staticmethod
+    def available():
+        return _libc is not None
+
+    def recv(self):
+        while True:
+            for i in range(self.count):
+                self.hdrs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                self.hdrs[i].msg_hdr.msg_flags = 0
+                self.hdrs[i].msg_len = 0
+            n = _libc.recvmmsg(self.fd, self.hdrs, self.count, MSG_DONTWAIT, None)
+            if n >= 0:
+                break
+            e = ctypes.get_errno()
+            if e not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise OSError(e, "recvmmsg: " + errno.errorcode.get(e, str(e)))
+            wait_read(self.fd, timeout=self.sock.gettimeout(), timeout_exc=socket.timeout("timed out"))
+
+        msgs = []
+        for i in range(n):
+            name = self.names[i]
+            address = (socket.inet_ntoa(bytes(name.sin_addr)), socket.ntohs(name.sin_port))
+            msgs.append((ctypes.string_at(self.bufs[i], self.hdrs[i].msg_len), address))
+        return msgs
+
+    def send(self, msgs):
+        sent = 0
+        while sent < len(msgs):
+            batch = msgs[sent:sent + self.count]
+            n = len(batch)
+            names = (sockaddr_in * n)()
+            iovs = (iovec * n)()
+            hdrs = (mmsghdr * n)()
+            for i, (data, address) in enumerate(batch):
+                names[i].sin_family = socket.AF_INET
+                names[i].sin_port = socket.htons(address[1])
+                names[i].sin_addr[:] = socket.inet_aton(address[0])
+                iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+                iovs[i].iov_len = len(data)
+                h = hdrs[i].msg_hdr
+                h.msg_name = ctypes.cast(ctypes.pointer(names[i]), ctypes.c_void_p)
+                h.msg_namelen = ctypes.sizeof(sockaddr_in)
+                h.msg_iov = ctypes.pointer(iovs[i])
+                h.msg_iovlen = 1
+            r = _libc.sendmmsg(self.fd, hdrs, n, MSG_DONTWAIT)
+            if r < 0:
+                e = ctypes.get_errno()
+                if e not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise OSError(e, "sendmmsg: " + errno.errorcode.get(e, str(e)))
+                wait_write(self.fd)
+                continue
+            sent += r
+        return sent
+
+
+def batch_io(sock, enabled=True):
+    if enabled and MmsgIO.available() and sock.family == socket.AF_INET:
+        return MmsgIO(sock)
+    return PlainIO(sock)
@@ -0,0 +1,87 @@
+import sys
+import time
+import socket
+import ipaddress
+from ..log import log
+from ..config import cfg
+
+IP_MTU = getattr(socket, "IP_MTU", 14)  # linux, not exported by every python build
+DEFAULT_MTU = 1500
+IP_HEADER = 20
+UDP_HEADER = 8
+TFTP_HEADER = 4
+MAX_BLOCK_SIZE = 65464
+
+
+def block_size_for(mtu, frames=1):
+    """Largest blksize whose DATA packet fits in `frames` IP packets of `mtu`."""
+    per_frame = (mtu - IP_HEADER) & ~7  # fragment payloads are 8-byte aligned
+    return max(8, min(MAX_BLOCK_SIZE, per_frame * frames - UDP_HEADER - TFTP_HEADER))
+
+
+class PathMtu(object):
+    """
+    MTU towards a peer: the first matching `subnet_mtu` override (longest
+    prefix first), else the MTU of the route the kernel would use, read
+    from a connected UDP socket (no packet is sent). Probes are cached
+    per peer IP for `ttl` seconds.
+    """
+
+    MAX_ENTRIES = 4096
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}  # [ip] = (expires, mtu)
+        self.overrides = []  # [(network, mtu)], longest prefix first
+        self.generation = None
+
+    def load_overrides(self):
+        overrides = []
+        for net, mtu in cfg.subnet_mtu.items():
+            try:
+                overrides.append((ipaddress.ip_network(net, strict=False), int(mtu)))
+            except ValueError as e:
+                log.warn("invalid subnet_mtu entry %s:" % net, e)
+        overrides.sort(key=lambda o: o[0].prefixlen, reverse=True)
+        self.overrides = overrides
+        self.entries.clear()
+        self.generation = cfg.generation
+
+    def probe(self, ip):
+        if not sys.platform.startswith("linux"):
+            return DEFAULT_MTU
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((ip, 9))
+            return s.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        except OSError as e:
+            log.debug("cannot get mtu to %s:" % ip, e)
+            return DEFAULT_MTU
+        finally:
+            s.close()
+
+    def get(self, ip):
+        if self.generation != cfg.generation:
+            self.load_overrides()
+        now = time.time()
+        e = self.entries.get(ip)
+        if e is not None and e[0] > now:
+            return e[1]
+        mtu = None
+        if self.overrides:
+            addr = ipaddress.ip_address(ip)
+            for net, value in self.overrides:
+                if addr in net:
+                    mtu = value
+                    break
+        if mtu is None:
+            mtu = self.probe(ip)
+        if len(self.entries) >= self.MAX_ENTRIES:
+            self.entries.clear()
+        self.entries[ip] = (now + self.ttl, mtu)
+        return mtu
+
+    def max_block_size(self, ip):
+        if cfg.mtu_frames <= 0:
+            return MAX_BLOCK_SIZE
+        return block_size_for(self.get(ip), cfg.mtu_frames)
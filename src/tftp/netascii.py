@@ -0,0 +1,233 @@
+"""
+netascii transfers (RFC 764): on the wire a line ends with CR LF and a
+bare CR is sent as CR NUL.
+
+Reads are translated as they are sent. Each LF or CR of the file adds
+one byte, so an index of the translated offset every SPAN raw bytes
+gives the exact translated size (tsize) and lets any block be found
+with one bisect and at most SPAN bytes of translation; a sequential
+transfer translates every byte once. Indexes are built in the thread
+pool and kept per file (path, mtime and size), and small files are kept
+translated whole in an LRU.
+
+Uploads are decoded by a stage of the sink chain: CR LF becomes the
+local line ending and CR NUL a CR, even when a block ends between the
+two.
+"""
+import os
+import errno
+from bisect import bisect_right
+from collections import OrderedDict
+import gevent
+from gevent.event import AsyncResult
+from ..log import log
+from .storage import FileSource, MemorySource, ArchiveSource, SeekSource, FrameCache, BAD_COMPRESSED, SPAN as FRAME
+from .dedup import ManifestSource
+from .sinks import Stage
+
+SPAN = 0x10000  # raw bytes between two index points, and per translation step
+SMALL = 1 << 20  # files up to this size are translated whole and cached
+MAX_INDEXES = 1024
+NEWLINE = os.linesep.encode()
+
+
+def encode(data):
+    return data.replace(b"\r", b"\r\0").replace(b"\n", b"\r\n")
+
+
+def decode(data):
+    return data.replace(b"\r\n", NEWLINE).replace(b"\r\0", b"\r")
+
+
+def stamp(path):
+    """The cache key of a file, None if it is not one (an archive member, a rendering...)."""
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return path, st.st_mtime_ns, st.st_size
+
+
+class NetasciiIndex(object):
+    """Translated offsets of the raw offsets 0, SPAN, 2 * SPAN..."""
+
+    def __init__(self):
+        self.raw = [0]
+        self.offsets = [0]
+        self.size = 0  # translated
+
+    def build(self, source):
+        raw = size = 0
+        while True:
+            data = source.read(raw, SPAN)
+            if not data:
+                break
+            raw += len(data)
+            size += len(data) + data.count(b"\n") + data.count(b"\r")
+            self.raw.append(raw)
+            self.offsets.append(size)
+        self.size = size
+        return self
+
+    def point(self, offset):
+        i = bisect_right(self.offsets, offset) - 1
+        return self.offsets[i], self.raw[i]
+
+
+class Decompressed(object):
+    """
+    Reads a compressed file for an index build in the thread pool: frames
+    come from its inflater, not from the frame cache the hub shares.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.frame = None, b""  # (number, data) of the frame read last
+
+    def read(self, offset, length):
+        n, pos = divmod(offset, FRAME)
+        if self.frame[0] != n:
+            try:
+                self.frame = n, self.source.decode(n)
+            except BAD_COMPRESSED as e:
+                raise OSError(errno.EIO, "Bad compressed file: %s" % e)
+        return self.frame[1][pos:pos + length]
+
+
+class Unbuffered(object):
+    """Reads an archive member for an index build in the thread pool, straight from its stream."""
+
+    def __init__(self, source):
+        self.read = source.fill
+
+
+def build(source):
+    """
+    The index of source, read whole in the thread pool: a compressed file
+    or archive member is decompressed there. A relayed file being fetched
+    waits for the download, on the hub.
+    """
+    if isinstance(source, SeekSource):
+        source = Decompressed(source)
+    elif isinstance(source, ArchiveSource):
+        source = Unbuffered(source)
+    elif not isinstance(source, (FileSource, MemorySource, ManifestSource)):
+        return NetasciiIndex().build(source)
+    return gevent.get_hub().threadpool.apply(NetasciiIndex().build, (source,))
+
+
+class NetasciiSource(object):
+    """
+    A source read in netascii. The translated bytes around the last read
+    are kept, so retransmits and the next blocks are slices; a read
+    elsewhere starts again from the nearest index point.
+    """
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+        self.path = source.path
+        self.size = index.size
+        self.start = 0  # translated offset of window
+        self.window = b""
+        self.raw = 0  # raw offset right after window
+
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset < self.start or offset > self.start + len(self.window) + SPAN:
+            self.start, self.raw = self.index.point(offset)
+            self.window = b""
+        while self.start + len(self.window) < end:
+            data = self.source.read(self.raw, SPAN)
+            if not data:
+                raise OSError(errno.EIO, "%s changed while being sent" % self.path)
+            self.raw += len(data)
+            self.window += encode(data)
+        if offset - self.start > SPAN:  # forget what was sent long ago
+            self.window = self.window[offset - self.start:]
+            self.start = offset
+        return self.window[offset - self.start:end - self.start]
+
+    def close(self):
+        self.source.close()
+
+
+class NetasciiStore(object):
+    """
+    Opens sources for netascii reads. Small files are translated whole
+    (kept in `texts`, by mtime), larger ones get an index, built once per
+    file version in the thread pool (sessions asking meanwhile wait for
+    the same build).
+    """
+
+    def __init__(self, capacity=16 << 20):
+        self.texts = FrameCache(capacity)  # [(path, mtime, size)] = translated file
+        self.indexes = OrderedDict()  # [(path, mtime, size)] = NetasciiIndex
+        self.building = {}  # [(path, mtime, size)] = AsyncResult
+
+    def open(self, source, path):
+        """The netascii rendering of source (which it takes over)."""
+        key = stamp(path)
+        text = self.texts.get(key) if key is not None else None
+        try:
+            if text is None and source.size is not None and source.size <= SMALL:
+                data = source.read(0, source.size)
+                text = encode(data)
+                if key is not None and len(data) == source.size:
+                    self.texts.put(key, text)
+            if text is None:
+                return NetasciiSource(source, self.index(key, source))
+        except OSError:
+            source.close()
+            raise
+        source.close()
+        return MemorySource(path, text)
+
+    def index(self, key, source):
+        if key is None:
+            return build(source)
+        index = self.indexes.get(key)
+        if index is not None:
+            self.indexes.move_to_end(key)
+            return index
+        pending = self.building.get(key)
+        if pending is not None:
+            return pending.get()
+        self.building[key] = pending = AsyncResult()
+        try:
+            index = build(source)
+        except OSError as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            del self.building[key]
+        log.info("netascii index of %s: %d -> %d bytes" % (key[0], key[2], index.size))
+        self.indexes[key] = index
+        while len(self.indexes) > MAX_INDEXES:
+            self.indexes.popitem(last=False)
+        pending.set(index)
+        return index
+
+
+class NetasciiStage(Stage):
+    """Decodes a netascii upload to the local line ending."""
+
+    def __init__(self, next, arg=None):
+        super().__init__(next)
+        self.cr = False  # the last block ended with a CR
+
+    def write(self, data):
+        if self.cr:
+            data = b"\r" + data
+        self.cr = data.endswith(b"\r")
+        if self.cr:
+            data = data[:-1]
+        self.next.write(decode(data))
+
+    def close(self):
+        if self.cr:
+            self.next.write(b"\r")
+            self.cr = False
+        return self.next.close()
@@ -1,7 +1,5 @@
-import os
 from struct import pack, unpack
 from ..log import log
-from ..config import cfg
 
 SUPPORTED_OPTIONS = ["blksize", "tsize", "timeout"]
 DEFAULT_BLOCK_SIZE = 512
@@ -87,6 +85,7 @@ class TftpReqPacket(object):
         self.options = {}
         self.accepted_options = {}
         self.block_size = DEFAULT_BLOCK_SIZE
+        self.requested_block_size = None  # blksize option of the client, if any
         self.timeout = 0
         self.tsize = 0  # transfer size
 
@@ -98,7 +97,30 @@ class TftpReqPacket(object):
             s += " OPN=%d" % len(self.options)
         return s
 
-    def parse(self):
+    def set_option(self, name, value):
+        """Change (or drop, if value is None) an accepted option, whatever its case."""
+        for opt in list(self.accepted_options):
+            if opt.lower() == name:
+                if value is None:
+                    del self.accepted_options[opt]
+                else:
+                    self.accepted_options[opt] = str(value)
+
+    @staticmethod
+    def peek(raw):
+        """Cheaply get (opcode, filename) of a request without a full parse, None if it has none or is not text."""
+        if len(raw) < 6:
+            return None
+        end = raw.find(b"\0", 2)
+        if end <= 2:
+            return None
+        try:
+            raw[2:].decode()  # the options too: parse() decodes them all
+        except UnicodeDecodeError:
+            return None
+        return unpack("!H", raw[:2])[0], raw[2:end].decode()
+
+    def parse(self, max_block_size=65464):
         if len(self.raw) < 6:
             log.debug("data too short:", len(self.raw))
             return False
@@ -133,10 +155,13 @@ class TftpReqPacket(object):
             opt_lower = opt.lower()
             value = self.accepted_options[opt]
             if opt_lower == "blksize" and value.isdigit():
-                self.block_size = int(value)
+                self.block_size = self.requested_block_size = int(value)
                 if self.block_size < 8 or self.block_size > 65464:
                     self.block_size = DEFAULT_BLOCK_SIZE
                     self.accepted_options[opt] = str(self.block_size)
+                elif self.block_size > max_block_size:
+                    self.block_size = max(max_block_size, DEFAULT_BLOCK_SIZE)
+                    self.accepted_options[opt] = str(self.block_size)
             elif opt_lower == "timeout" and value.isdigit():
                 self.timeout = int(value)
                 if not 1 <= self.timeout <= 255:
@@ -145,11 +170,7 @@ class TftpReqPacket(object):
                     self.accepted_options[opt] = str(self.timeout)
             elif opt_lower == "tsize" and value.isdigit():
                 if self.code == TftpOpCode.ReadRequest:
-                    try:
-                        path = cfg.get_real_path(self.filename)
-                        self.tsize = os.path.getsize(path)
-                    except OSError:
-                        self.tsize = 0
+                    self.tsize = 0  # set by the session from the source it opens
                 else:
                     self.tsize = int(value)
                 self.accepted_options[opt] = str(self.tsize)
@@ -228,7 +249,7 @@ class TftpAckPacket(object):
         return p
 
     @classmethod
-    def from_bytes(cls, raw):
+    def from_bytes(cls, raw, supported=SUPPORTED_OPTIONS):
         if type(raw) is not bytes or len(raw) < 4:
             log.error("data too short:", len(raw))
             return None
@@ -238,16 +259,20 @@ class TftpAckPacket(object):
             return None
 
         p = cls(block)
-        p.parse_options(raw[4:-1])
+        if code == TftpOpCode.OACK:  # no block number, options start right after the opcode
+            p.block = 0
+            p.parse_options(raw[2:-1], supported)
+        else:
+            p.parse_options(raw[4:-1], supported)
         return p
 
-    def parse_options(self, opt_raw):
+    def parse_options(self, opt_raw, supported=SUPPORTED_OPTIONS):
         opname = None
         for s in opt_raw.decode().split("\0"):
             if opname is None:
                 opname = s
             else:
-                if opname in SUPPORTED_OPTIONS:
+                if supported is None or opname.lower() in supported:
                     self.options[opname] = s
                 opname = None
 
@@ -298,3 +323,17 @@ class TftpErrorPacket(object):
     def __bytes__(self):
         s = pack("!HH", self.code, self.errcode)
         return s + (self.msg + "\0").encode()
+
+
+def describe(raw):
+    """Short description of a raw packet for the log, like str() of the packet objects."""
+    if len(raw) < 4:
+        return "UDP L=%d" % len(raw)
+    code, arg = unpack("!HH", raw[:4])
+    if code == TftpOpCode.Data:
+        return "<Data> N=%d L=%d" % (arg, len(raw) - 4)
+    if code == TftpOpCode.ACK:
+        return "<ACK> N=%d" % arg
+    if code == TftpOpCode.Error:
+        return "<Error> E=%d/%s M='%s'" % (arg, TftpErrCode.str(arg), raw[4:-1].decode(errors="replace"))
+    return "<%s> L=%d" % (TftpOpCode.str(code), len(raw))
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+from collections import Counter
+import gevent
+from gevent import monkey
+from ..log import log
+
+get_ident = monkey.get_original("_thread", "get_ident")
+real_sleep = monkey.get_original("time", "sleep")
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+class Profiler(object):
+    """
+    On-demand profiler of the running server.
+
+    "sample" mode runs a real OS thread that samples the hub thread's
+    current frame every `interval` seconds. Whatever greenlet is running
+    at that moment is sampled, so all greenlets are covered, and an idle
+    hub shows up as the hub's own frames. The result is written as
+    collapsed stacks (one "a;b;c count" line per stack, ready for
+    flamegraph.pl or speedscope) plus a top-N text report.
+
+    "cprofile" mode wraps the hub thread in cProfile and writes the
+    pstats dump and its text report.
+    """
+
+    def __init__(self, out_dir, interval=0.005):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.mode = None
+        self.samples = Counter()
+        self.profile = None
+        self.sampling = False
+        self.timer = None
+        self.started = 0
+        self.on_stop = None  # called with the output prefix, however the profile ends
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    def start(self, seconds=30, mode="sample"):
+        if self.running:
+            log.warn("profiler is already running")
+            return False
+        log.warn("profiler: %s for %ds" % (mode, seconds))
+        self.mode = mode
+        self.started = time.time()
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.samples.clear()
+            self.sampling = True
+            gevent.get_hub().threadpool.spawn(self.sample, get_ident())
+        if seconds > 0:
+            self.timer = gevent.spawn_later(seconds, self.stop)
+        return True
+
+    def sample(self, ident):
+        while self.sampling:
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+            real_sleep(self.interval)
+
+    def stop(self):
+        if not self.running:
+            return None
+        if self.timer and self.timer is not gevent.getcurrent():
+            self.timer.kill(block=False)
+        self.timer = None
+        os.makedirs(self.out_dir, exist_ok=True)
+        prefix = os.path.join(self.out_dir, "profile-%s" % time.strftime("%Y%m%d-%H%M%S"))
+        if self.mode == "cprofile":
+            self.profile.disable()
+            self.profile.dump_stats(prefix + ".prof")
+            with open(prefix + ".txt", "w") as f:
+                pstats.Stats(self.profile, stream=f).sort_stats("cumulative").print_stats(50)
+            self.profile = None
+        else:
+            self.sampling = False
+            real_sleep(self.interval * 2)  # let the sampler leave its loop
+            with open(prefix + ".folded", "w") as f:
+                for stack, n in self.samples.most_common():
+                    f.write("%s %d\n" % (stack, n))
+            with open(prefix + ".txt", "w") as f:
+                f.write(self.report())
+        if self.on_stop:
+            self.on_stop(prefix)
+        log.warn("profiler: %s stopped after %.1fs, written to %s.*"
+                 % (self.mode, time.time() - self.started, prefix))
+        self.mode = None
+        return prefix
+
+    def report(self, top=40):
+        total = sum(self.samples.values()) or 1
+        own = Counter()
+        inclusive = Counter()
+        for stack, n in self.samples.items():
+            frames = stack.split(";")
+            own[frames[-1]] += n
+            for name in set(frames):
+                inclusive[name] += n
+        lines = ["%d samples, %.1fms interval" % (total, self.interval * 1000), "",
+                 "%7s %7s  %s" % ("self%", "total%", "function")]
+        for name, n in own.most_common(top):
+            lines.append("%6.1f%% %6.1f%%  %s" % (n * 100.0 / total, inclusive[name] * 100.0 / total, name))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,327 @@
+"""
+Sans-IO core of a TFTP transfer.
+
+A machine never touches a socket, a file or a clock. The engine feeds it
+what happened - start(), receive(raw), timeout(), and data() to answer a
+READ - and carries out the actions it returns, in order:
+
+    (SEND, raw)                    send raw to the peer
+    (READ, offset, length)         read the source, then call data(bytes)
+    (WRITE, offset, data)          write to the sink
+    (PROGRESS, transferred)        bytes done so far
+    (DONE, ok, title, detail)      the transfer is over; a write session
+                                   stays open to re-ACK retransmissions
+    (CLOSE,)                       nothing left to do, drop the session
+
+If an action fails (e.g. the source cannot be read), the engine skips
+the remaining ones and performs fail(errcode, msg) instead.
+"""
+import sys
+import time
+import random
+from struct import pack, unpack
+from .packet import TftpOpCode, TftpErrCode
+
+SEND = 1
+READ = 2
+WRITE = 3
+PROGRESS = 4
+DONE = 5
+CLOSE = 6
+
+TFTP_RETRY = 5
+
+_ACK = TftpOpCode.ACK
+_DATA = TftpOpCode.Data
+_ERROR = TftpOpCode.Error
+
+
+class Machine(object):
+
+    def __init__(self, block_size, oack=None, retries=TFTP_RETRY):
+        self.block_size = block_size
+        self.oack = oack  # raw OACK to start with, if options were accepted
+        self.retries = retries
+        self.block = 0  # last block number on the wire
+        self.total_block = 0
+        self.retry = 0
+        self.retransmits = 0
+        self.last = None  # packet to resend on timeout
+        self.finished = False  # the last block is sent (read) or received (write)
+        self.closed = False
+        self.transferred = 0
+
+    def fail(self, errcode, msg):
+        """Tell the peer and give up."""
+        self.finished = self.closed = True
+        title = "Denied" if errcode in (TftpErrCode.AccessViolation, TftpErrCode.FileNotFound) else "Error"
+        return [(SEND, pack("!HH", _ERROR, errcode) + msg.encode() + b"\0"),
+                (DONE, False, title, TftpErrCode.str(errcode) + ": " + msg), (CLOSE,)]
+
+    def peer_error(self, raw):
+        self.finished = self.closed = True
+        errcode, = unpack("!H", raw[2:4])
+        msg = raw[4:-1].decode(errors="replace")
+        return [(DONE, False, "Error", "Peer: %s: %s" % (TftpErrCode.str(errcode), msg)), (CLOSE,)]
+
+    def timeout(self):
+        if self.closed:
+            return [(CLOSE,)]
+        self.retry += 1
+        if self.retry > self.retries:
+            self.closed = True
+            if self.finished:  # only the final ACK is missing
+                return [(DONE, True, "", ""), (CLOSE,)]
+            return [(DONE, False, "Timeout", ""), (CLOSE,)]
+        self.retransmits += 1
+        return [(SEND, self.last)]
+
+
+class ReadMachine(Machine):
+    """Sends the source to the peer, one block per ACK."""
+
+    def __init__(self, block_size, oack=None, retries=TFTP_RETRY):
+        Machine.__init__(self, block_size, oack, retries)
+        self.reading = False  # a READ is out, ACKs are ignored until data() comes
+
+    def start(self):
+        if self.oack:
+            self.last = self.oack
+            return [(SEND, self.oack)]
+        self.reading = True
+        return [(READ, 0, self.block_size)]
+
+    def data(self, data):
+        self.reading = False
+        self.total_block += 1
+        self.block = self.total_block & 0xffff
+        self.last = pack("!HH", _DATA, self.block) + data
+        self.transferred = (self.total_block - 1) * self.block_size + len(data)
+        if len(data) < self.block_size:
+            self.finished = True
+        return [(SEND, self.last), (PROGRESS, self.transferred)]
+
+    def receive(self, raw):
+        if len(raw) < 4 or self.closed:
+            return ()
+        code, block = unpack("!HH", raw[:4])
+        if code == _ERROR:
+            return self.peer_error(raw)
+        if code != _ACK or block != self.block or self.reading:
+            return ()  # stale or duplicate ACK
+        self.retry = 0
+        if self.finished:
+            self.closed = True
+            return [(DONE, True, "", ""), (CLOSE,)]
+        self.reading = True
+        return [(READ, self.total_block * self.block_size, self.block_size)]
+
+
+class WriteMachine(Machine):
+    """Receives blocks from the peer, ACKing each of them."""
+
+    def start(self):
+        self.last = self.oack or pack("!HH", _ACK, 0)
+        return [(SEND, self.last)]
+
+    def receive(self, raw):
+        if len(raw) < 4 or self.closed:
+            return ()
+        code, block = unpack("!HH", raw[:4])
+        if code == _ERROR:
+            return self.peer_error(raw)
+        if code != _DATA:
+            return ()
+        if block == self.block:  # our ACK was lost
+            return [(SEND, pack("!HH", _ACK, block))]
+        if block != (self.total_block + 1) & 0xffff or self.finished:
+            return ()
+        self.retry = 0
+        data = raw[4:]
+        offset = self.total_block * self.block_size
+        self.total_block += 1
+        self.block = block
+        self.last = pack("!HH", _ACK, block)
+        self.transferred = offset + len(data)
+        if len(data) < self.block_size:  # the upload is complete once the sink is closed, ACK after
+            self.finished = True
+            return [(WRITE, offset, data), (PROGRESS, self.transferred), (DONE, True, "", ""), (SEND, self.last)]
+        return [(WRITE, offset, data), (SEND, self.last), (PROGRESS, self.transferred)]
+
+    def timeout(self):
+        if self.finished:  # the final ACK had its chance to be retransmitted
+            self.closed = True
+            return [(CLOSE,)]
+        return Machine.timeout(self)
+
+
+PEER = "peer"
+STRAY = "stray"  # another transfer ID, e.g. a late packet of an old session
+
+
+def simulate(size=1 << 20, block_size=512, loss=0.0, dup=0.0, write=False, seed=None, stray=0.0):
+    """
+    Run one transfer against a simulated peer over a link that drops
+    (`loss`) and duplicates (`dup`) packets in both directions; with
+    `stray`, a packet from another transfer ID follows that often, and is
+    refused with an UnknownTID error as the session does. There is no
+    real time: when nothing is in flight, both sides time out - the peer
+    resends its last packet and the machine gets timeout().
+    Returns {ok, same (data matches), packets, retransmits, blocks (DATA
+    or ACK packets the machine sent), refused (stray packets)}.
+    """
+    rnd = random.Random(seed)
+    chunk = bytes(rnd.getrandbits(8) for _ in range(4096))
+    payload = (chunk * (size // 4096 + 1))[:size]
+    received = bytearray()
+    m = WriteMachine(block_size) if write else ReadMachine(block_size)
+    state = {"ok": None, "packets": 0, "expect": 1, "sent": 0, "last": None, "blocks": 0, "refused": 0}
+    wire = []  # packets in flight: (to_machine, raw, transfer ID of the sender)
+
+    def link(to_machine, raw):
+        state["packets"] += 1
+        if rnd.random() >= loss:
+            wire.append((to_machine, raw, PEER))
+            if rnd.random() < dup:
+                wire.append((to_machine, raw, PEER))
+        if to_machine and rnd.random() < stray:
+            wire.append((True, raw, STRAY))
+
+    def peer(raw):
+        if not write:  # the client of a read session: store in order, ACK what arrives
+            block, = unpack("!H", raw[2:4])
+            if block == state["expect"] & 0xffff:
+                received.extend(raw[4:])
+                state["expect"] += 1
+            state["last"] = pack("!HH", _ACK, block)
+            return state["last"]
+        # the client of a write session: the next block for the ACK of the last one
+        block, = unpack("!H", raw[2:4])
+        n = state["sent"]
+        if raw[1] != _ACK or block != n & 0xffff or n * block_size > size:
+            return None  # never answer a duplicate ACK (sorcerer's apprentice)
+        state["sent"] += 1
+        state["last"] = pack("!HH", _DATA, (n + 1) & 0xffff) + payload[n * block_size:(n + 1) * block_size]
+        return state["last"]
+
+    def perform(actions):
+        for action in actions:
+            kind = action[0]
+            if kind == SEND:
+                if action[1][1] in (_DATA, _ACK):
+                    state["blocks"] += 1
+                link(False, action[1])
+            elif kind == READ:
+                perform(m.data(payload[action[1]:action[1] + action[2]]))
+            elif kind == WRITE:
+                del received[action[1]:]
+                received.extend(action[2])
+            elif kind == DONE:
+                state["ok"] = action[1]
+
+    perform(m.start())
+    while not m.closed:
+        if not wire:
+            if write and state["last"] and not m.finished:
+                link(True, state["last"])
+            perform(m.timeout())
+            continue
+        to_machine, raw, tid = wire.pop(0)
+        if tid != PEER:  # what the session does: the machine never sees it
+            state["refused"] += 1
+        elif to_machine:
+            perform(m.receive(raw))
+        else:
+            reply = peer(raw)
+            if reply:
+                link(True, reply)
+    return dict(state, same=bytes(received) == payload, retransmits=m.retransmits)
+
+
+def check(loss=0.05):
+    """
+    Checks the machines against the simulated link and a few scripted
+    exchanges: exact data with and without loss, retransmits only when
+    packets are lost, no extra blocks for duplicated ACKs, other transfer
+    IDs kept out, timeouts and peer errors. Returns the failed checks.
+    """
+    failed = []
+    size, block_size = 1 << 20, 512
+
+    def expect(what, ok):
+        print("%-52s %s" % (what, "ok" if ok else "FAILED"))
+        if not ok:
+            failed.append(what)
+
+    for write in (False, True):
+        kind = "write" if write else "read"
+        blocks = size // block_size + 1 + write  # a write starts with ACK 0
+        r = simulate(size, block_size, write=write, seed=1)
+        expect("%s: lossless, exact and no retransmit" % kind,
+               r["ok"] and r["same"] and r["retransmits"] == 0 and r["blocks"] == blocks)
+        r = simulate(size, block_size, loss, loss, write, seed=2)
+        expect("%s: %g%% loss, exact with retransmits" % (kind, loss * 100),
+               r["ok"] and r["same"] and (r["retransmits"] > 0) == (loss > 0))
+        r = simulate(size, block_size, 0, 0.3, write, seed=3)
+        # a duplicated DATA is ACKed again, a duplicated ACK must not send its block twice
+        expect("%s: duplicates, exact and no timeout" % kind,
+               r["ok"] and r["same"] and r["retransmits"] == 0 and (write or r["blocks"] == blocks))
+        r = simulate(size, block_size, 0, 0, write, seed=4, stray=0.2)
+        expect("%s: another TID is refused, transfer unharmed" % kind,
+               r["ok"] and r["same"] and r["refused"] > 0 and r["blocks"] == blocks)
+
+    ack1 = pack("!HH", _ACK, 1)
+    m = ReadMachine(block_size)
+    m.start()
+    m.data(bytes(block_size))
+    first = m.receive(ack1)
+    early = m.receive(ack1)  # before data() answers the READ
+    m.data(bytes(block_size))
+    late = m.receive(ack1)
+    expect("read: a duplicate ACK sends nothing", first == [(READ, block_size, block_size)] and early == () and late == ())
+
+    m = ReadMachine(block_size, retries=3)
+    m.start()
+    m.data(bytes(block_size))
+    outs = [m.timeout() for _ in range(4)]
+    expect("read: silent peer, retries then Timeout", outs[:3] == [[(SEND, m.last)]] * 3
+           and outs[3][0][:3] == (DONE, False, "Timeout") and m.retransmits == 3 and m.closed)
+
+    m = WriteMachine(block_size, retries=2)
+    m.start()
+    outs = [m.timeout() for _ in range(3)]
+    expect("write: silent peer, retries then Timeout", outs[2][0][:3] == (DONE, False, "Timeout") and m.closed)
+
+    m = WriteMachine(block_size)
+    m.start()
+    done = m.receive(pack("!HH", _DATA, 1) + b"end")
+    again = m.receive(pack("!HH", _DATA, 1) + b"end")  # our final ACK was lost
+    out = m.timeout()
+    expect("write: a lost final ACK is sent again, then closed", (DONE, True, "", "") in done
+           and again == [(SEND, ack1)] and out == [(CLOSE,)] and m.closed)
+
+    m = ReadMachine(block_size)
+    m.start()
+    m.data(bytes(block_size))
+    out = m.receive(pack("!HH", _ERROR, TftpErrCode.DiskFull) + b"full\0")
+    expect("read: peer error ends the transfer", out[0][:2] == (DONE, False) and m.closed)
+    return failed
+
+
+def main(argv=None):
+    args = argv if argv is not None else sys.argv[1:]
+    loss = float(args[0]) if args else 0.01
+    for write in (False, True):
+        start = time.perf_counter()
+        r = simulate(16 << 20, 512, loss, loss, write, seed=1)
+        elapsed = time.perf_counter() - start
+        print("%-5s ok=%s same=%s %d packets, %d retransmits, %.0f packets/s"
+              % ("write" if write else "read", r["ok"], r["same"], r["packets"], r["retransmits"],
+                 r["packets"] / elapsed))
+    failed = check(loss)
+    print("%d checks failed" % len(failed) if failed else "all checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import socket
+import tempfile
+import subprocess
+from collections import OrderedDict
+import gevent
+from gevent.event import Event
+from ..log import log
+from .client import TftpClient, TransferError
+from .packet import TftpErrCode
+from .storage import FileSource
+from .stats import Stats
+
+
+class Fetch(object):
+    """One upstream download in progress, shared by every session asking for the file."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.part = "%s.part.%d" % (path, os.getpid())
+        self.size = None  # tsize of the upstream, if it told
+        self.received = 0
+        self.done = False
+        self.error = None
+        self.errcode = None
+        self.ready = Event()  # the upstream answered: options known, or failed
+        self.event = Event()  # replaced every time more data arrived
+
+    def wake(self):
+        event, self.event = self.event, Event()
+        event.set()
+
+
+class FetchSource(object):
+    """Reads a file while it is being fetched: read() waits for the bytes it needs."""
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.path = fetch.path
+        self.fd = os.open(fetch.part, os.O_RDONLY)
+        fetch.ready.wait()
+        if fetch.error and not fetch.received:
+            os.close(self.fd)
+            if fetch.errcode == TftpErrCode.FileNotFound:
+                raise FileNotFoundError(errno.ENOENT, fetch.error)
+            raise OSError(errno.EIO, "Upstream: " + fetch.error)
+
+    @property
+    def size(self):
+        f = self.fetch
+        if f.size is None and f.done:
+            return f.received
+        return f.size
+
+    def read(self, offset, length):
+        f = self.fetch
+        while not f.done and f.received < offset + length:
+            f.event.wait()
+        if f.error and f.received < offset + length:
+            raise OSError(errno.EIO, "Upstream: " + f.error)
+        return os.pread(self.fd, length, offset)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Relay(object):
+    """
+    Caching relay of an upstream TFTP server for the files missing locally.
+
+    The first request of a file starts a fetch from the upstream into
+    `cache_dir`; it is served while it arrives, and sessions asking for
+    the same file meanwhile share the fetch. Later requests are served
+    from the cache, bounded by `capacity` bytes (LRU). A copy older than
+    `ttl` seconds is still served, and revalidated in the background:
+    the upstream is asked for its tsize and the file is fetched again
+    when the size changed (an upstream not telling the size is taken as
+    unchanged). If the upstream cannot be reached, the copy is kept.
+    """
+
+    def __init__(self, upstream, cache_dir, capacity, ttl=300, stats=None):
+        host, _, port = upstream.rpartition(":") if ":" in upstream else (upstream, "", "")
+        self.client = TftpClient(host, int(port or 69))
+        self.cache_dir = cache_dir
+        self.capacity = capacity
+        self.ttl = ttl
+        self.stats = stats
+        self.entries = None  # [name] = size, least recently used first
+        self.used = 0
+        self.fetches = {}  # [name] = Fetch
+        self.revalidating = set()  # names being revalidated
+
+    def incr(self, name):
+        if self.stats:
+            self.stats.incr(name)
+
+    @staticmethod
+    def key(name):
+        name = os.path.normpath(name.replace("\\", "/").lstrip("/"))
+        if name in (".", "") or name.startswith(".."):
+            return None
+        return name
+
+    def path(self, name):
+        key = self.key(name)
+        return os.path.join(self.cache_dir, key) if key else None
+
+    def load(self):
+        self.entries = OrderedDict()
+        self.used = 0
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                if ".part." in f:
+                    os.unlink(path)  # left by an interrupted fetch
+                    continue
+                st = os.stat(path)
+                found.append((st.st_atime, os.path.relpath(path, self.cache_dir), st.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.used += size
+        log.info("relay cache: %d files in %s" % (len(self.entries), self.cache_dir))
+
+    def add(self, name, size):
+        self.used += size - self.entries.pop(name, 0)
+        self.entries[name] = size
+        while self.used > self.capacity and self.entries:
+            old, old_size = self.entries.popitem(last=False)
+            self.used -= old_size
+            if old in self.fetches:
+                continue
+            log.debug("relay cache: evict", old)
+            try:
+                os.unlink(os.path.join(self.cache_dir, old))
+            except OSError:
+                pass
+
+    def drop(self, name):
+        self.used -= self.entries.pop(name, 0)
+        try:
+            os.unlink(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def open(self, name):
+        key = self.key(name)
+        if key is None:
+            raise FileNotFoundError(errno.ENOENT, "Illegal file name")
+        if self.entries is None:
+            self.load()
+        fetch = self.fetches.get(key)
+        if fetch is None:
+            path = os.path.join(self.cache_dir, key)
+            if key in self.entries and self.fresh(key, path):
+                self.entries.move_to_end(key)
+                self.incr("relay.hits")
+                return FileSource(path)
+            fetch = self.start(key, path)
+        return FetchSource(fetch)
+
+    def fresh(self, key, path):
+        """Whether the cached copy may be served; an old one is revalidated in the background meanwhile."""
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except OSError:
+            self.drop(key)
+            return False
+        if age >= self.ttl and key not in self.revalidating:
+            self.revalidating.add(key)
+            gevent.spawn(self.revalidate, key, path)
+        return True
+
+    def revalidate(self, key, path):
+        """Asks the upstream for the tsize of key: the copy is kept, dropped or fetched again."""
+        try:
+            size = self.client.probe_size(key)
+        except TransferError as e:
+            if e.errcode == TftpErrCode.FileNotFound:
+                log.info("relay: %s is gone upstream" % key)
+                if key not in self.fetches:
+                    self.drop(key)
+            else:
+                log.warn("relay: cannot revalidate %s, serving the cached copy:" % key, e)
+                self.incr("relay.stale")
+            return
+        finally:
+            self.revalidating.discard(key)
+        if key in self.fetches or key not in self.entries:
+            return  # fetched again or evicted meanwhile
+        if size is None or size == self.entries[key]:  # no tsize: nothing tells it changed
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            self.incr("relay.revalidated")
+            return
+        log.info("relay: %s changed upstream" % key)
+        self.start(key, path)
+
+    def start(self, key, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fetch = Fetch(key, path)
+        fd = os.open(fetch.part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.fetches[key] = fetch
+        self.incr("relay.fetches")
+        gevent.spawn(self.run, fetch, fd)
+        return fetch
+
+    def run(self, fetch, fd):
+        def started(tsize):
+            fetch.size = tsize
+            fetch.ready.set()
+
+        def write(data):
+            os.write(fd, data)
+            fetch.received += len(data)
+            fetch.wake()
+
+        t = time.time()
+        try:
+            self.client.download(fetch.name, write, started)
+            os.close(fd)
+            fd = None
+            os.replace(fetch.part, fetch.path)
+            self.add(fetch.name, fetch.received)
+            log.info("relay: fetched %s, %d bytes in %.2fs" % (fetch.name, fetch.received, time.time() - t))
+        except (TransferError, OSError) as e:
+            log.warn("relay: failed to fetch %s:" % fetch.name, e)
+            fetch.error = str(e)
+            fetch.errcode = getattr(e, "errcode", None)
+            self.incr("relay.errors")
+            try:
+                os.unlink(fetch.part)
+            except OSError:
+                pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+            del self.fetches[fetch.name]
+            fetch.done = True
+            fetch.ready.set()
+            fetch.wake()
+
+
+def check(port=None):
+    """
+    Relays from a stand-in upstream: a headless server started with a
+    config of its own (in a temporary HOME) on a loopback port. Checks a
+    fetch, a hit, and the background revalidation of a copy whose
+    upstream is unchanged, changed and gone. Returns the failed checks.
+    """
+    if port is None:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+    tmp = tempfile.mkdtemp(prefix="holytftp-relay-")
+    home, root = os.path.join(tmp, "home"), os.path.join(tmp, "root")
+    os.makedirs(os.path.join(home, ".config"))
+    os.makedirs(root)
+    with open(os.path.join(home, ".config", "holytftp.json"), "w") as f:
+        json.dump({"port": port, "tabs": [{"paths": [root]}], "admin_socket": "", "history": False}, f)
+    upstream_file = os.path.join(root, "image.bin")
+    first, second = os.urandom(300000), os.urandom(200000)
+    with open(upstream_file, "wb") as f:
+        f.write(first)
+    upstream = subprocess.Popen([sys.executable, "-m", "src.main", "--headless"], env=dict(os.environ, HOME=home),
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    failed = []
+
+    def expect(what, ok):
+        print("%-56s %s" % (what, "ok" if ok else "FAILED"))
+        if not ok:
+            failed.append(what)
+
+    def read_all(source):
+        out, offset = [], 0
+        while True:
+            data = source.read(offset, 0x10000)
+            if not data:
+                break
+            out.append(data)
+            offset += len(data)
+        source.close()
+        return b"".join(out)
+
+    def settle():
+        while relay.fetches or relay.revalidating:
+            gevent.sleep(0.05)
+
+    try:
+        relay = Relay("127.0.0.1:%d" % port, os.path.join(tmp, "cache"), 1 << 30, ttl=3600, stats=Stats())
+        for _ in range(100):  # until the upstream answers
+            try:
+                relay.client.probe_size("image.bin")
+                break
+            except TransferError:
+                gevent.sleep(0.1)
+        source = relay.open("image.bin")
+        expect("a missing file is fetched from the upstream", isinstance(source, FetchSource))
+        expect("the fetch is sent as it arrives", read_all(source) == first)
+        settle()
+        with open(relay.path("image.bin"), "rb") as f:
+            expect("the fetched copy is kept", f.read() == first)
+        source = relay.open("image.bin")
+        expect("the next request is served from the cache", isinstance(source, FileSource))
+        source.close()
+
+        relay.ttl = 0  # every copy is old from now on
+        os.utime(relay.path("image.bin"), (0, 0))
+        source = relay.open("image.bin")
+        expect("an old copy is served at once", isinstance(source, FileSource) and bool(relay.revalidating))
+        source.close()
+        settle()
+        expect("an unchanged upstream refreshes the copy",
+               relay.stats.counters.get("relay.revalidated") == 1 and os.stat(relay.path("image.bin")).st_mtime > 0)
+
+        with open(upstream_file, "wb") as f:
+            f.write(second)
+        expect("a changed upstream is served the cached copy meanwhile", read_all(relay.open("image.bin")) == first)
+        settle()
+        relay.ttl = 3600
+        expect("then the copy is fetched again", read_all(relay.open("image.bin")) == second)
+
+        relay.ttl = 0
+        os.unlink(upstream_file)
+        read_all(relay.open("image.bin"))
+        settle()
+        expect("a file gone upstream is dropped", "image.bin" not in relay.entries
+               and not os.path.exists(relay.path("image.bin")))
+    finally:
+        upstream.kill()
+        upstream.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failed
+
+
+def main(argv=None):
+    args = argv if argv is not None else sys.argv[1:]
+    failed = check(int(args[0]) if args else None)
+    print("%d checks failed" % len(failed) if failed else "all checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    # python -m src.tftp.relay [PORT]
+    sys.exit(main())
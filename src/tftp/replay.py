@@ -0,0 +1,161 @@
+"""
+Replay a request trace (see trace.py) against a server, e.g. a local
+one with the tuning to try, and compare with what was recorded.
+
+Every recorded request is sent again at its recorded time (scaled by
+--speed, 0 for as fast as possible) by a simulated client using the
+recorded options. Reads are discarded as they arrive; writes upload
+zeros of the recorded size under --write-dir. Against a loopback
+address, each recorded client gets its own source address
+(10.1.2.3 -> 127.1.2.3), so per-source limits apply as they did.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from collections import Counter
+import gevent
+from gevent.pool import Pool
+from .packet import TftpOpCode, TFTP_TIMEOUT, DEFAULT_BLOCK_SIZE
+from .client import TftpClient, TransferError
+from .trace import read_trace
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Replay(object):
+
+    def __init__(self, host, port=69, speed=1.0, jobs=1000, write_dir="replay"):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.jobs = jobs
+        self.write_dir = write_dir.strip("/")
+        self.spread = host.startswith("127.")
+        self.tmp = tempfile.mkdtemp(prefix="holytftp-replay-")
+        self.zeros = {}  # [size] = sparse local file to upload
+        self.results = []  # (record, ok, error, first block latency, duration)
+        self.late = 0  # requests sent later than scheduled: no job was free
+
+    def client(self, rec):
+        o = rec.get("o", {})
+        source = None
+        if self.spread:
+            source = "127." + ".".join(rec["c"].split(".")[1:])
+        return TftpClient(self.host, self.port, int(o.get("blksize", DEFAULT_BLOCK_SIZE)),
+                          int(o.get("windowsize", 1)), "tsize" in o, int(o.get("timeout", TFTP_TIMEOUT)),
+                          source=source)
+
+    def zero_file(self, size):
+        path = self.zeros.get(size)
+        if path is None:
+            self.zeros[size] = path = os.path.join(self.tmp, "%d.bin" % size)
+            with open(path, "wb") as f:
+                f.truncate(size)
+        return path
+
+    def one(self, rec):
+        start = time.time()
+        first = [None]
+        try:
+            client = self.client(rec)
+            if rec["op"] == TftpOpCode.ReadRequest:
+                def started(tsize):
+                    first[0] = time.time() - start
+                client.download(rec["f"], lambda data: None, started)
+                ok, error = True, None
+            else:
+                size = int(rec.get("o", {}).get("tsize") or rec.get("b") or 0)
+                name = rec["f"].replace("\\", "/").strip("/").replace("/", "_")
+                r = client.put(self.zero_file(size), "%s/%s" % (self.write_dir, name) if self.write_dir else name)
+                ok, error = r["ok"], r.get("error")
+        except (TransferError, OSError, ValueError) as e:
+            ok, error = False, str(e)
+        self.results.append((rec, ok, error, first[0], time.time() - start))
+
+    def run(self, records):
+        pool = Pool(self.jobs)
+        t0 = records[0]["t"]
+        start = time.time()
+        for rec in records:
+            if self.speed > 0:
+                due = start + (rec["t"] - t0) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+                if pool.full():
+                    self.late += 1
+            pool.spawn(self.one, rec)
+        pool.join()
+        return time.time() - start
+
+    def close(self):
+        for path in self.zeros.values():
+            os.unlink(path)
+        os.rmdir(self.tmp)
+
+
+def ms(value):
+    return "%8.1f" % (value * 1000) if value is not None else "%8s" % "-"
+
+
+def report(replay, records, elapsed):
+    results = replay.results
+    span = records[-1]["t"] - records[0]["t"]
+    print("%d requests over %.1fs recorded, replayed in %.1fs (speed %s), %d started late"
+          % (len(records), span, elapsed, replay.speed or "max", replay.late))
+    rec_failed = sum(1 for r in records if not r.get("ok"))
+    failed = sum(1 for r in results if not r[1])
+    print("%-22s %14s %14s" % ("", "recorded", "replayed"))
+    print("%-22s %7d %5.1f%% %7d %5.1f%%" % ("failed", rec_failed, 100.0 * rec_failed / len(records),
+                                             failed, 100.0 * failed / len(results)))
+    rec_durations = [r["d"] for r in records if r.get("ok") and "d" in r]
+    durations = [r[4] for r in results if r[1]]
+    waits = [r["q"] for r in records if "q" in r]
+    firsts = [r[3] for r in results if r[3] is not None]
+    for p in (50, 90, 99):
+        print("%-22s %14s %14s" % ("duration p%d (ms)" % p, ms(percentile(rec_durations, p)),
+                                   ms(percentile(durations, p))))
+    for p in (50, 90, 99):
+        print("%-22s %14s %14s" % ("queue / first block p%d" % p, ms(percentile(waits, p)),
+                                   ms(percentile(firsts, p))))
+    errors = Counter(r[2] for r in results if not r[1])
+    for error, count in errors.most_common(10):
+        print("%7d  %s" % (count, error))
+    return 1 if failed > rec_failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="holytftp-replay", description="Replay a request trace against a server.")
+    parser.add_argument("trace", help="trace file recorded with trace_file")
+    parser.add_argument("host", nargs="?", default="127.0.0.1", help="server address")
+    parser.add_argument("-p", "--port", type=int, default=69)
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="time scale, 10 for 10x, 0 for max")
+    parser.add_argument("-j", "--jobs", type=int, default=1000, help="simulated clients at once")
+    parser.add_argument("-n", "--limit", type=int, help="replay only the first N requests")
+    parser.add_argument("-w", "--write-dir", default="replay", help="remote folder of the uploads")
+    args = parser.parse_args(argv)
+
+    records = sorted((r for r in read_trace(args.trace)
+                      if r.get("op") in (TftpOpCode.ReadRequest, TftpOpCode.WriteRequest)), key=lambda r: r["t"])
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("no requests in %s" % args.trace, file=sys.stderr)
+        return 1
+    replay = Replay(args.host, args.port, args.speed, args.jobs, args.write_dir)
+    try:
+        elapsed = replay.run(records)
+    finally:
+        replay.close()
+    return report(replay, records, elapsed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,139 @@
 import os
 import sys
+import json
+import time
+import errno
+import signal
 import socket
+import subprocess
 import gevent
 from gevent import monkey, queue
 from .packet import *
 from ..log import log
 from ..globals import g
 from ..config import cfg
+from .history import TransferHistory
+from .mmsg import batch_io
+from .cache import NegativeCache
+from .storage import FileCache, ArchiveStore, CompressedStore
+from .warmup import Preloader
+from .stats import Stats
+from .profiler import Profiler
+from .capture import PacketRing
+from .admin import AdminServer
+from .limits import SourceLimiter
+from .acl import Acl
+from .trace import TraceRecorder
+from .mtu import PathMtu
+from .relay import Relay
+from .dedup import DedupStore
+from .sinks import open_sink, parse_stages, upload_limit
+from .netascii import NetasciiStore, NetasciiStage
+from .templates import Templates
+from .protocol import ReadMachine, WriteMachine, TFTP_RETRY, SEND, READ, WRITE, PROGRESS, DONE, CLOSE
 
-TFTP_RETRY = 5
 BUFFER_SIZE = 0xffff
+LISTEN_FD_ENV = "HOLYTFTP_LISTEN_FD"  # listening sockets handed over by a restarting process, main one first
+ANY_HOST = "0.0.0.0"
 
 monkey.patch_all()  # use monkey to replace original socket (and others) module
 socket.setdefaulttimeout(TFTP_TIMEOUT)
 
 
+def parse_listen(text, port=69):
+    """(host, port) of a tab's "listen": "1069", ":1069", "10.0.0.5" or "10.0.0.5:1069"."""
+    host, sep, p = text.strip().rpartition(":")
+    if not sep:
+        host, p = ("", p) if p.isdigit() else (p, "")
+    if p:
+        port = int(p)
+        if not 0 < port < 0x10000:
+            raise ValueError("invalid port %d" % port)
+    if host:
+        socket.inet_aton(host)  # raises OSError if it is not an IPv4 address
+    return host or ANY_HOST, port
+
+
+class TabListener(object):
+    """The socket of a tab served on its own address, read by a boss of its own."""
+
+    def __init__(self, tab, host, port, sock):
+        self.tab = tab
+        self.host = host
+        self.port = port
+        self.sock = sock
+        self.io = batch_io(sock, cfg.batch_io)
+        self.greenlet = None
+
+    def close(self):
+        if self.greenlet:
+            self.greenlet.kill()
+        self.sock.close()
+
+
+def write_errcode(e):
+    if e.errno in (errno.ENOSPC, errno.EFBIG, errno.EDQUOT):
+        return TftpErrCode.DiskFull
+    return TftpErrCode.AccessViolation
+
+
 class TftpServer(object):
     PORT = 69
-    WORKER_NUMBER = 4
 
     def __init__(self, port=PORT):
         self.port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.queue = queue.Queue()
+        self.worker_number = cfg.workers
+        self.workers = {}  # [index] = greenlet
+        self.rate_limit = cfg.rate_limit  # bytes per second per session
+        self.sock = None  # the main listener, serving the active tab
+        self.io = None
+        self.boss_greenlet = None
+        self.listeners = {}  # [tab] = TabListener of the tabs with their own "listen"
+        self.inherited = {}  # [(host, port)] = listening socket handed over, not claimed yet
+        self.handoff = False  # started by restart() of the process it replaces
+        self.draining = False
+        self.queue = queue.Queue(maxsize=cfg.queue_depth)  # (data, address, admitted time, tab, host)
+        self.limiter = SourceLimiter(cfg.source_rate, cfg.source_burst)
         self.peers = {}  # [address] = session
+        self.stats = Stats()
+        self.tab_stats = {}  # [tab] = Stats, counters only
+        self.profiler = Profiler(cfg.dump_dir)
+        self.profiler.on_stop = self.dump_stats
+        self.capture = PacketRing(cfg.capture_server_packets) if cfg.capture_server_packets else None
+        self.neg_cache = NegativeCache(cfg.neg_cache_ttl)
+        self.mtu = PathMtu()
+        self.not_found_reply = bytes(TftpErrorPacket(TftpErrCode.FileNotFound, "File Not Found"))
+        self.shutdown_reply = bytes(TftpErrorPacket(TftpErrCode.Undefined, "Server is shutting down"))
+        self.busy_reply = bytes(TftpErrorPacket(TftpErrCode.Undefined, "Server is busy"))
+        self.denied_reply = bytes(TftpErrorPacket(TftpErrCode.AccessViolation, "Access Denied"))
+        self.acl = Acl()
+        self.history = TransferHistory(cfg.history_file) if cfg.history else None
+        self.trace = TraceRecorder(cfg.trace_file) if cfg.trace_file else None
+        self.files = FileCache(cfg.file_cache_mb << 20)
+        self.archives = ArchiveStore()
+        self.compressed = CompressedStore(cfg.frame_cache_mb << 20)
+        self.netascii = NetasciiStore(cfg.netascii_cache_mb << 20)
+        self.templates = Templates(cfg.render_cache_mb << 20)
+        self.preloader = Preloader(self.files, self.history)
+        self.admin = AdminServer(self, cfg.admin_socket) if cfg.admin_socket else None
+        self.relay = None
+        if cfg.upstream:
+            try:
+                self.relay = Relay(cfg.upstream, cfg.relay_cache_dir, cfg.relay_cache_mb << 20,
+                                   cfg.relay_ttl, self.stats)
+            except (OSError, ValueError) as e:
+                log.error("invalid upstream %s:" % cfg.upstream, e)
+        self.upload_stages = parse_stages(cfg.upload_stages)
+        self.dedup = None
+        if cfg.dedup_store:
+            try:
+                self.dedup = DedupStore(cfg.dedup_store, cfg.dedup_chunk_kb << 10, self.stats)
+            except OSError as e:
+                log.error("cannot open dedup store %s:" % cfg.dedup_store, e)
+        if self.dedup and any(cls.suffix for cls, _ in self.upload_stages):
+            # a small change moves every compressed byte after it, so no chunk would be shared
+            log.warn("compression upload stages ignored: uploads go to the dedup store")
+            self.upload_stages = [(cls, arg) for cls, arg in self.upload_stages if not cls.suffix]
         self.start_callback = self.nop_callback
         self.update_callback = self.nop_callback
         self.stop_callback = self.nop_callback
@@ -36,11 +146,176 @@ class TftpServer(object):
         self.update_callback = update or self.nop_callback
         self.stop_callback = stop or self.nop_callback
 
-    def start(self):
+    def sessions(self):
+        return [s for s in self.peers.values() if isinstance(s, TftpSession)]
+
+    def set_workers(self, number):
+        number = max(1, number)
+        self.worker_number = number
+        for i in range(1, number + 1):
+            if i not in self.workers:
+                self.workers[i] = g.spawn(self.worker, i)
+        busy = set(s.index for s in self.sessions())
+        for i in list(self.workers):
+            if i > number and i not in busy:
+                self.workers.pop(i).kill(block=False)  # idle, retire it now
+        log.info("workers:", number)
+
+    def count(self, tab, name, n=1):
+        self.stats.incr(name, n)
+        stats = self.tab_stats.get(tab)
+        if stats is None:
+            self.tab_stats[tab] = stats = Stats()
+        stats.incr(name, n)
+
+    def session_stopped(self, session, ok, title, detail=""):
+        if self.history:
+            self.history.record(
+                start=session.start_time, duration=time.time() - session.start_time,
+                client=session.peer[0], port=session.peer[1],
+                direction="read" if session.is_read() else "write",
+                file=session.req.filename if session.req else None, path=session.filename,
+                size=session.size, bytes=session.transferred,
+                blksize=session.req.block_size if session.req else None,
+                req_blksize=session.req.requested_block_size if session.req else None,
+                retransmits=session.retransmits, ok=1 if ok else 0, result=title or "Completed",
+                detail=detail, results=json.dumps(session.results) if session.results else None)
+            if session.source:
+                self.history.access(session.filename)
+        if self.trace:
+            self.trace.finished(session.peer, ok, title or "Completed", time.time() - session.start_time,
+                                session.transferred, session.retransmits)
+        self.count(session.tab, "completed" if ok else "failed")
+        self.count(session.tab, "bytes_read" if session.is_read() else "bytes_written", session.transferred)
+        t = self.stats.now()
+        self.stop_callback(session.peer, ok, title, detail, session.results)
+        self.stats.timed("callback.stop", t)
+
+    def dump_stats(self, prefix):
+        """The counters and timers next to a profile."""
+        with open(prefix + ".stats.json", "w") as f:
+            json.dump(self.stats.dict(), f, indent=4)
+
+    def toggle_profiler(self, mode="sample"):
+        if self.profiler.running:
+            self.profiler.stop()
+        else:
+            self.profiler.start(cfg.profile_seconds, mode)
+
+    def dump_capture(self, filename=None):
+        if not self.capture:
+            return None
+        filename = filename or os.path.join(cfg.dump_dir, "server-%s.pcap" % time.strftime("%Y%m%d-%H%M%S"))
+        return self.capture.dump(filename)
+
+    def warmup(self, paths=None):
+        self.preloader.run(paths)
+
+    def drain(self, deadline=None, handoff=False):
+        """
+        Stop taking new requests and wait (up to `deadline` seconds) for the
+        admitted ones to finish; what is left then is killed.
+        With `handoff`, the boss stops reading the listening socket at all,
+        so new requests wait there for the process that took it over;
+        otherwise they are rejected with an ERROR packet.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        if deadline is None:
+            deadline = cfg.drain_seconds
+        if handoff and self.boss_greenlet:
+            self.boss_greenlet.kill()
+            for listener in self.listeners.values():
+                listener.greenlet.kill()
+        log.warn("draining %d sessions (%d queued), deadline %ds"
+                 % (len(self.sessions()), self.queue.qsize(), deadline))
+        end = time.time() + deadline
+        while (self.sessions() or not self.queue.empty()) and time.time() < end:
+            gevent.sleep(0.2)
+        for s in self.sessions():
+            s.kill("Server is shutting down")
+        log.warn("drained")
+
+    def shutdown(self, code=0, deadline=None):
+        self.drain(deadline)
+        self.close()
+        cfg.save()
+        sys.exit(code)
+
+    def restart(self):
+        """Start a new process on the same listening sockets, then drain this one."""
+        if self.draining:
+            return
+        if g.engine is not None:  # a new engine must be the GUI's child, with a link to it
+            g.engine.restart()
+            return
+        fds = [self.sock.fileno()] + [listener.sock.fileno() for listener in self.listeners.values()]
+        for fd in fds:
+            os.set_inheritable(fd, True)
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = ",".join(map(str, fds))
+        argv = [sys.executable, "-m", "src.main"] + sys.argv[1:]
+        log.warn("restarting:", " ".join(argv))
+        try:
+            subprocess.Popen(argv, env=env, pass_fds=fds)
+        except OSError as e:
+            log.error("failed to restart:", e)
+            return
+        self.drain(handoff=True)
+        self.close()
+        cfg.save()
+        sys.exit(0)
+
+    def close(self):
+        if self.admin:
+            self.admin.close()
+        if self.history:
+            self.history.close()
+        if self.trace:
+            self.trace.flush()
+
+    def tab_addresses(self):
+        """[tab] = (host, port) of the tabs with their own listener."""
+        ret = {}
+        for tab in range(len(cfg.tabs)):
+            listen = cfg.get_tab_listen(tab)
+            if not listen:
+                continue
+            try:
+                ret[tab] = parse_listen(listen, self.port)
+            except (ValueError, OSError) as e:
+                log.error("invalid listen %r of tab %d:" % (listen, tab), e)
+        return ret
+
+    def new_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if cfg.reuse_port and hasattr(socket, "SO_REUSEPORT"):
+            # lets a new instance bind the port while this one drains
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # a tab bound to one address shares the port with the wildcard listener,
+        # which both sockets must allow, whenever the tab starts listening
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock
+
+    def listen(self):
+        fds = os.environ.pop(LISTEN_FD_ENV, None)
+        if fds:
+            fds = [int(fd) for fd in fds.split(",")]
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, fileno=fds[0])
+            self.port = self.sock.getsockname()[1]
+            self.handoff = True
+            log.warn("took over the listening socket of port %d" % self.port)
+            for fd in fds[1:]:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, fileno=fd)
+                self.inherited[sock.getsockname()] = sock
+            return
+
+        self.sock = self.new_socket()
         bind_ok = False
         for i in range(self.port, 0x10000):
             try:
-                self.sock.bind(("0.0.0.0", i))
+                self.sock.bind((ANY_HOST, i))
             except OSError as e:
                 log.info("Failed to bind port %d" % i, e)
                 if i == self.port:
@@ -54,24 +329,87 @@ class TftpServer(object):
             g.error("No port available.")
             sys.exit(1)
 
+    def update_listeners(self):
+        """Open and close the listeners of the tabs to match their "listen"."""
+        wanted = self.tab_addresses()
+        for tab, listener in list(self.listeners.items()):
+            if wanted.get(tab) != (listener.host, listener.port):
+                log.info("tab %d no longer listens on %s:%d" % (tab, listener.host, listener.port))
+                self.listeners.pop(tab).close()
+        for tab, address in wanted.items():
+            if tab in self.listeners or self.draining:
+                continue
+            sock = self.inherited.pop(address, None)
+            if sock is None:
+                sock = self.new_socket()
+                try:
+                    sock.bind(address)
+                except OSError as e:
+                    sock.close()
+                    log.error("tab %d cannot listen on %s:%d:" % ((tab,) + address), e)
+                    g.warn("Tab %d cannot listen on %s:%d: %s" % ((tab,) + address + (e,)))
+                    continue
+            sock.setblocking(True)
+            self.listeners[tab] = listener = TabListener(tab, address[0], address[1], sock)
+            listener.greenlet = g.spawn(self.boss, listener.io, listener.port, tab, address[0])
+            log.info("tab %d listens on %s:%d" % ((tab,) + address))
+        for sock in self.inherited.values():
+            sock.close()  # no tab wants it any more
+        self.inherited.clear()
+
+    def reload(self):
+        cfg.load()
+        self.update_listeners()
+
+    def start(self):
+        self.listen()
         self.sock.setblocking(True)
+        self.io = batch_io(self.sock, cfg.batch_io)
+        log.info("boss uses", type(self.io).__name__)
+
+        self.boss_greenlet = g.spawn(self.boss, self.io, self.port)
+        self.update_listeners()
+        if self.history:
+            g.spawn(self.history.run)
+        if self.trace:
+            g.spawn(self.trace.run)
+        if cfg.preload or cfg.preload_hottest:
+            g.spawn(self.warmup)
+        if hasattr(signal, "SIGUSR1"):
+            gevent.signal_handler(signal.SIGUSR1, self.toggle_profiler)
+        if hasattr(signal, "SIGUSR2"):
+            gevent.signal_handler(signal.SIGUSR2, lambda: g.spawn(self.dump_capture))
+        if hasattr(signal, "SIGHUP"):
+            gevent.signal_handler(signal.SIGHUP, lambda: g.spawn(self.restart))
+        gevent.signal_handler(signal.SIGTERM, lambda: g.spawn(self.shutdown))
 
-        g.spawn(self.boss)
+        if self.admin:
+            try:
+                self.admin.start(takeover=self.handoff)
+            except OSError as e:
+                log.error("cannot create admin socket %s:" % self.admin.path, e)
 
-        for i in range(TftpServer.WORKER_NUMBER):
-            g.spawn(self.worker, i + 1)
+        self.set_workers(self.worker_number)
 
-    def boss(self):
-        log.info("boss is ready")
+    def boss(self, io, port, tab=None, host=ANY_HOST):
+        """Read the requests of a listener: the main one (tab None, the active tab) or a tab's own."""
+        log.info("boss of port %d is ready" % port)
         while True:
             try:
-                data, address = self.sock.recvfrom(BUFFER_SIZE)
-                log.info("B#0 << %s:%d: UDP L=%d" % (address[0], address[1], len(data)))
-                if self.peers.get(address) is not None:
-                    log.debug("B#0 -- %s:%d: duplicate session, ignored." % address)
-                    continue  # duplicate session
-                self.queue.put((data, address))
-                self.peers[address] = True
+                replies = []
+                for data, address in io.recv():
+                    reply = self.admit(data, address, port, cfg.active_tab if tab is None else tab, host)
+                    if self.trace:
+                        self.trace.arrived(self, data, address, time.time(), reply)
+                    if reply:
+                        replies.append((reply, address))
+                if replies:
+                    if self.capture:
+                        for reply, address in replies:
+                            self.capture.add(PacketRing.OUT, address, port, reply)
+                    t = self.stats.now()
+                    io.send(replies)
+                    self.stats.timed("sendto", t)
             except socket.timeout:
                 log.debug("B#0: wait timeout and retry ...")
             except socket.error as e:
@@ -79,208 +417,370 @@ class TftpServer(object):
             finally:
                 gevent.sleep()
 
+    def admit(self, data, address, port, tab, host=ANY_HOST):
+        log.info("B#0 << %s:%d: UDP L=%d" % (address[0], address[1], len(data)))
+        self.count(tab, "requests")
+        if self.capture:
+            self.capture.add(PacketRing.IN, address, port, data)
+        if self.draining:
+            log.debug("B#0 -- %s:%d: draining, rejected." % address)
+            return self.shutdown_reply
+        if not self.limiter.allow(address[0]):
+            log.debug("B#0 -- %s:%d: over the request rate, dropped." % address)
+            self.count(tab, "rate_limited")
+            return  # do not answer floods
+        if self.peers.get(address) is not None:
+            log.debug("B#0 -- %s:%d: duplicate session, ignored." % address)
+            return  # duplicate session
+        head = TftpReqPacket.peek(data)
+        if head is None:
+            log.debug("B#0 -- %s:%d: malformed request, dropped." % address)
+            self.count(tab, "malformed")
+            return  # no name to check against the acl, nothing a worker could parse
+        if not self.acl.allowed(address[0], head[0], head[1], tab):
+            log.debug("B#0 -- %s:%d: %s is denied by the acl" % (address[0], address[1], head[1]))
+            self.count(tab, "acl_denied")
+            return self.denied_reply
+        if head[0] == TftpOpCode.ReadRequest and self.neg_cache.hit(head[1], tab):
+            log.debug("B#0 -- %s:%d: %s is not found (cached)" % (address[0], address[1], head[1]))
+            self.count(tab, "neg_cache_hits")
+            return self.not_found_reply
+        try:
+            self.queue.put_nowait((data, address, time.time(), tab, host))
+        except queue.Full:
+            log.debug("B#0 -- %s:%d: queue is full, rejected." % address)
+            self.count(tab, "busy")
+            return self.busy_reply
+        self.peers[address] = True
+
     def worker(self, index):
         log.info("worker#%d is ready" % index)
-        while True:
-            data, address = self.queue.get()
+        while index <= self.worker_number:
+            data, address, admitted, tab, host = self.queue.get()
+            self.stats.add_time("queue_wait", time.time() - admitted)
+            if self.trace:
+                self.trace.started(address, time.time() - admitted)
             log.info("W#%d << %s:%d: UDP L=%d" % (index, address[0], address[1], len(data)))
-            s = TftpSession(self, index, data, address)
+            s = TftpSession(self, index, data, address, tab, host)
             self.peers[s.peer] = s
             s.run()
+            s.close()
+            if self.trace:
+                self.trace.forget(address)
             log.warn("W#%d -- %s:%d: session is terminated" % (index, address[0], address[1]))
             self.peers[s.peer] = None
             del s
             gevent.sleep()
+        log.info("worker#%d is retired" % index)
+        self.workers.pop(index, None)
 
 
 class TftpSession(object):
 
-    def __init__(self, server, index, data, address):
+    def __init__(self, server, index, data, address, tab=0, host=ANY_HOST):
         self.server = server
         self.index = index
         self.data = data
         self.peer = address
+        self.tab = tab  # decided when admitted: switching tabs does not affect it
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(TFTP_TIMEOUT)
+        self.sock.bind((host, 0))  # answer from the address the client asked
+        self.port = self.sock.getsockname()[1]
         self.req = None
         self.filename = None
-        self.block = 0
-        self.total_block = 0
-        self.retry = 0
-        self.finished = False
-        self.sending_pkt = None
-
-    def send(self, pkt, record=True):
-        log.info("W#%d >> %s:%d: %s" % (self.index, self.peer[0], self.peer[1], pkt))
-        if record:
-            self.sending_pkt = pkt
+        self.machine = None
+        self.stopped = False
+        self.source = None
+        self.sink = None
+        self.results = None  # what the upload stages reported (digests, ...)
+        self.ring = PacketRing(cfg.capture_packets) if cfg.capture_packets else None
+        self.size = 0
+        self.transferred = 0
+        self.start_time = time.time()
+
+    def close(self):
+        if self.source:
+            self.source.close()
+        self.close_sink(False)
+        self.sock.close()
+
+    def close_sink(self, ok):
+        """Finish the upload; a failed one is aborted (no manifest is written for it)."""
+        if self.sink:
+            sink, self.sink = self.sink, None
+            if ok:
+                self.results = sink.close()
+            else:
+                sink.abort()
+
+    @property
+    def retransmits(self):
+        return self.machine.retransmits if self.machine else 0
+
+    @property
+    def netascii(self):
+        return self.req is not None and self.req.mode is not None and self.req.mode.lower() == "netascii"
+
+    def is_read(self):
+        return self.req is not None and self.req.code == TftpOpCode.ReadRequest
+
+    def stop(self, ok, title, detail=""):
+        if self.stopped:
+            return
+        self.stopped = True
+        if not ok and title in ("Timeout", "Error") and self.ring:
+            filename = os.path.join(cfg.dump_dir, "session-%s-%d-%s.pcap"
+                                    % (self.peer[0], self.peer[1], time.strftime("%Y%m%d-%H%M%S")))
+            gevent.spawn(self.ring.dump, filename)
+        self.server.session_stopped(self, ok, title, detail)
+
+    def record(self, out, data):
+        if self.ring:
+            self.ring.add(out, self.peer, self.port, data)
+        if self.server.capture:
+            self.server.capture.add(out, self.peer, self.port, data)
+
+    def progress(self, transferred):
+        self.transferred = transferred
+        t = self.server.stats.now()
+        self.server.update_callback(self.peer, transferred)
+        self.server.stats.timed("callback.update", t)
+        if self.server.rate_limit > 0:
+            delay = transferred / self.server.rate_limit - (time.time() - self.start_time)
+            if delay > 0:
+                gevent.sleep(delay)
+
+    def kill(self, reason="Killed by administrator"):
+        log.warn("W#%d -- %s:%d: %s" % (self.index, self.peer[0], self.peer[1], reason))
+        self.stop(False, "Killed", reason)
+        self.send(TftpErrorPacket(TftpErrCode.Undefined, reason))
+        self.sock.close()  # wakes up run() if it is waiting
+
+    def find_compressed(self):
+        if not self.filename:
+            return None
+        try:
+            return self.server.compressed.find(self.filename)
+        except OSError as e:
+            log.error("W#%d: cannot index compressed file:" % self.index, e)
+            return None
+
+    def render(self):
+        """The rendering of a dynamic file, None if the name is none, False if it cannot be rendered."""
+        try:
+            return self.server.templates.open(self.req.filename, self.tab, self.peer[0])
+        except FileNotFoundError as e:  # e.g. the client is not in the table: let it try its next name
+            log.info("W#%d: %s" % (self.index, e.strerror))
+        except (OSError, ValueError) as e:
+            log.error("W#%d: cannot render %s:" % (self.index, self.req.filename), e)
+        return False
+
+    def find_member(self):
+        if not self.filename:
+            return None
+        try:
+            return self.server.archives.find(self.filename)
+        except OSError as e:
+            log.error("W#%d: cannot read archive:" % self.index, e)
+            return None
+
+    def send(self, pkt):
+        """Send a packet outside of the protocol machine (e.g. refusing the request)."""
         if pkt.code == TftpOpCode.Error:
             title = "Denied" if pkt.errcode in [TftpErrCode.AccessViolation, TftpErrCode.FileNotFound] else "Error"
-            self.server.stop_callback(self.peer, False, title, TftpErrCode.str(pkt.errcode) + ": " + pkt.msg)
-            self.finished = True
+            self.stop(False, title, TftpErrCode.str(pkt.errcode) + ": " + pkt.msg)
+        self.send_raw(bytes(pkt))
+
+    def send_raw(self, raw, address=None):
+        log.info("W#%d >> %s:%d: %s" % (self.index, self.peer[0], self.peer[1], describe(raw)))
         try:
-            return self.sock.sendto(bytes(pkt), self.peer)
+            self.record(PacketRing.OUT, raw)
+            t = self.server.stats.now()
+            n = self.sock.sendto(raw, address or self.peer)
+            self.server.stats.timed("sendto", t)
+            return n
         except socket.error as e:
             log.debug("W#%d -- %s:%d: error: %s" % (self.index, self.peer[0], self.peer[1], e))
 
+    def perform(self, actions):
+        """Carry out the actions of the protocol machine. True when the session is over."""
+        for action in actions:
+            kind = action[0]
+            if kind == SEND:
+                self.send_raw(action[1])
+            elif kind == READ:
+                try:
+                    t = self.server.stats.now()
+                    data = self.source.read(action[1], action[2])
+                    self.server.stats.timed("read", t)
+                except OSError as e:
+                    log.error("Failed to read file %s:" % self.filename, e)
+                    return self.perform(self.machine.fail(TftpErrCode.AccessViolation, e.strerror or str(e)))
+                if self.perform(self.machine.data(data)):
+                    return True
+            elif kind == WRITE:
+                try:
+                    t = self.server.stats.now()
+                    if self.sink is None:
+                        stages = self.server.upload_stages
+                        if self.netascii:
+                            stages = [(NetasciiStage, None)] + stages
+                        self.sink = open_sink(self.filename, stages, self.server.dedup)
+                    self.sink.write(action[2])
+                    self.server.stats.timed("write", t)
+                except OSError as e:
+                    log.error("Failed to write file %s:" % self.filename, e)
+                    return self.perform(self.machine.fail(write_errcode(e), e.strerror or str(e)))
+            elif kind == PROGRESS:
+                self.progress(action[1])
+            elif kind == DONE:
+                try:
+                    self.close_sink(action[1])
+                except OSError as e:
+                    log.error("Failed to write file %s:" % self.filename, e)
+                    return self.perform(self.machine.fail(write_errcode(e), e.strerror or str(e)))
+                if not action[1] and action[2] == "Timeout":
+                    log.error("W#%d: timeout" % self.index)
+                self.stop(action[1], action[2], action[3])
+            elif kind == CLOSE:
+                return True
+        return False
+
     def run(self):
         # parse and check first packet
         self.req = TftpReqPacket(self.data)
-        result = self.req.parse()
+        t = self.server.stats.now()
+        result = self.req.parse(self.server.mtu.max_block_size(self.peer[0]))
+        self.server.stats.timed("parse", t)
+        if self.req.requested_block_size and self.req.block_size < self.req.requested_block_size:
+            self.server.stats.incr("blksize_capped")
+            log.debug("W#%d: blksize %d capped to %d" % (self.index, self.req.requested_block_size,
+                                                        self.req.block_size))
         log.info("W#%d << %s:%d: %s" % (self.index, self.peer[0], self.peer[1], self.req))
         if result is False:
             return self.sock.close()  # simply ignore
 
         # get direction
         r = (self.req.code == TftpOpCode.ReadRequest)
+        relayed = False
+        member = packed = rendered = None
         # get file size
-        size = 0
         if self.req.filename:
-            self.filename = cfg.get_real_path(self.req.filename)
-            if r and self.filename and os.access(self.filename, os.F_OK):
-                size = os.path.getsize(self.filename)
+            self.filename = cfg.get_real_path(self.req.filename, self.tab)
+            if r and result is True:
+                rendered = self.render()
+            if rendered:
+                self.filename = rendered.path
+                self.size = rendered.size
+            elif rendered is False:
+                self.filename = None  # a dynamic file, not for this client
+            elif r and self.filename and os.access(self.filename, os.F_OK):
+                self.size = os.path.getsize(self.filename)
+            elif r and result is True:
+                packed = self.find_compressed()
+                member = None if packed else self.find_member()
+                if packed:
+                    self.size = packed.size
+                elif member:
+                    self.size = member[2][2]
+                elif self.server.relay:
+                    relayed = True  # missing here, ask the upstream
+                    self.filename = self.server.relay.path(self.req.filename)
             elif not r and self.req.tsize:
-                size = self.req.tsize
-        self.server.start_callback(self.peer, r, self.req.filename, size,
+                self.size = self.req.tsize
+        t = self.server.stats.now()
+        self.server.start_callback(self.peer, r, self.req.filename, self.size,
                                    self.filename or self.req.filename)
+        self.server.stats.timed("callback.start", t)
         if result is not True:  # error occurred
             return self.send(TftpErrorPacket(*result))
         if not self.filename:
+            if r and rendered is not False:  # a dynamic file may exist for the next client
+                self.server.neg_cache.add(self.req.filename, None, self.tab)
             return self.send(TftpErrorPacket(TftpErrCode.FileNotFound, "File Not Found"))
         if self.req.timeout:
             self.sock.settimeout(self.req.timeout)
 
         # start session
         if r:  # READ
-            if not os.access(self.filename, os.F_OK):
-                return self.send(TftpErrorPacket(TftpErrCode.FileNotFound, "File Not Found"))
-            if not os.access(self.filename, os.R_OK):
-                return self.send(TftpErrorPacket(TftpErrCode.AccessViolation, "Access Denied"))
-            if self.req.accepted_options:
-                # send OptionACK
-                self.send(TftpAckPacket.from_previous_packet(self.req))
+            if rendered:  # from a template
+                self.source = rendered
+            elif relayed:  # from the upstream
+                try:
+                    self.source = self.server.relay.open(self.req.filename)
+                except FileNotFoundError:
+                    self.server.neg_cache.add(self.req.filename, None, self.tab)
+                    return self.send(TftpErrorPacket(TftpErrCode.FileNotFound, "File Not Found"))
+                except OSError as e:
+                    log.error("W#%d: cannot relay %s:" % (self.index, self.req.filename), e)
+                    return self.send(TftpErrorPacket(TftpErrCode.Undefined, e.strerror))
+                self.size = self.source.size or 0
+            elif packed:  # from its .gz / .zst
+                self.source = self.server.compressed.open(packed)
+            elif member:  # from an archive
+                self.source = self.server.archives.open(member)
             else:
+                if not os.access(self.filename, os.F_OK):
+                    self.server.neg_cache.add(self.req.filename, self.filename, self.tab)
+                    return self.send(TftpErrorPacket(TftpErrCode.FileNotFound, "File Not Found"))
+                if not os.access(self.filename, os.R_OK):
+                    return self.send(TftpErrorPacket(TftpErrCode.AccessViolation, "Access Denied"))
                 try:
-                    with open(self.filename, "rb") as f:
-                        data = f.read(self.req.block_size)
-                        self.total_block += 1
-                        self.block = self.total_block % 0x10000
-                        self.send(TftpDataPacket(self.block, data))
-                        self.server.update_callback(
-                            self.peer, (self.total_block - 1) * self.req.block_size + len(data))
-                        if len(data) < self.req.block_size:
-                            self.finished = True
+                    self.source = self.server.dedup and self.server.dedup.open(self.filename)
+                    if self.source:  # an upload kept as a manifest of chunks
+                        self.size = self.source.size
+                    else:
+                        self.source = self.server.files.open(self.filename)
                 except FileNotFoundError as e:
                     log.error("W#%d: cannot open file %s" % (self.index, self.filename))
                     return self.send(TftpErrorPacket(TftpErrCode.FileNotFound, e.strerror))
                 except OSError as e:
                     log.error("Failed to open file %s:" % self.filename, e)
                     return self.send(TftpErrorPacket(TftpErrCode.AccessViolation, e.strerror))
+            if self.netascii:  # translated as it is sent, tsize included
+                try:
+                    self.source = self.server.netascii.open(self.source, None if rendered else self.filename)
+                except OSError as e:
+                    self.source = None
+                    log.error("W#%d: cannot translate %s:" % (self.index, self.filename), e)
+                    return self.send(TftpErrorPacket(TftpErrCode.AccessViolation, e.strerror or str(e)))
+                self.size = self.source.size
+            self.req.set_option("tsize", self.source.size)  # not offered if unknown (relay)
+            machine = ReadMachine
         else:  # WRITE
             if (os.access(self.filename, os.F_OK)
                     and not os.access(self.filename, os.W_OK))\
                 or (not os.access(self.filename, os.F_OK)
                     and not os.access(os.path.dirname(self.filename), os.W_OK)):
                 return self.send(TftpErrorPacket(TftpErrCode.AccessViolation, "Access Denied"))
-            self.send(TftpAckPacket.from_previous_packet(self.req))
+            limit = upload_limit(self.server.upload_stages)
+            if limit is not None and self.req.tsize and self.req.tsize > limit:
+                return self.send(TftpErrorPacket(TftpErrCode.DiskFull, "File too large (limit %d bytes)" % limit))
+            machine = WriteMachine
+        oack = bytes(TftpAckPacket.from_previous_packet(self.req)) if self.req.accepted_options else None
+        self.machine = machine(self.req.block_size, oack, TFTP_RETRY)
+        if self.perform(self.machine.start()):
+            return
 
         # wait next packet
         while True:
             try:
                 data, address = self.sock.recvfrom(BUFFER_SIZE)
-                if address != self.peer:
-                    log.debug("W#%d: %s: is not peer %s" % (self.index, address, self.peer))
-                    self.send(TftpErrorPacket(TftpErrCode.UnknownTID))
-                else:
-                    log.info("W#%d << %s:%d: UDP L=%d" % (self.index, self.peer[0], self.peer[1], len(data)))
-                    if self.step(data) is True:
-                        return
             except socket.timeout:
-                if self.timeout() > TFTP_RETRY:
-                    if not self.finished:
-                        log.error("W#%d: timeout" % self.index)
-                        self.server.stop_callback(self.peer, False, "Timeout")
-                    else:
-                        self.server.stop_callback(self.peer, True, "")
-                    return
+                log.debug("W#%d: timeout" % self.index)
+                actions = self.machine.timeout()
             except socket.error as e:
                 log.error("W#%d: error:" % self.index, e)
-                self.server.stop_callback(self.peer, False, "Error", str(e))
-                return
-
-    def timeout(self):
-        if self.finished and self.req.code == TftpOpCode.WriteRequest:
-            log.info("W#%d: final ack is sent %ds ago, terminated."
-                     % (self.index, self.sock.gettimeout()))
-            return TFTP_RETRY + 1
-        log.debug("W#%d: timeout and retry" % self.index)
-        self.retry += 1
-        self.send(self.sending_pkt)
-        return self.retry
-
-    def step(self, data):
-        if self.req.code == TftpOpCode.ReadRequest:  # READ
-            ack = TftpAckPacket.from_bytes(data)
-            if not ack:
+                self.stop(False, "Error", str(e))
                 return
-            log.info("W#%d << %s:%d: %s" % (self.index, self.peer[0], self.peer[1], str(ack)))
-            if ack.block != self.block:
-                log.info("W#%d: ignore block %d(not %d)" % (self.index, ack.block, self.block))
-                return
-            if self.finished:
-                log.info("W#%d: got final ack, terminated." % self.index)
-                self.server.stop_callback(self.peer, True, "")
-                return True  # got the final ack, terminate the session
-            try:
-                with open(self.filename, "rb") as f:
-                    f.seek(self.total_block * self.req.block_size)
-                    data = f.read(self.req.block_size)
-                    self.total_block += 1
-                    self.block = self.total_block % 0x10000
-                    self.send(TftpDataPacket(self.block, data))
-                    self.server.update_callback(
-                        self.peer, (self.total_block - 1) * self.req.block_size + len(data))
-                    if len(data) < self.req.block_size:
-                        self.finished = True
-                        # instead of terminate it immediately,
-                        # we wait a short time for retransmission purpose
-            except FileNotFoundError as e:
-                log.error("W#%d: cannot open file %s" % (self.index, self.filename))
-                self.send(TftpErrorPacket(TftpErrCode.FileNotFound, e.strerror))
-                return True  # terminated
-            except OSError as e:
-                log.error("Failed to open file %s:" % self.filename, e)
-                self.send(TftpErrorPacket(TftpErrCode.AccessViolation, e.strerror))
-                return True  # terminated
-        else:  # WRITE
-            pkt = TftpDataPacket.from_bytes(data)
-            if not pkt:
-                return
-            log.info("W#%d << %s:%d: %s" % (self.index, self.peer[0], self.peer[1], str(pkt)))
-            if pkt.block == self.block:
-                log.info("W#%d: retransmit ack" % self.index)
-                return self.send(TftpAckPacket(pkt.block), False)  # retransmit ack
-            elif pkt.block != ((self.total_block + 1) % 0x10000):
-                log.debug("W#%d: ignore block %d(not %d)"
-                          % (self.index, pkt.block, (self.total_block + 1) % 0x10000))
-                return
-            if self.finished:
-                log.info("W#%d: finishing session, ignored." % self.index)
+            else:
+                if address != self.peer:
+                    log.debug("W#%d: %s: is not peer %s" % (self.index, address, self.peer))
+                    self.send_raw(bytes(TftpErrorPacket(TftpErrCode.UnknownTID)), address)
+                    continue
+                log.info("W#%d << %s:%d: %s" % (self.index, self.peer[0], self.peer[1], describe(data)))
+                self.record(PacketRing.IN, data)
+                actions = self.machine.receive(data)
+            if self.perform(actions):
                 return
-            self.total_block += 1
-            self.block = self.total_block % 0x10000
-            try:
-                with open(self.filename, "wb" if self.total_block == 1 else "ab") as f:
-                    f.write(pkt.data)
-                    self.send(TftpAckPacket(pkt.block))
-                    self.server.update_callback(
-                        self.peer, (self.total_block-1) * self.req.block_size + len(pkt.data))
-                    if len(pkt.data) < self.req.block_size:
-                        self.finished = True
-                        self.server.stop_callback(self.peer, True, "")
-                        # instead of terminate it immediately,
-                        # we wait a short time for retransmission purpose
-            except OSError as e:
-                log.error("Failed to open file %s:" % self.filename, e)
-                self.send(TftpErrorPacket(TftpErrCode.AccessViolation, e.strerror))
-                return True  # terminated
@@ -0,0 +1,251 @@
+"""
+Upload sinks: where the data of a write session goes.
+
+A sink has write(data), close() -> results (a dict reported with the
+session) and abort(). Stages are sinks that pass every chunk on to the
+next one, so a chain of them handles a file of any size in flat memory:
+
+    ["limit:2G", "sha256", "crc32", "zstd:3"]
+
+caps the upload at 2 GB, hashes what the client sent and stores it as
+FILE.zst. A stage is "name" or "name:argument".
+"""
+import os
+import zlib
+import errno
+import hashlib
+from ..log import log
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+
+class FileSink(object):
+    """Upload written straight to its file. A failed upload leaves what was received."""
+
+    def __init__(self, path, replaces=None):
+        self.path = path
+        self.replaces = replaces  # plain file superseded by this (compressed) one
+        self.f = open(path, "wb")
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.f.close()
+        if self.replaces and os.path.exists(self.replaces):
+            os.unlink(self.replaces)  # would be served instead of the new upload
+        return {"stored": self.path} if self.replaces else {}
+
+    def abort(self):
+        self.f.close()
+
+
+class DedupSink(object):
+    """
+    Upload cut into fixed-size chunks that go to a DedupStore as they
+    fill; the file itself becomes a manifest once the upload completes.
+    A failed upload writes no manifest (its chunks are left to the GC).
+    """
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.buf = bytearray()
+        self.chunks = []
+        self.hasher = store.hasher()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        self.buf += data
+        n = self.store.chunk_size
+        while len(self.buf) >= n:
+            self.chunks.append(self.store.put(bytes(self.buf[:n])))
+            del self.buf[:n]
+
+    def close(self):
+        if self.buf:
+            try:
+                self.chunks.append(self.store.put(bytes(self.buf)))
+            except OSError:
+                self.abort()
+                raise
+            self.buf = bytearray()
+        self.store.commit(self.path, self.size, self.hasher.hexdigest(), self.chunks)
+        return {"chunks": len(self.chunks)}
+
+    def abort(self):
+        self.buf = bytearray()
+        self.store.release(self.chunks)
+
+
+class Stage(object):
+    suffix = ""  # added to the stored file name
+
+    def __init__(self, next, arg=None):
+        self.next = next
+
+    def write(self, data):
+        self.next.write(data)
+
+    def close(self):
+        return self.next.close()
+
+    def abort(self):
+        self.next.abort()
+
+
+class HashStage(Stage):
+    """Digest of the data seen so far, e.g. sha256, md5 (any hashlib name)."""
+
+    def __init__(self, next, name):
+        Stage.__init__(self, next)
+        self.name = name
+        self.hasher = hashlib.new(name)
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.next.write(data)
+
+    def close(self):
+        results = self.next.close()
+        results[self.name] = self.hasher.hexdigest()
+        return results
+
+
+class Crc32Stage(Stage):
+
+    def __init__(self, next, arg=None):
+        Stage.__init__(self, next)
+        self.crc = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.next.write(data)
+
+    def close(self):
+        results = self.next.close()
+        results["crc32"] = "%08x" % self.crc
+        return results
+
+
+class LimitStage(Stage):
+    """Fails the upload once it grows past `limit` bytes."""
+
+    def __init__(self, next, limit):
+        Stage.__init__(self, next)
+        self.limit = limit
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise OSError(errno.EFBIG, "File too large (limit %d bytes)" % self.limit)
+        self.next.write(data)
+
+
+class CompressStage(Stage):
+    """Compresses the data on its way to the next sink."""
+
+    def __init__(self, next, compressor):
+        Stage.__init__(self, next)
+        self.compressor = compressor
+        self.size = 0
+        self.compressed = 0
+
+    def write(self, data):
+        self.size += len(data)
+        out = self.compressor.compress(data)
+        if out:
+            self.compressed += len(out)
+            self.next.write(out)
+
+    def close(self):
+        out = self.compressor.flush()
+        self.compressed += len(out)
+        self.next.write(out)
+        results = self.next.close()
+        results["compressed"] = self.compressed
+        return results
+
+
+class GzipStage(CompressStage):
+    suffix = ".gz"
+
+    def __init__(self, next, level=6):
+        CompressStage.__init__(self, next, zlib.compressobj(level, zlib.DEFLATED, 31))
+
+
+class ZstdStage(CompressStage):
+    suffix = ".zst"
+
+    def __init__(self, next, level=3):
+        CompressStage.__init__(self, next, zstandard.ZstdCompressor(level=level).compressobj())
+
+
+def parse_size(text):
+    """'512', '64K', '2G' -> bytes"""
+    text = text.strip().upper()
+    for i, unit in enumerate("KMGT"):
+        if text.endswith(unit):
+            return int(float(text[:-1]) * (1 << (10 * (i + 1))))
+    return int(text)
+
+
+def parse_stages(specs):
+    """
+    Check the stage specs of the config: [(class, argument)] for the
+    valid ones, the others are logged and skipped.
+    """
+    stages = []
+    for spec in specs:
+        name, _, arg = str(spec).partition(":")
+        name = name.strip().lower()
+        try:
+            if name == "crc32":
+                stages.append((Crc32Stage, None))
+            elif name == "limit":
+                stages.append((LimitStage, parse_size(arg)))
+            elif name == "gzip":
+                stages.append((GzipStage, int(arg or 6)))
+            elif name == "zstd":
+                if zstandard is None:
+                    raise ValueError("the zstandard module is not installed")
+                stages.append((ZstdStage, int(arg or 3)))
+            elif name in hashlib.algorithms_available:
+                stages.append((HashStage, name))
+            else:
+                raise ValueError("unknown stage")
+        except ValueError as e:
+            log.error("upload stage %r ignored:" % spec, e)
+    return stages
+
+
+def upload_limit(stages):
+    """The smallest size limit of the stages, None if there is none."""
+    limits = [arg for cls, arg in stages if cls is LimitStage]
+    return min(limits) if limits else None
+
+
+def open_sink(path, stages=(), dedup=None):
+    """
+    The head of the chain writing an upload to `path` (plus the suffixes
+    of the compressors), or to the dedup store: compressors are not
+    combined with it, a manifest is no compressed file to serve.
+    """
+    suffix = "".join(cls.suffix for cls, _ in stages)
+    if dedup:
+        if suffix:
+            raise ValueError("compression stages cannot write to a dedup store")
+        sink = DedupSink(dedup, path)
+    else:
+        sink = FileSink(path + suffix, path if suffix else None)
+    for cls, arg in reversed(stages):
+        sink = cls(sink, arg)
+    return sink
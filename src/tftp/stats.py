@@ -0,0 +1,58 @@
+from time import perf_counter
+
+
+class Timer(object):
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def dict(self):
+        return {"count": self.count, "total": self.total, "max": self.max,
+                "avg": self.total / self.count if self.count else 0.0}
+
+
+class Stats(object):
+    """
+    Always-on counters and timers of the hot paths.
+
+    Timing costs two perf_counter() calls:
+        t = stats.now()
+        ...
+        stats.timed("read", t)
+    """
+
+    now = staticmethod(perf_counter)
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, name, start):
+        return self.add_time(name, perf_counter() - start)
+
+    def add_time(self, name, elapsed):
+        t = self.timers.get(name)
+        if t is None:
+            self.timers[name] = t = Timer()
+        t.add(elapsed)
+        return elapsed
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+
+    def dict(self):
+        return {"counters": dict(self.counters),
+                "timers": {k: v.dict() for k, v in self.timers.items()}}
@@ -0,0 +1,584 @@
+import os
+import bz2
+import errno
+import gzip
+import lzma
+import zlib
+import tarfile
+import zipfile
+from struct import unpack
+from bisect import bisect_right
+from collections import OrderedDict
+import gevent
+from gevent.event import AsyncResult
+from ..log import log
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+TAR_OPENERS = {".gz": gzip.open, ".tgz": gzip.open, ".bz2": bz2.open, ".tbz2": bz2.open,
+               ".xz": lzma.open, ".txz": lzma.open}
+STORED = "stored"  # member data lies as-is at an offset of the archive
+DEFLATED = "deflated"  # raw deflate stream at an offset (zip)
+ZIPPED = "zipped"  # other zip methods, read through zipfile
+TARRED = "tarred"  # offset in the decompressed stream of a compressed tar
+READ_AHEAD = 0x10000
+BAD_COMPRESSED = (zlib.error, EOFError) + ((zstandard.ZstdError,) if zstandard else ())
+SPAN = 4 << 20  # uncompressed bytes between two seek points of a compressed file, and per cached frame
+
+
+class FileSource(object):
+    """A file opened once for the whole session and read by offset."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.size = os.fstat(self.f.fileno()).st_size
+
+    def read(self, offset, length):
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def close(self):
+        self.f.close()
+
+
+class MemorySource(object):
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.size = len(data)
+
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+
+    def close(self):
+        pass
+
+
+class FileCache(object):
+    """
+    Files preloaded into memory, bounded by `capacity` bytes (LRU).
+
+    A cached copy is only served while the file's mtime and size are
+    unchanged; otherwise open() falls back to the file itself.
+    """
+
+    def __init__(self, capacity=256 << 20):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # [path] = (mtime, size, data)
+        self.used = 0
+
+    def open(self, path):
+        e = self.entries.get(path)
+        if e is not None:
+            st = os.stat(path)
+            if (st.st_mtime_ns, st.st_size) == e[:2]:
+                self.entries.move_to_end(path)
+                return MemorySource(path, e[2])
+            self.drop(path)
+        return FileSource(path)
+
+    def drop(self, path):
+        e = self.entries.pop(path, None)
+        if e is not None:
+            self.used -= len(e[2])
+
+    def put(self, path, st, data):
+        if len(data) > self.capacity:
+            return False
+        self.drop(path)
+        while self.used + len(data) > self.capacity:
+            p, e = self.entries.popitem(last=False)
+            self.used -= len(e[2])
+            log.debug("file cache: evict", p)
+        self.entries[path] = (st.st_mtime_ns, st.st_size, data)
+        self.used += len(data)
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        self.used = 0
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+class InflateReader(object):
+    """Inflates the raw deflate stream of a zip member as it is read."""
+
+    def __init__(self, path, offset, compressed_size):
+        self.f = open(path, "rb")
+        self.f.seek(offset)
+        self.left = compressed_size
+        self.z = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buf = b""
+
+    def read(self, n):
+        while len(self.buf) < n and (self.left > 0 or self.z.unconsumed_tail):
+            if self.z.unconsumed_tail:
+                chunk = self.z.unconsumed_tail
+            else:
+                chunk = self.f.read(min(READ_AHEAD, self.left))
+                if not chunk:
+                    break
+                self.left -= len(chunk)
+            self.buf += self.z.decompress(chunk, n - len(self.buf))
+        ret, self.buf = self.buf[:n], self.buf[n:]
+        return ret
+
+    def close(self):
+        self.f.close()
+
+
+class ArchiveSource(object):
+    """
+    A member of an archive. Stored members are read by offset like a
+    file; compressed ones are decompressed as a stream in the thread
+    pool, READ_AHEAD bytes at a time, and the stream is restarted only if
+    a read goes back past what was kept.
+    """
+
+    def __init__(self, index, name, member):
+        self.path = os.path.join(index.path, name)
+        self.index = index
+        self.name = name
+        self.kind, self.offset, self.size, self.extra = member
+        self.f = None
+        self.zip = None
+        self.stream = None
+        self.pos = 0
+        self.start = 0  # member offset of buf
+        self.buf = b""  # decompressed bytes around the last read
+        if self.kind == STORED:
+            self.f = open(index.path, "rb")
+
+    def open_stream(self):
+        self.close_stream()
+        self.pos = 0
+        if self.kind == DEFLATED:
+            self.stream = InflateReader(self.index.path, self.offset, self.extra)
+        elif self.kind == ZIPPED:
+            self.zip = zipfile.ZipFile(self.index.path)
+            self.stream = self.zip.open(self.extra)
+        else:  # TARRED
+            self.stream = self.index.opener(self.index.path, "rb")
+            self.skip(self.offset)
+            self.pos = 0
+
+    def close_stream(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if self.zip:
+            self.zip.close()
+            self.zip = None
+
+    def skip(self, n):
+        while n > 0:
+            chunk = self.stream.read(min(n, READ_AHEAD))
+            if not chunk:
+                break
+            n -= len(chunk)
+            self.pos += len(chunk)
+
+    def fill(self, offset, length):
+        """Reads the member without buffer nor thread pool: blocks while it decompresses."""
+        length = max(0, min(length, self.size - offset))
+        if self.kind == STORED:
+            return os.pread(self.f.fileno(), length, self.offset + offset)
+        if self.stream is None or offset < self.pos:
+            self.open_stream()
+        self.skip(offset - self.pos)
+        data = self.stream.read(length)
+        self.pos += len(data)
+        return data
+
+    def read(self, offset, length):
+        if self.kind == STORED:
+            return self.fill(offset, length)
+        end = min(offset + length, self.size)
+        if offset < self.start or end > self.start + len(self.buf):
+            if self.start <= offset <= self.start + len(self.buf):  # going on: the stream is at the end of buf
+                cut = max(0, offset - self.start - READ_AHEAD)  # a little is kept for retransmits
+                self.buf = self.buf[cut:]
+                self.start += cut
+            else:
+                self.start, self.buf = offset, b""
+            want = max(end - self.start - len(self.buf), READ_AHEAD)
+            self.buf += gevent.get_hub().threadpool.apply(self.fill, (self.start + len(self.buf), want))
+        return self.buf[offset - self.start:end - self.start]
+
+    def close(self):
+        if self.f:
+            self.f.close()
+        self.close_stream()
+
+
+class ArchiveIndex(object):
+    """Member name -> (kind, offset, size, extra) of one zip or tar archive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {}
+        self.opener = None
+        self.mtime = None
+        self.size = None
+
+    @staticmethod
+    def member_name(name):
+        name = name.replace("\\", "/")
+        while name.startswith("./"):
+            name = name[2:]
+        return name.lstrip("/")
+
+    def build(self):
+        st = os.stat(self.path)
+        self.mtime, self.size = st.st_mtime_ns, st.st_size
+        members = {}
+        if self.path.lower().endswith(".zip"):
+            with open(self.path, "rb") as f, zipfile.ZipFile(f) as z:
+                for i in z.infolist():
+                    if i.is_dir() or i.flag_bits & 0x1:  # encrypted ones cannot be served
+                        continue
+                    f.seek(i.header_offset)
+                    header = f.read(zipfile.sizeFileHeader)
+                    name_len, extra_len = unpack("<HH", header[26:30])
+                    offset = i.header_offset + zipfile.sizeFileHeader + name_len + extra_len
+                    if i.compress_type == zipfile.ZIP_STORED:
+                        member = (STORED, offset, i.file_size, None)
+                    elif i.compress_type == zipfile.ZIP_DEFLATED:
+                        member = (DEFLATED, offset, i.file_size, i.compress_size)
+                    else:
+                        member = (ZIPPED, offset, i.file_size, i.filename)
+                    members[self.member_name(i.filename)] = member
+        else:
+            ext = os.path.splitext(self.path.lower())[1]
+            self.opener = TAR_OPENERS.get(ext)
+            kind = TARRED if self.opener else STORED
+            with tarfile.open(self.path, "r:*") as t:
+                for m in t:
+                    if m.isreg() and not m.sparse:
+                        members[self.member_name(m.name)] = (kind, m.offset_data, m.size, None)
+        self.members = members
+        log.info("archive %s: %d members indexed" % (self.path, len(members)))
+        return self
+
+
+class ArchiveStore(object):
+    """
+    Archives used as (part of) a tab root. A path like
+    /srv/boot.zip/pxelinux.cfg/default is the member pxelinux.cfg/default
+    of /srv/boot.zip. The member index of an archive is built once in
+    the thread pool (sessions asking meanwhile wait for the same build)
+    and rebuilt when the archive's mtime or size changes.
+    """
+
+    def __init__(self):
+        self.indexes = {}  # [archive path] = ArchiveIndex
+        self.building = {}  # [archive path] = AsyncResult
+
+    @staticmethod
+    def split(path):
+        """(archive, member) if path lies inside an archive file, else None."""
+        archive = path
+        while True:
+            parent = os.path.dirname(archive)
+            if parent == archive or not parent:
+                return None
+            archive = parent
+            if os.path.exists(archive):
+                break
+        if not os.path.isfile(archive) or not is_archive(archive):
+            return None
+        return archive, os.path.relpath(path, archive)
+
+    def index(self, archive):
+        st = os.stat(archive)
+        index = self.indexes.get(archive)
+        if index is not None and (index.mtime, index.size) == (st.st_mtime_ns, st.st_size):
+            return index
+        pending = self.building.get(archive)
+        if pending is not None:
+            return pending.get()
+        self.building[archive] = pending = AsyncResult()
+        try:
+            index = gevent.get_hub().threadpool.apply(ArchiveIndex(archive).build)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError, lzma.LZMAError) as e:
+            error = OSError(errno.EINVAL, "Bad archive %s: %s" % (os.path.basename(archive), e))
+            pending.set_exception(error)
+            raise error
+        except OSError as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            del self.building[archive]
+        self.indexes[archive] = index
+        pending.set(index)
+        return index
+
+    def find(self, path):
+        """(index, name, member) of the member at path, or None."""
+        parts = self.split(path)
+        if parts is None:
+            return None
+        index = self.index(parts[0])
+        name = ArchiveIndex.member_name(parts[1])
+        member = index.members.get(name)
+        return (index, name, member) if member else None
+
+    def open(self, found):
+        return ArchiveSource(*found)
+
+
+class Inflater(object):
+    """Decompresses a gzip or zstd file from one of its seek points on."""
+
+    def __init__(self, index, fd, point):
+        self.index = index
+        self.fd = fd
+        self.pos, self.cpos, state = point  # next uncompressed byte out, next compressed byte in
+        self.d = state.copy() if state is not None else index.decompressor()
+        self.fresh = state is None  # at the start of a gzip member or zstd frame
+        self.pending = b""
+        self.buf = bytearray()
+
+    def fill(self):
+        """Decompress some more into buf. False at the end of the file."""
+        while True:
+            if not self.pending:
+                self.pending = os.pread(self.fd, READ_AHEAD, self.cpos)
+                if not self.pending:
+                    return False
+                self.cpos += len(self.pending)
+            if self.index.zstd:
+                out = self.d.decompress(self.pending)
+                self.pending = b""
+            else:  # bounded, a block of zeros inflates a thousandfold
+                out = self.d.decompress(self.pending, READ_AHEAD * 16)
+                self.pending = self.d.unconsumed_tail
+            self.fresh = False
+            if self.d.eof:  # next member / frame
+                self.pending = self.d.unused_data
+                self.d = self.index.decompressor()
+                self.fresh = True
+            if out:
+                self.buf += out
+                return True
+
+    def read(self, n):
+        while len(self.buf) < n and self.fill():
+            pass
+        out = bytes(self.buf[:n])
+        del self.buf[:n]
+        self.pos += len(out)
+        return out
+
+    def skip(self, n):
+        while n > 0:
+            out = self.read(min(n, SPAN))
+            if not out:
+                break
+            n -= len(out)
+
+    def point(self):
+        """A seek point at pos, or None if decompression cannot be resumed from here."""
+        if self.buf:
+            return None
+        if self.fresh:
+            return self.pos, self.cpos - len(self.pending), None
+        if self.index.zstd:
+            return None  # a zstd frame can only be entered at its start
+        return self.pos, self.cpos - len(self.pending), self.d.copy()
+
+
+class SeekIndex(object):
+    """
+    Seek points of a gzip or zstd file: (uncompressed offset, compressed
+    offset, decompressor state). A gzip member is one long deflate
+    stream, so a copy of the decompressor is kept about every SPAN bytes;
+    a zstd file can only be entered at the start of a frame (files made
+    with `zstd --seekable` or `pzstd` have many, plain `zstd` only one).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zstd = path.endswith(".zst")
+        st = os.stat(path)
+        self.mtime = st.st_mtime_ns
+        self.compressed_size = st.st_size
+        self.points = []
+        self.offsets = []  # uncompressed offsets of the points, for bisect
+        self.size = 0  # uncompressed
+
+    def decompressor(self):
+        if self.zstd:
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(31)
+
+    def add(self, point):
+        self.points.append(point)
+        self.offsets.append(point[0])
+
+    def build(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            inf = Inflater(self, fd, (0, 0, None))
+            self.add((0, 0, None))
+            while inf.fill():
+                inf.pos += len(inf.buf)
+                inf.buf.clear()
+                if inf.pos - self.offsets[-1] >= SPAN:
+                    point = inf.point()
+                    if point:
+                        self.add(point)
+            self.size = inf.pos
+        finally:
+            os.close(fd)
+        log.info("seek index of %s: %d bytes, %d points" % (self.path, self.size, len(self.points)))
+        return self
+
+    def point(self, offset):
+        return self.points[bisect_right(self.offsets, offset) - 1]
+
+
+class SeekSource(object):
+    """
+    The decompressed content of a gzip or zstd file, produced SPAN bytes
+    at a time from the nearest seek point and kept in the store's frame
+    cache. The inflater is kept across frames, so a sequential transfer
+    decompresses the file once even without seek points.
+    """
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self.path = index.path
+        self.size = index.size
+        self.fd = os.open(index.path, os.O_RDONLY)
+        self.inflater = None
+        self.frame = None  # (number, data) of the frame read last
+
+    def decode(self, n):
+        start = n * SPAN
+        inf = self.inflater
+        point = self.index.point(start)
+        if inf is None or inf.pos > start or inf.pos < point[0]:
+            inf = Inflater(self.index, self.fd, point)
+        inf.skip(start - inf.pos)
+        data = inf.read(SPAN)
+        self.inflater = inf
+        return data
+
+    def get_frame(self, n):
+        if self.frame is None or self.frame[0] != n:
+            key = (self.index.path, self.index.mtime, n)
+            data = self.store.frames.get(key)
+            if data is None:
+                try:
+                    data = gevent.get_hub().threadpool.apply(self.decode, (n,))
+                except BAD_COMPRESSED as e:
+                    raise OSError(errno.EIO, "Bad compressed file: %s" % e)
+                self.store.frames.put(key, data)
+            self.frame = (n, data)
+        return self.frame[1]
+
+    def read(self, offset, length):
+        out = []
+        end = min(offset + length, self.size)
+        while offset < end:
+            n, pos = divmod(offset, SPAN)
+            data = self.get_frame(n)[pos:pos + end - offset]
+            if not data:
+                raise OSError(errno.EIO, "%s is truncated" % self.path)
+            out.append(data)
+            offset += len(data)
+        return b"".join(out)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FrameCache(object):
+    """Decompressed frames shared by the sessions, bounded by `capacity` bytes (LRU)."""
+
+    def __init__(self, capacity=64 << 20):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # [(path, mtime, frame number)] = data
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.capacity:
+            return
+        self.used += len(data) - len(self.entries.pop(key, b""))
+        self.entries[key] = data
+        while self.used > self.capacity:
+            _, old = self.entries.popitem(last=False)
+            self.used -= len(old)
+
+
+class CompressedStore(object):
+    """
+    Files kept compressed at rest: FILE is served from FILE.gz or
+    FILE.zst when FILE itself does not exist. The seek index of such a
+    file is built once in the thread pool (sessions asking meanwhile
+    wait for the same build) and rebuilt when its mtime or size changes;
+    it also gives the uncompressed size for tsize.
+    """
+    SUFFIXES = (".gz", ".zst")
+
+    def __init__(self, capacity=64 << 20):
+        self.indexes = {}  # [compressed path] = SeekIndex
+        self.building = {}  # [compressed path] = AsyncResult
+        self.frames = FrameCache(capacity)
+
+    def find(self, path):
+        """The SeekIndex of the compressed copy of path, or None."""
+        for suffix in self.SUFFIXES:
+            if suffix == ".zst" and zstandard is None:
+                continue
+            if os.path.isfile(path + suffix):
+                return self.index(path + suffix)
+        return None
+
+    def index(self, path):
+        st = os.stat(path)
+        index = self.indexes.get(path)
+        if index is not None and (index.mtime, index.compressed_size) == (st.st_mtime_ns, st.st_size):
+            return index
+        pending = self.building.get(path)
+        if pending is not None:
+            return pending.get()
+        self.building[path] = pending = AsyncResult()
+        try:
+            index = gevent.get_hub().threadpool.apply(SeekIndex(path).build)
+        except BAD_COMPRESSED as e:
+            error = OSError(errno.EINVAL, "Bad compressed file %s: %s" % (os.path.basename(path), e))
+            pending.set_exception(error)
+            raise error
+        except OSError as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            del self.building[path]
+        self.indexes[path] = index
+        pending.set(index)
+        return index
+
+    def open(self, index):
+        return SeekSource(self, index)
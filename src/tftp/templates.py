@@ -0,0 +1,179 @@
+"""
+Dynamic files of a tab ("templates" in its config): a name matched like
+the mapping rules (name, regex or prefix) is rendered from a template
+for the client asking, instead of being read from the tab folder:
+
+    {"regex": "pxelinux\\.cfg/01-(?P<mac>[0-9a-f-]{17})",
+     "template": "templates/pxe.cfg", "table": "hosts.csv", "key": "mac"}
+
+A template is text where {{ip}}, {{ip_hex}} (pxelinux style, C0A80105),
+{{mac}} (aa:bb:cc:dd:ee:ff, found in the requested name), {{name}},
+{{root}}, the regex captures ({{1}}, {{mac}}...) and the fields of the
+client's row of the table are replaced. The table (.csv with a header
+line, first column the key, or .json {key: {field: value}}) is looked
+up by the `key` variable, mac by default. A template asking for a
+variable the client has not (no row in the table) is a missing file, so
+PXE clients go on to their next name.
+
+Renderings are cached by template and table version plus the values of
+the variables the template uses: clients differing only by what the
+template ignores share one, and each is rendered once.
+"""
+import os
+import re
+import csv
+import json
+import socket
+import errno
+import gevent
+from gevent.event import AsyncResult
+from ..log import log
+from ..config import cfg
+from ..rules import RuleSet, normalize
+from .storage import MemorySource, FrameCache
+
+PLACEHOLDER = re.compile(r"\{\{\s*([\w.-]+)\s*\}\}")
+MAC = re.compile(r"(?<![0-9a-fA-F])((?:[0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2})(?![0-9a-fA-F])")
+
+
+def normalize_mac(mac):
+    return mac.lower().replace("-", ":")
+
+
+def mtime(path):
+    return os.stat(path).st_mtime_ns
+
+
+class Template(object):
+    def __init__(self, path):
+        self.path = path
+        self.mtime = mtime(path)
+        with open(path, "r", encoding="utf-8") as f:
+            self.text = f.read()
+        self.names = sorted(set(PLACEHOLDER.findall(self.text)))
+
+    def render(self, values):
+        return PLACEHOLDER.sub(lambda m: values[m.group(1)], self.text).encode("utf-8")
+
+
+class Table(object):
+    def __init__(self, path):
+        self.path = path
+        self.mtime = mtime(path)
+        self.rows = {}  # [key] = {field: value}
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            if path.endswith(".json"):
+                rows = json.load(f)
+                if not isinstance(rows, dict) or not all(isinstance(row, dict) for row in rows.values()):
+                    raise ValueError("%s is not {key: {field: value}}" % path)
+                rows = rows.items()
+            else:
+                reader = csv.DictReader(f)
+                rows = ((row[reader.fieldnames[0]], row) for row in reader)
+            for key, row in rows:
+                self.rows[self.normalize(str(key))] = {str(k): str(v) for k, v in row.items()}
+
+    @staticmethod
+    def normalize(key):
+        key = key.strip().lower()
+        return normalize_mac(key) if MAC.fullmatch(key) else key
+
+
+class Rendered(MemorySource):
+    """A rendering being sent: `path` is its template, what the history and GUI show."""
+
+
+class Templates(object):
+    """The templates of the tabs, compiled on first use and again when the config changes."""
+
+    def __init__(self, capacity=16 << 20):
+        self.rules = {}  # [tab] = RuleSet
+        self.generation = None
+        self.templates = {}  # [path] = Template, reloaded when its mtime changes
+        self.tables = {}  # [path] = Table, idem
+        self.renders = FrameCache(capacity)  # [(template, mtime, table, mtime, values)] = data
+        self.rendering = {}  # [key] = AsyncResult, renders under way
+        self.rendered = 0
+
+    def get(self, tab):
+        if self.generation != cfg.generation:
+            self.rules.clear()
+            self.generation = cfg.generation
+        if tab not in self.rules:
+            rules = cfg.get_tab_templates(tab)
+            ruleset = None
+            if rules:
+                ruleset = RuleSet(rules, cfg.get_tab_path(tab), "template")
+                log.info("templates of tab %d: %d of %d compiled" % (tab, ruleset.size, len(rules)))
+            self.rules[tab] = ruleset
+        return self.rules[tab]
+
+    def load(self, store, path, cls):
+        """The parsed template or table of path, read again when the file changes."""
+        obj = store.get(path)
+        if obj is None or obj.mtime != mtime(path):
+            store[path] = obj = cls(path)
+        return obj
+
+    def values(self, name, ip, groups, named, rest, root):
+        values = {"ip": ip, "name": name, "root": root}
+        try:
+            values["ip_hex"] = socket.inet_aton(ip).hex().upper()
+        except OSError:
+            pass
+        m = MAC.search(name)
+        if m:
+            values["mac"] = normalize_mac(m.group(1))
+        if rest is not None:
+            values["rest"] = rest
+        values.update((str(i), v) for i, v in enumerate(groups))
+        values.update(named)
+        if "mac" in named and MAC.fullmatch(named["mac"]):
+            values["mac"] = normalize_mac(named["mac"])
+        return values
+
+    def open(self, name, tab, ip):
+        """The rendering of name for the client ip, None if name is no dynamic file of the tab."""
+        ruleset = self.get(tab)
+        if ruleset is None:
+            return None
+        name = normalize(name)
+        found = ruleset.match(name)
+        if found is None:
+            return None
+        rule, groups, named, rest = found
+        root = cfg.get_tab_path(tab)
+        template = self.load(self.templates, os.path.join(root, rule["template"]), Template)
+        values = self.values(name, ip, groups, named, rest, root)
+        table = None
+        if rule.get("table"):
+            table = self.load(self.tables, os.path.join(root, rule["table"]), Table)
+            row = table.rows.get(Table.normalize(values.get(rule.get("key", "mac"), "")))
+            if row:
+                values = dict(row, **values)
+        missing = [n for n in template.names if n not in values]
+        if missing:
+            raise FileNotFoundError(errno.ENOENT, "%s: no %s for %s" % (name, ", ".join(missing), ip))
+        key = (template.path, template.mtime, table.path if table else None, table.mtime if table else None,
+               tuple(values[n] for n in template.names))
+        return Rendered(template.path, self.render(key, template, values))
+
+    def render(self, key, template, values):
+        data = self.renders.get(key)
+        if data is not None:
+            return data
+        pending = self.rendering.get(key)
+        if pending is not None:
+            return pending.get()
+        self.rendering[key] = pending = AsyncResult()
+        try:
+            data = gevent.get_hub().threadpool.apply(template.render, (values,))
+        except Exception as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            del self.rendering[key]
+        self.rendered += 1
+        self.renders.put(key, data)
+        pending.set(data)
+        return data
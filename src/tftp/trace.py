@@ -0,0 +1,122 @@
+import gzip
+import json
+from collections import deque
+import gevent
+from ..log import log
+from .packet import TftpOpCode
+
+REQUESTS = (TftpOpCode.ReadRequest, TftpOpCode.WriteRequest)
+
+
+def parse_request(raw):
+    """(opcode, filename, {option: value}) of a RRQ/WRQ, or None. No validation, the session does that."""
+    if len(raw) < 4 or raw[1] not in REQUESTS or raw[0] != 0:
+        return None
+    fields = raw[2:].split(b"\0")
+    if len(fields) < 2:
+        return None
+    opts = fields[2:]
+    options = {opts[i].decode(errors="replace").lower(): opts[i + 1].decode(errors="replace")
+               for i in range(0, len(opts) - 1, 2) if opts[i]}
+    return raw[1], fields[0].decode(errors="replace"), options
+
+
+def open_trace(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+
+def read_trace(filename):
+    with open_trace(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class TraceRecorder(object):
+    """
+    Compact trace of the incoming requests, one JSON object per line
+    (gzipped if the file name ends with .gz):
+
+        {"t": arrival time, "c": client ip, "op": 1|2, "f": file name,
+         "o": {options}, "r": result, "ok": 0|1, "q": queue wait,
+         "d": duration, "b": bytes, "x": retransmits}
+
+    Requests refused by the boss are written at once ("r" is "busy",
+    "denied", "not found", ... and there is no duration); admitted ones
+    when their session ends. Like the history, lines are only queued
+    here and written from the thread pool by run().
+    """
+
+    FLUSH_INTERVAL = 1
+    REJECTED = {"busy_reply": "busy", "denied_reply": "denied",
+                "not_found_reply": "not found", "shutdown_reply": "draining"}
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lines = deque()
+        self.pending = {}  # [address] = record of an admitted request
+
+    def arrived(self, server, data, address, now, reply):
+        """The boss decided on a request: `reply` is what it answered (None if queued or dropped)."""
+        req = parse_request(data)
+        if req is None:
+            return
+        rec = {"t": round(now, 6), "c": address[0], "op": req[0], "f": req[1], "o": req[2]}
+        if reply is None and server.peers.get(address) is True and address not in self.pending:
+            self.pending[address] = rec
+            return
+        if reply is None:
+            rec["r"] = "dropped"
+        else:
+            rec["r"] = next((r for attr, r in self.REJECTED.items() if getattr(server, attr) is reply), "error")
+        rec["ok"] = 0
+        self.add(rec)
+
+    def started(self, address, wait):
+        rec = self.pending.get(address)
+        if rec is not None:
+            rec["q"] = round(wait, 6)
+
+    def finished(self, address, ok, result, duration, transferred, retransmits):
+        rec = self.pending.pop(address, None)
+        if rec is not None:
+            rec.update(r=result, ok=1 if ok else 0, d=round(duration, 6), b=transferred, x=retransmits)
+            self.add(rec)
+
+    def forget(self, address):
+        """The session ended without a result (e.g. an unparsable request)."""
+        rec = self.pending.pop(address, None)
+        if rec is not None:
+            rec.update(r="ignored", ok=0)
+            self.add(rec)
+
+    def add(self, rec):
+        self.lines.append(json.dumps(rec, separators=(",", ":")))
+
+    def take(self):
+        lines = list(self.lines)
+        self.lines.clear()
+        return lines
+
+    def write(self, lines):
+        with open_trace(self.filename, "a") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def flush(self):
+        if self.lines:
+            self.write(self.take())
+
+    def run(self):
+        log.info("requests are traced to", self.filename)
+        pool = gevent.get_hub().threadpool
+        while True:
+            gevent.sleep(self.FLUSH_INTERVAL)
+            if not self.lines:
+                continue
+            try:
+                pool.apply(self.write, (self.take(),))
+            except OSError as e:
+                log.error("failed to write trace:", e)
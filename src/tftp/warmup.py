@@ -0,0 +1,97 @@
+import os
+import gevent
+from ..log import log
+from ..config import cfg
+from ..utils import bytes2human
+
+CHUNK_SIZE = 1 << 20
+
+
+def read_whole(path, limit):
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size > limit:
+            return st, None
+        return st, f.read()
+
+
+def touch_pages(path):
+    """Pull a file into the OS page cache without keeping it."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while f.read(CHUNK_SIZE):
+            pass
+    return size
+
+
+class Preloader(object):
+    """
+    Warms up the hottest files (from the history) and the ones listed in
+    cfg.preload before traffic arrives, in the hub's thread pool.
+
+    In "memory" mode files go to the server's FileCache, in "pagecache"
+    mode they are only read through so the OS keeps them.
+    """
+
+    def __init__(self, files, history=None):
+        self.files = files
+        self.history = history
+        self.running = False
+        self.total = 0
+        self.done = 0
+        self.loaded = 0  # bytes read
+
+    def candidates(self):
+        paths = []
+        for name in cfg.preload:
+            p = name if os.path.isabs(name) else cfg.get_real_path(name)
+            if p:
+                paths.append(p)
+        if self.history and cfg.preload_hottest > 0:
+            try:
+                paths += gevent.get_hub().threadpool.apply(self.history.hottest, (cfg.preload_hottest,))
+            except Exception as e:
+                log.error("warm-up: cannot read the history:", e)
+        ret = []
+        for p in paths:
+            if p not in ret and os.path.isfile(p):
+                ret.append(p)
+        return ret
+
+    def progress(self):
+        return {"running": self.running, "total": self.total, "done": self.done,
+                "loaded": self.loaded, "memory": self.files.used}
+
+    def run(self, paths=None):
+        if self.running:
+            log.warn("warm-up is already running")
+            return
+        self.running = True
+        try:
+            self.warmup(self.candidates() if paths is None else paths)
+        finally:
+            self.running = False
+
+    def warmup(self, paths):
+        pool = gevent.get_hub().threadpool
+        memory = (cfg.preload_mode == "memory")
+        self.total, self.done, self.loaded = len(paths), 0, 0
+        log.info("warm-up: %d files into %s" % (self.total, "memory" if memory else "page cache"))
+        for path in paths:
+            try:
+                if memory:
+                    st, data = pool.apply(read_whole, (path, self.files.capacity))
+                    if data is None or not self.files.put(path, st, data):
+                        log.warn("warm-up: %s does not fit in the file cache" % path)
+                    else:
+                        self.loaded += len(data)
+                else:
+                    self.loaded += pool.apply(touch_pages, (path,))
+            except OSError as e:
+                log.error("warm-up: cannot read %s:" % path, e)
+            self.done += 1
+            log.info("warm-up %d/%d: %s (read %s, cache %s)"
+                     % (self.done, self.total, path, bytes2human(self.loaded), bytes2human(self.files.used)))
+        log.info("warm-up done")
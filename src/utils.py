@@ -0,0 +1,21 @@
+def bytes2human(n, precision=4):
+    b = int(n % 1024)
+    n /= 1024
+    k = int(n % 1024)
+    n /= 1024
+    m = int(n % 1024)
+    n /= 1024
+    g = int(n % 1024)
+    n /= 1024
+    t = int(n % 1024)
+    if t:
+        s, u = "%.2f" % (t + g/1024), "TB"
+    elif g:
+        s, u = "%.2f" % (g + m/1024), "GB"
+    elif m:
+        s, u = "%.2f" % (m + k/1024), "MB"
+    elif k:
+        s, u = "%.2f" % (k + b/1024), "KB"
+    else:
+        s, u = "%d" % b, "B"
+    return s[:int(precision)].strip(".") + " " + u